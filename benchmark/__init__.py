@@ -0,0 +1 @@
+"""benchmarks, run with python -m benchmark.<name>"""
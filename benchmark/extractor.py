@@ -0,0 +1,68 @@
+"""names/sec of whisky name parsing, the parsers one by one against extract,
+on names it hasn't seen, and again once they're cached as in re-parses.
+
+The corpus is made of synthetic names, distilleries from whisky/data with
+ages, vintages, sizes, strengths and cask numbers in the formats the
+parsers handle, some of which have none of them."""
+import argparse
+import random
+import time
+
+from whisky import extractor, parsers
+
+ATTRIBUTES = ['currency', 'abv', 'cask_no', 'size', 'vintage', 'age']
+PARTS = [
+	lambda rng: f"{rng.randint(3, 50)} Year Old",
+	lambda rng: f"{rng.randint(3, 50)} Years",
+	lambda rng: f"{rng.randint(1950, 2019)}",
+	lambda rng: f"’{rng.randint(60, 99)}",
+	lambda rng: f"{rng.choice([50, 180, 500, 700])}ml",
+	lambda rng: f"{rng.choice([20, 35, 70, 75])} cl",
+	lambda rng: f"{rng.choice(['1', '1.5', '4.5'])} litre",
+	lambda rng: f"{rng.randint(40, 65)}.{rng.randint(0, 9)}%",
+	lambda rng: f"Cask #{rng.randint(1, 9999)}",
+	lambda rng: f"Cask No.{rng.randint(1, 999)}",
+	lambda rng: rng.choice(['Single Malt', 'Sherry Cask', 'Rare Malts', 'Limited Edition', 'Distillers Edition']),
+]
+
+
+def _distilleries():
+	try:
+		with open('whisky/data/distilleries.txt', 'r') as f:
+			return [line.strip() for line in f if line.strip()]
+	except IOError:
+		return ['Macallan', 'Brora', 'Yamazaki', 'Ardbeg']
+
+
+def corpus(size, seed=0):
+	rng = random.Random(seed)
+	distilleries = _distilleries()
+	return [
+		' - '.join([rng.choice(distilleries)] + [part(rng) for part in rng.sample(PARTS, rng.randint(0, 5))])
+		for _ in range(size)]
+
+
+def one_by_one(name):
+	return {attr_name: getattr(parsers, attr_name)(name) for attr_name in ATTRIBUTES}
+
+
+def _time(label, fn, names):
+	start = time.perf_counter()
+	for name in names:
+		fn(name)
+	elapsed = time.perf_counter() - start
+	print(f"{label}: {len(names) / elapsed:,.0f} names/s")
+
+
+def run(names):
+	_time("one by one", one_by_one, names)
+	extractor._extract.cache_clear()
+	_time("extract", extractor.extract, names)
+	_time("extract, cached", extractor.extract, names)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--names', type=int, default=extractor.CACHE_SIZE)
+	args = parser.parse_args()
+	run(corpus(args.names))
@@ -0,0 +1,53 @@
+"""enqueue and dequeue rates of SqliteFrontier.
+
+Requests are fingerprinted up front, so this times the store,
+not scrapy's fingerprinting, which every backend pays the same."""
+import argparse
+import hashlib
+import tempfile
+import time
+
+from slick import frontier
+
+
+def _rate(count, seconds):
+	return f"{count / seconds:,.0f}/s"
+
+
+def run(count, domains, flush_size, chunk_size):
+	rows = []
+	for i in range(count):
+		url = f'http://site{i % domains}.com/page/{i}'
+		rows.append((hashlib.sha1(url.encode('utf8')).digest()[:frontier.FINGERPRINT_SIZE],
+			url, f'site{i % domains}.com', i % 10))
+
+	with tempfile.TemporaryDirectory() as directory:
+		queue = frontier.SqliteFrontier.for_spider(directory, 'benchmark', flush_size=flush_size)
+
+		start = time.perf_counter()
+		for key, url, domain, priority in rows:
+			queue.add(key, url, callback='parse', priority=priority, domain=domain)
+		queue.flush()
+		print(f"enqueue {count:,}: {_rate(count, time.perf_counter() - start)}")
+
+		start = time.perf_counter()
+		dequeued = sum(1 for _ in queue.iter_pending(chunk_size=chunk_size))
+		assert dequeued == count
+		print(f"dequeue {count:,}: {_rate(count, time.perf_counter() - start)}")
+
+		start = time.perf_counter()
+		for key, _, _, _ in rows:
+			queue.mark_crawled(key)
+		queue.flush()
+		print(f"resolve {count:,}: {_rate(count, time.perf_counter() - start)}")
+		queue.close()
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--count', type=int, default=500000, help="requests to enqueue")
+	parser.add_argument('--domains', type=int, default=100, help="domains they're spread over")
+	parser.add_argument('--flush-size', type=int, default=frontier.FLUSH_SIZE)
+	parser.add_argument('--chunk-size', type=int, default=frontier.CHUNK_SIZE)
+	args = parser.parse_args()
+	run(args.count, args.domains, args.flush_size, args.chunk_size)
@@ -0,0 +1,54 @@
+"""names/sec of distillery matching, as the distillery list grows.
+
+Compares the automaton of whisky.matcher with the linear scan it replaced,
+on names from benchmark.extractor, with the distilleries of whisky/data
+padded with made up ones to each list size."""
+import argparse
+import random
+import re
+import time
+
+from benchmark import extractor as names
+from whisky import parsers
+
+
+def linear_scan(distilleries):
+	"""the parser make_distillery_parser used to return"""
+	processed = [re.sub(r'\(\w+\)', '', dist).strip() for dist in distilleries]
+
+	def distillery_parser(txt):
+		for dist in processed:
+			if txt.find(dist) != -1:
+				return dist
+		return None
+
+	return distillery_parser
+
+
+def distilleries(size, seed=0):
+	rng = random.Random(seed)
+	res = names._distilleries()[:size]
+	while len(res) < size:
+		res.append('Glen ' + ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(8)).title())
+	return res
+
+
+def run(corpus, sizes):
+	for size in sizes:
+		listed = distilleries(size)
+		for label, parser in [
+				("linear scan", linear_scan(listed)),
+				("automaton", parsers.make_distillery_parser(listed))]:
+			start = time.perf_counter()
+			for name in corpus:
+				parser(name)
+			elapsed = time.perf_counter() - start
+			print(f"{size} distilleries, {label}: {len(corpus) / elapsed:,.0f} names/s")
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--names', type=int, default=20000)
+	parser.add_argument('--sizes', type=int, nargs='+', default=[100, 600, 6000])
+	args = parser.parse_args()
+	run(names.corpus(args.names), args.sizes)
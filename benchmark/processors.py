@@ -0,0 +1,104 @@
+"""values/sec of the field input processors, the chains they were against the fused ones.
+
+Values are the text and markup of elements of the html fixtures in test/data,
+see make download-fixtures, in lists as loaders pass them. Int and float
+processors only get the values they can read."""
+import argparse
+import glob
+import re
+import time
+
+from itemloaders.processors import MapCompose
+from scrapy.http import HtmlResponse
+from w3lib import html
+
+from slick import parser
+
+FIXTURES = 'test/data/*.html'
+FALLBACK = ['<span class="count">1,234</span>', ' 12 reviews ', '<td>\n 3\'001.5 </td>', 'Some <b>Game</b>', '  Indie  ']
+
+
+def strip_tags(value):
+	if isinstance(value, str):
+		return html.remove_tags(value)
+	return value
+
+
+def _strip_number(value):
+	for rep in ('"', "'", "\n", ','):
+		value = value.replace(rep, '')
+	return parser.strip_whitespace(value)
+
+
+def read_int(value):
+	if not isinstance(value, str):
+		return value
+	if not value:
+		return 0
+	stripped = _strip_number(value)
+	reg = re.search(r'[.\d]+', stripped)
+	result = reg[0] if reg else stripped
+	if (result.find('.') != -1):
+		return int(round(float(result)))
+	return int(result)
+
+
+def read_float(value):
+	if not isinstance(value, str):
+		return value
+	if not value:
+		return 0.0
+	return float(_strip_number(value))
+
+
+PROCESSORS = [
+	('int', MapCompose(strip_tags, parser.strip_whitespace, read_int), parser.MapValues(parser.clean_int)),
+	('float', MapCompose(strip_tags, parser.strip_whitespace, read_float), parser.MapValues(parser.clean_float)),
+	('text', MapCompose(strip_tags, parser.strip_whitespace), parser.MapValues(parser.clean_text)),
+]
+
+
+def fixture_values():
+	"""lists of values of each element, its text nodes and its markup"""
+	res = []
+	for path in sorted(glob.glob(FIXTURES)):
+		with open(path, 'rb') as f:
+			response = HtmlResponse(url='http://www.example.com', body=f.read(), encoding='utf-8')
+		for element in response.css('body *'):
+			res.append(element.xpath('./text()').getall())
+			res.append([element.get()])
+	return [values for values in res if values]
+
+
+def _readable(chain, corpus):
+	res = []
+	for values in corpus:
+		try:
+			chain(values)
+		except ValueError:
+			continue
+		res.append(values)
+	return res
+
+
+def run(corpus, repeat):
+	for name, chain, fused in PROCESSORS:
+		values = _readable(chain, corpus) * repeat
+		count = sum(len(v) for v in values)
+		for label, processor in [("chain", chain), ("fused", fused)]:
+			start = time.perf_counter()
+			for v in values:
+				processor(v)
+			elapsed = time.perf_counter() - start
+			print(f"{name} {label}: {count / elapsed:,.0f} values/s")
+
+
+if __name__ == "__main__":
+	argparser = argparse.ArgumentParser(description=__doc__)
+	argparser.add_argument('--repeat', type=int, default=1)
+	args = argparser.parse_args()
+	corpus = fixture_values()
+	if not corpus:
+		print(f"no fixtures in {FIXTURES}, run make download-fixtures. Using a few made up values")
+		corpus = [[value] for value in FALLBACK] * 20000
+	run(corpus, args.repeat)
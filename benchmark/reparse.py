@@ -0,0 +1,66 @@
+"""pages/sec of parallel re-parses, by number of processes.
+
+Builds a synthetic archive of listing pages, and parses it with a spider
+whose callback does what our loaders do, css selection and cleanup."""
+import argparse
+import os
+import tempfile
+import time
+
+from scrapy import Request, Spider
+from scrapy.http import HtmlResponse
+
+from slick import archive, reparse
+
+
+class BenchmarkSpider(Spider):
+	name = 'benchmark'
+
+	def parse_page(self, response):
+		for row in response.css('li.row'):
+			yield {
+				'name': row.css('a::text').get().strip(),
+				'url': response.urljoin(row.css('a::attr(href)').get()),
+				'price': row.css('span.price::text').re_first(r'[\d.]+'),
+			}
+
+
+def _page(i, rows):
+	items = ''.join(
+		f'<li class="row"><a href="/item/{i}/{j}"> item {j} </a><span class="price">${j}.99</span></li>'
+		for j in range(rows))
+	return f'<html><head><title>page {i}</title></head><body><ul>{items}</ul></body></html>'.encode('utf8')
+
+
+def run(pages, rows, segments, processes):
+	spider = BenchmarkSpider()
+	with tempfile.TemporaryDirectory() as directory:
+		writer = archive.ArchiveWriter(directory)
+		per_segment = max(pages // segments, 1)
+		for i in range(pages):
+			request = Request(f'http://example.com/page/{i}', callback=spider.parse_page)
+			writer.write(archive.make_record(request, HtmlResponse(request.url, body=_page(i, rows)), spider))
+			if (i + 1) % per_segment == 0:
+				writer.close()
+		writer.close()
+		segment_paths = archive.iter_segments(directory)
+
+		for count in processes:
+			workers = reparse.WorkerStats()
+			start = time.perf_counter()
+			for pid, parsed, seconds, _ in reparse.parse_segments(BenchmarkSpider, segment_paths, processes=count):
+				workers.add(pid, parsed, seconds)
+			elapsed = time.perf_counter() - start
+			per_worker = sum(workers.rates().values()) / len(workers.rates())
+			print(f"{count} processes: {pages / elapsed:,.0f} pages/s, {per_worker:,.0f} pages/s per worker")
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--pages', type=int, default=4000)
+	parser.add_argument('--rows', type=int, default=50, help="items per page")
+	parser.add_argument('--segments', type=int, default=64)
+	parser.add_argument('--processes', type=int, nargs='+',
+		default=sorted({1, 2, os.cpu_count() or 1}), help="process counts to compare")
+	args = parser.parse_args()
+	run(args.pages, args.rows, args.segments, args.processes)
@@ -19,9 +19,12 @@ def _env(key, default=None):
 	return env_val
 
 
-def _bool(var_name):
-	"""gets env variable as bool"""
-	return True if _env(var_name) else False
+def _bool(var_name, default=False):
+	"""gets env variable as bool, values like 0 and false are False"""
+	e = _env(var_name)
+	if not e:
+		return default
+	return e.lower() not in ('0', 'false', 'no', 'off')
 
 
 def _int(var_name, default=0):
@@ -54,7 +57,14 @@ _attributes = {
 	"mysql_db": _mkattr(_env, "MYSQL_DB", 'scraping'),
 	"mysql_password": _mkattr(_env, 'MYSQL_PASSWORD', 'password'),
 	"mysql_charset": _mkattr(_env, 'MYSQL_CHARSET', 'utf8mb4'),
+	"mysql_pool": _mkattr(_env, 'MYSQL_POOL', 'static'),
+	"mysql_pool_size": _mkattr(_int, 'MYSQL_POOL_SIZE', 5),
+	"mysql_pool_overflow": _mkattr(_int, 'MYSQL_POOL_OVERFLOW', 10),
+	"mysql_pool_timeout": _mkattr(_int, 'MYSQL_POOL_TIMEOUT', 30),
+	"mysql_pool_recycle": _mkattr(_int, 'MYSQL_POOL_RECYCLE', 5 * 60),
+	"mysql_pool_pre_ping": _mkattr(_bool, 'MYSQL_POOL_PRE_PING', False),
 	"forum_search": _mkattr(_env, 'FORUM_SEARCH', 'parsec'),
+	"cache_dir": _mkattr(_env, 'CACHE_DIR', '.cache'),
 }
 
 """use this attribute array to assign attributes
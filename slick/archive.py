@@ -0,0 +1,221 @@
+"""raw response archive, for re-parsing pages without crawling them again.
+
+ArchiveMiddleware writes every page it downloads, with its url, headers
+and serialized request, to gzipped segment files in a directory per spider.
+The reparse cli command replays an archive through the spider's callbacks
+and pipelines, with replay middlewares that serve archived responses
+instead of downloading them, see configure_replay."""
+import glob
+import gzip
+import os
+import pickle
+import time
+
+from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import Request
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.misc import load_object
+
+from slick import frontier
+
+# where spider archives are kept, unless ARCHIVE_DIR is set
+DEFAULT_DIR = '.archive'
+# segments are closed once this many bytes were written to them, bounding what a crash
+# loses. They're the unit of work of parallel re-parses, so there should be plenty
+SEGMENT_SIZE = 16 * 1024 * 1024
+SEGMENT_PATTERN = '*.pickle.gz'
+META_KEY = 'archived'
+
+
+def spider_directory(directory, spider_name):
+	return os.path.join(directory, spider_name)
+
+
+def is_robots(request):
+	"""true for robots.txt requests, which are archived but aren't the spider's"""
+	return urlparse_cached(request).path == '/robots.txt'
+
+
+def make_record(request, response, spider=None):
+	"""what's archived of a response"""
+	return {
+		'url': response.url,
+		'status': response.status,
+		'headers': dict(response.headers),
+		'body': response.body,
+		'cls': f'{type(response).__module__}.{type(response).__name__}',
+		'callback': getattr(request.callback, '__name__', None),
+		'request': frontier.serialize(request, spider),
+		'archived_at': time.time(),
+	}
+
+
+def make_response(record, request=None):
+	"""the archived response"""
+	return load_object(record['cls'])(
+		url=record['url'],
+		status=record['status'],
+		headers=record['headers'],
+		body=record['body'],
+		request=request)
+
+
+class ArchiveWriter(object):
+	"""appends records to gzipped segments of pickles in directory"""
+
+	def __init__(self, directory, segment_size=SEGMENT_SIZE):
+		self.directory = directory
+		self.segment_size = segment_size
+		self.file = None
+		self.written = 0
+		self.segments = 0
+		os.makedirs(directory, exist_ok=True)
+
+	def _open(self):
+		name = f"{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}-{self.segments:04d}.pickle.gz"
+		self.file = gzip.open(os.path.join(self.directory, name), 'wb')
+		self.written = 0
+		self.segments += 1
+
+	def write(self, record):
+		if self.file is None:
+			self._open()
+		data = pickle.dumps(record, protocol=4)
+		self.file.write(data)
+		self.written += len(data)
+		if self.written >= self.segment_size:
+			self.close()
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+
+def iter_segments(directory):
+	"""segment files in directory, oldest first"""
+	return sorted(glob.glob(os.path.join(directory, SEGMENT_PATTERN)))
+
+
+def iter_segment(path):
+	"""records of a segment. Segments cut short by a crash are read up to where they end"""
+	with gzip.open(path, 'rb') as f:
+		while True:
+			try:
+				yield pickle.load(f)
+			except EOFError:
+				return
+
+
+def iter_records(directory):
+	"""records of every segment in directory, oldest first"""
+	for path in iter_segments(directory):
+		yield from iter_segment(path)
+
+
+class ArchiveMiddleware(object):
+	"""downloader middleware archiving 200 responses, enabled by ARCHIVE_ENABLED.
+	Should come before HttpCompressionMiddleware, so bodies are archived decompressed."""
+
+	def __init__(self, stats=None, directory=DEFAULT_DIR, segment_size=SEGMENT_SIZE):
+		self.stats = stats
+		self.directory = directory
+		self.segment_size = segment_size
+		self.writer = None
+
+	@classmethod
+	def from_crawler(cls, crawler):
+		settings = crawler.settings
+		if not settings.getbool('ARCHIVE_ENABLED'):
+			raise NotConfigured
+		s = cls(
+			stats=crawler.stats,
+			directory=settings.get('ARCHIVE_DIR') or DEFAULT_DIR,
+			segment_size=settings.getint('ARCHIVE_SEGMENT_SIZE', SEGMENT_SIZE))
+		crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+		crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+		return s
+
+	def spider_opened(self, spider):
+		self.writer = ArchiveWriter(spider_directory(self.directory, spider.name), self.segment_size)
+
+	def spider_closed(self, spider):
+		self.writer.close()
+
+	def process_response(self, request, response, spider):
+		if response.status == 200:
+			self.writer.write(make_record(request, response, spider))
+			if self.stats is not None:
+				self.stats.inc_value('archive/responses', spider=spider)
+				self.stats.inc_value('archive/bytes', len(response.body), spider=spider)
+		return response
+
+
+class ReplaySpiderMiddleware(object):
+	"""replaces the start requests of the spider with the archived ones,
+	and drops requests its callbacks make, since those pages are replayed too"""
+
+	def __init__(self, directory=DEFAULT_DIR):
+		self.directory = directory
+
+	@classmethod
+	def from_crawler(cls, crawler):
+		return cls(directory=crawler.settings.get('ARCHIVE_DIR') or DEFAULT_DIR)
+
+	def process_start_requests(self, start_requests, spider):
+		# replayed pages aren't downloaded, so there's nothing to be polite to
+		spider.download_delay = 0
+		for record in iter_records(spider_directory(self.directory, spider.name)):
+			request = frontier.make_request(spider, record['url'], record['callback'], data=record['request'])
+			if request is not None and not is_robots(request):
+				request.meta[META_KEY] = record
+				yield request.replace(dont_filter=True)
+
+	def process_spider_output(self, response, result, spider):
+		for i in result:
+			if not isinstance(i, Request):
+				yield i
+
+
+class ReplayDownloaderMiddleware(object):
+	"""serves archived responses, and never downloads anything"""
+
+	def process_request(self, request, spider):
+		record = request.meta.pop(META_KEY, None)
+		if record is None:
+			raise IgnoreRequest(f"not archived: {request.url}")
+		return make_response(record, request=request)
+
+
+def configure_replay(settings, directory=None):
+	"""changes crawl settings to replay the archive in directory"""
+	if directory:
+		settings.set('ARCHIVE_DIR', directory, priority='cmdline')
+	spider_middlewares = settings.getdict('SPIDER_MIDDLEWARES')
+	spider_middlewares['slick.archive.ReplaySpiderMiddleware'] = 1
+	downloader_middlewares = settings.getdict('DOWNLOADER_MIDDLEWARES')
+	downloader_middlewares['slick.archive.ReplayDownloaderMiddleware'] = 1
+	# records are replayed oldest first, and every capture of a page should be
+	# written in turn so the newest wins, not dropped as a duplicate of the oldest
+	item_pipelines = settings.getdict('ITEM_PIPELINES')
+	item_pipelines['slick.pipeline.ItemDeduplicationPipeline'] = None
+	settings.setdict({
+		'SPIDER_MIDDLEWARES': spider_middlewares,
+		'DOWNLOADER_MIDDLEWARES': downloader_middlewares,
+		'ITEM_PIPELINES': item_pipelines,
+		'DEDUP_INDEX_DIR': None,
+		# nothing is downloaded, so nothing to be polite to
+		'CONCURRENT_REQUESTS': 64,
+		'CONCURRENT_REQUESTS_PER_DOMAIN': 64,
+		'DOWNLOAD_DELAY': 0,
+		'AUTOTHROTTLE_ENABLED': False,
+		'ROBOTSTXT_OBEY': False,
+		'COOKIES_ENABLED': False,
+		# these only make sense for pages that were downloaded
+		'ARCHIVE_ENABLED': False,
+		'RECRAWL_ENABLED': False,
+		'URLCACHE_ENABLED': False,
+		'HTTPCACHE_ENABLED': False,
+	}, priority='cmdline')
+	return settings
@@ -5,9 +5,11 @@ import os
 import time
 
 import sqlalchemy
+from scrapy.crawler import Crawler, CrawlerProcess
+from scrapy.utils.project import get_project_settings
 
 import env
-from slick import model, util
+from slick import archive, model, reparse, util
 import lib
 import sheets
 
@@ -41,6 +43,34 @@ def _create(name, drop=False):
 				raise e
 
 
+def _migrate(name):
+	"""migrates tables of models that define a migrate fn"""
+	with model.db_context() as db:
+		for model_class in util.get_models(name):
+			migrate = getattr(model_class, 'migrate', None)
+			if migrate:
+				logger.info(f"migrating {model_class.__name__}")
+				migrate(db, logger=logger)
+
+
+def _reparse(name, spider_name, directory=None, processes=1):
+	"""replays the archive of a spider through its callbacks and pipelines.
+	With more than one process, or 0 for one per cpu, callbacks run in a
+	process pool instead of a crawl, see slick.reparse"""
+	os.environ['SCRAPY_PROJECT'] = name
+	settings = archive.configure_replay(get_project_settings(), directory=directory)
+	if processes == 1:
+		process = CrawlerProcess(settings)
+		process.crawl(spider_name)
+		process.start()
+		return
+
+	settings.set('DBPIPELINE_THREADS', 0, priority='cmdline')
+	process = CrawlerProcess(settings)
+	crawler = Crawler(process.spider_loader.load(spider_name), settings)
+	reparse.reparse(crawler, settings.get('ARCHIVE_DIR') or archive.DEFAULT_DIR, processes=processes or None)
+
+
 def _as_dict(obj):
 	return obj.as_dict()
 
@@ -112,6 +142,14 @@ class ArgumentParser(argparse.ArgumentParser):
 		"""recreates tables"""
 		_create(self.name, drop=True)
 
+	def migrate(self, args):
+		"""migrates db tables to the current schema"""
+		_migrate(self.name)
+
+	def reparse(self, args):
+		"""re-parses archived responses of a spider, without crawling"""
+		_reparse(self.name, args.spider, directory=args.archive_dir, processes=args.processes)
+
 	def query(self, args):
 		"""parses args, queries mysql"""
 		model_name = args.name
@@ -139,8 +177,15 @@ class ArgumentParser(argparse.ArgumentParser):
 		parser = self
 		parser.add_subparser("create", self.create, help="creates db models")
 		parser.add_subparser("recreate", self.recreate, help="recreates db models")
+		parser.add_subparser("migrate", self.migrate, help="migrates db models to the current schema")
 		parser.add_subparser("ls", self.ls, help="lists info about scraper")
 
+		do_reparse = parser.add_subparser("reparse", self.reparse, help="re-parses archived responses of a spider")
+		do_reparse.add_argument('spider', type=str, help="the name of the spider")
+		do_reparse.add_argument('--archive-dir', type=str, help="where archives are kept, defaults to ARCHIVE_DIR")
+		do_reparse.add_argument('--processes', type=int, default=1,
+			help="parses in a pool of this many processes, 0 for one per cpu")
+
 		subparser = parser.add_subparser("query", self.query, help="queries models by classname")
 		subparser.add_argument('--name', type=str, help="the name of the model to query")
 		subparser.add_argument('--desc', action="store_true", help="show list in desc order instead of asc")
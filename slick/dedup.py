@@ -0,0 +1,312 @@
+"""deduplication backends for ItemDeduplicationPipeline.
+
+All backends have add(value), which returns true iff
+value was (probably) added before, and len(). The exact set is the
+default, bloom filters are opt-in where losing a few new values to
+false positives is ok, see false_positive_rate.
+
+Backends can be made persistent across runs with a SqliteIndex,
+which PersistentDupeFilter also uses for requests."""
+import hashlib
+import math
+import os
+import sqlite3
+import time
+
+from scrapy import signals
+from scrapy.dupefilters import BaseDupeFilter
+from scrapy.utils.request import request_fingerprint
+
+DEFAULT_BACKEND = 'set'
+DEFAULT_CAPACITY = 100000
+DEFAULT_ERROR_RATE = 0.001
+# new index entries are written in batches of this size, bounding what a crash loses
+INDEX_PERSIST_SIZE = 1000
+# where spider indexes are kept, unless DEDUP_INDEX_DIR is set
+DEFAULT_INDEX_DIR = '.dedup'
+
+
+def _to_bytes(value):
+	"""values are hashed by their string representation"""
+	return value if isinstance(value, bytes) else str(value).encode('utf-8')
+
+
+class ExactSet(object):
+	"""remembers every value, no false positives but memory grows with values"""
+
+	def __init__(self, **kwargs):
+		self.values = set()
+
+	def add(self, value):
+		if value in self.values:
+			return True
+		self.values.add(value)
+		return False
+
+	def __contains__(self, value):
+		return value in self.values
+
+	def __len__(self):
+		return len(self.values)
+
+
+class BloomFilter(object):
+	"""fixed size bloom filter, sized for capacity values at error_rate
+	false positives. Adding more values than capacity raises the error rate."""
+
+	def __init__(self, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE, **kwargs):
+		if not 0 < error_rate < 1:
+			raise ValueError(f"error_rate must be between 0 and 1, not {error_rate}")
+		self.capacity = capacity
+		self.error_rate = error_rate
+		self.num_bits = max(int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+		self.num_hashes = max(int(round(self.num_bits / capacity * math.log(2))), 1)
+		self.bits = bytearray((self.num_bits + 7) // 8)
+		self.count = 0
+
+	def _positions(self, value):
+		"""bit positions of value, using double hashing of one digest"""
+		digest = hashlib.blake2b(_to_bytes(value), digest_size=16).digest()
+		h1 = int.from_bytes(digest[:8], 'little')
+		h2 = int.from_bytes(digest[8:], 'little') | 1
+		return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+	def __contains__(self, value):
+		return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(value))
+
+	def add(self, value):
+		found = True
+		for p in self._positions(value):
+			mask = 1 << (p & 7)
+			if not self.bits[p >> 3] & mask:
+				found = False
+				self.bits[p >> 3] |= mask
+		if not found:
+			self.count += 1
+		return found
+
+	def is_full(self):
+		return self.count >= self.capacity
+
+	def false_positive_rate(self):
+		"""the chance that a new value is taken for a seen one, at the current fill"""
+		return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
+	def __len__(self):
+		return self.count
+
+
+class ScalableBloomFilter(object):
+	"""bloom filter that adds bigger, tighter filters as it fills up,
+	so the total error rate stays below error_rate however many values
+	are added, see Almeida et al, Scalable Bloom Filters.
+	Memory grows with about 2 bytes per value at a 0.1% error rate."""
+
+	GROWTH = 2
+	TIGHTENING = 0.5
+
+	def __init__(self, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE, **kwargs):
+		self.error_rate = error_rate
+		# the series error_rate * (1 - t) * t^i sums to error_rate
+		self.filters = [BloomFilter(capacity, error_rate * (1 - self.TIGHTENING))]
+
+	def __contains__(self, value):
+		return any(value in f for f in self.filters)
+
+	def add(self, value):
+		if value in self:
+			return True
+		last = self.filters[-1]
+		if last.is_full():
+			last = BloomFilter(last.capacity * self.GROWTH, last.error_rate * self.TIGHTENING)
+			self.filters.append(last)
+		last.add(value)
+		return False
+
+	def false_positive_rate(self):
+		"""the chance that a new value is taken for a seen one by any of the filters"""
+		return 1 - math.prod(1 - f.false_positive_rate() for f in self.filters)
+
+	def __len__(self):
+		return sum(len(f) for f in self.filters)
+
+
+BACKENDS = {
+	'set': ExactSet,
+	'bloom': BloomFilter,
+	'scalable': ScalableBloomFilter,
+}
+
+
+def make_backend(name=DEFAULT_BACKEND, **kwargs):
+	"""creates a backend by its name in BACKENDS"""
+	try:
+		backend_klass = BACKENDS[name]
+	except KeyError:
+		raise ValueError(f"unknown dedup backend {name}, expected one of {', '.join(BACKENDS)}")
+	return backend_klass(**kwargs)
+
+
+def false_positive_rate(backend):
+	"""the false positive rate of backend, 0 for exact ones"""
+	backend = getattr(backend, 'backend', backend)
+	rate = getattr(backend, 'false_positive_rate', None)
+	return rate() if rate else 0.0
+
+
+def _digest(value):
+	"""fixed size key for value, so the index doesn't store whole urls"""
+	return hashlib.blake2b(_to_bytes(value), digest_size=16).digest()
+
+
+class SqliteIndex(object):
+	"""on disk index of seen keys, by kind (such as an item class name),
+	in a sqlite db in WAL mode. Keys expire ttl seconds after they were
+	first seen, a ttl of 0 keeps them forever."""
+
+	def __init__(self, path, ttl=0, persist_size=INDEX_PERSIST_SIZE):
+		self.path = path
+		self.ttl = ttl
+		self.persist_size = persist_size
+		self.pending = []
+		directory = os.path.dirname(path)
+		if directory:
+			os.makedirs(directory, exist_ok=True)
+		self.conn = sqlite3.connect(path)
+		self.conn.execute('PRAGMA journal_mode=WAL')
+		self.conn.execute('PRAGMA synchronous=NORMAL')
+		self.conn.execute("""CREATE TABLE IF NOT EXISTS seen (
+			kind TEXT NOT NULL,
+			key BLOB NOT NULL,
+			seen_at REAL NOT NULL,
+			PRIMARY KEY (kind, key)) WITHOUT ROWID""")
+		self.conn.commit()
+
+	@classmethod
+	def for_spider(cls, directory, spider_name, **kwargs):
+		"""the index of a spider, one file per spider name"""
+		return cls(os.path.join(directory, f'{spider_name}.sqlite'), **kwargs)
+
+	def expire(self, now=None):
+		"""deletes keys older than ttl, returns how many"""
+		if not self.ttl:
+			return 0
+		now = time.time() if now is None else now
+		deleted = self.conn.execute('DELETE FROM seen WHERE seen_at < ?', (now - self.ttl, )).rowcount
+		self.conn.commit()
+		return deleted
+
+	def keys(self, kind):
+		"""iterates over the keys of kind, without loading them all"""
+		for row in self.conn.execute('SELECT key FROM seen WHERE kind = ?', (kind, )):
+			yield row[0]
+
+	def add(self, kind, key):
+		"""remembers key, written with the next persist"""
+		self.pending.append((kind, key, time.time()))
+		if len(self.pending) >= self.persist_size:
+			self.persist()
+
+	def persist(self):
+		"""writes pending keys"""
+		if self.pending:
+			self.conn.executemany('INSERT OR IGNORE INTO seen (kind, key, seen_at) VALUES (?, ?, ?)', self.pending)
+			self.conn.commit()
+			self.pending = []
+
+	def close(self):
+		self.persist()
+		self.conn.close()
+
+
+class PersistentBackend(object):
+	"""wraps a backend so values are remembered across runs in index.
+	Keys seen in earlier runs are loaded into the backend up front, so
+	lookups don't touch the disk."""
+
+	def __init__(self, backend, index, kind):
+		self.backend = backend
+		self.index = index
+		self.kind = kind
+		for key in index.keys(kind):
+			backend.add(key)
+
+	def add(self, value, remember=True):
+		"""true iff value was seen before, see the backends.
+		Without remember, new values are only kept for this run, see remember"""
+		key = _digest(value)
+		if self.backend.add(key):
+			return True
+		if remember:
+			self.index.add(self.kind, key)
+		return False
+
+	def remember(self, value):
+		"""keeps value for later runs"""
+		self.index.add(self.kind, _digest(value))
+
+	def __contains__(self, value):
+		return _digest(value) in self.backend
+
+	def __len__(self):
+		return len(self.backend)
+
+
+class PersistentDupeFilter(BaseDupeFilter):
+	"""request dupefilter remembering request fingerprints across runs,
+	for DEDUP_INDEX_TTL seconds, in the spider's index in DEDUP_INDEX_DIR.
+	Use it with DUPEFILTER_CLASS = 'slick.dedup.PersistentDupeFilter'.
+
+	Requests are filtered as soon as they're scheduled, but only kept for later
+	runs once their response arrives, so requests left pending by a crash or
+	an interrupted run aren't filtered when the crawl is resumed."""
+
+	KIND = 'request'
+
+	def __init__(self, spider_name, directory=DEFAULT_INDEX_DIR, ttl=0, backend=DEFAULT_BACKEND,
+			capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE, debug=False):
+		self.spider_name = spider_name
+		self.directory = directory
+		self.ttl = ttl
+		self.backend_kwargs = {'capacity': capacity, 'error_rate': error_rate}
+		self.backend_name = backend
+		self.debug = debug
+		self.index = None
+		self.seen = None
+
+	@classmethod
+	def from_crawler(cls, crawler):
+		settings = crawler.settings
+		s = cls(
+			crawler.spider.name,
+			directory=settings.get('DEDUP_INDEX_DIR') or DEFAULT_INDEX_DIR,
+			ttl=settings.getint('DEDUP_INDEX_TTL'),
+			backend=settings.get('DEDUP_BACKEND', DEFAULT_BACKEND),
+			capacity=settings.getint('DEDUP_CAPACITY', DEFAULT_CAPACITY),
+			error_rate=settings.getfloat('DEDUP_ERROR_RATE', DEFAULT_ERROR_RATE),
+			debug=settings.getbool('DUPEFILTER_DEBUG'))
+		crawler.signals.connect(s.response_received, signal=signals.response_received)
+		return s
+
+	def open(self):
+		"""loads fingerprints of earlier runs that haven't expired"""
+		self.index = SqliteIndex.for_spider(self.directory, self.spider_name, ttl=self.ttl)
+		self.index.expire()
+		self.seen = PersistentBackend(make_backend(self.backend_name, **self.backend_kwargs), self.index, self.KIND)
+
+	def request_seen(self, request):
+		return self.seen.add(request_fingerprint(request), remember=False)
+
+	def response_received(self, response, request, spider):
+		"""keeps the fingerprint of a crawled request for later runs"""
+		if self.seen is not None:
+			self.seen.remember(request_fingerprint(request))
+
+	def close(self, reason):
+		"""persists fingerprints seen in this run"""
+		self.index.close()
+
+	def log(self, request, spider):
+		if self.debug:
+			spider.logger.debug(f"filtered duplicate request: {request}")
+		spider.crawler.stats.inc_value('dupefilter/filtered', spider=spider)
@@ -7,6 +7,7 @@ from scrapy import signals
 from scrapy.exceptions import NotConfigured
 
 import metrics
+from slick import timing
 
 
 class PublishMetricsExtension(object):
@@ -36,11 +37,16 @@ class PublishMetricsExtension(object):
 		return o
 
 	def log(self):
-		"""logs the stats"""
+		"""logs the stats, and timing percentiles as a metric of their own"""
 		stats = {k: v for (k, v) in self.stats.get_stats().items() if k.find('log_count') == -1}
+		prefix = f'{timing.STATS_PREFIX}/'
+		timings = {k[len(prefix):]: v for (k, v) in stats.items() if k.startswith(prefix)}
+		stats = {k: v for (k, v) in stats.items() if not k.startswith(prefix)}
 		# first stats call only has log info
 		if stats:
 			self.metrics.publish('stats', stats, dimensions={"spider": self.spider_name})
+		if timings:
+			self.metrics.publish('timing', timings, dimensions={"spider": self.spider_name})
 
 	def spider_closed(self, spider, reason):
 		"""stops task on spider end"""
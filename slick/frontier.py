@@ -0,0 +1,187 @@
+"""embedded crawl frontier, for resuming crawls without a db service.
+
+SqliteFrontier keeps the requests of a crawl in a sqlite db in WAL mode,
+one file per spider, with a queue of pending requests per domain ordered
+by request priority. It resumes like steam's UrlCache: requests stay
+pending until their response is resolved, and pending requests are
+yielded again when the crawl restarts.
+
+Requests are stored serialized, as scrapy's disk queues store them,
+so resumed requests keep their callback, cookies, meta and priority."""
+import collections
+import os
+import pickle
+import sqlite3
+import zlib
+
+from scrapy.http import Request, Response
+from scrapy.utils.reqser import request_from_dict, request_to_dict
+from scrapy.utils.request import request_fingerprint
+
+from lib import get_domain
+
+# where spider frontiers are kept, unless URLCACHE_DIR is set
+DEFAULT_DIR = '.frontier'
+# pending writes that trigger a flush, bounding what a crash loses
+FLUSH_SIZE = 50000
+# pending requests read per query, per domain
+CHUNK_SIZE = 1000
+# page cache of the sqlite connection, big enough to keep the indexes in memory
+CACHE_KB = 256 * 1024
+# bytes of the request fingerprint kept as keys
+FINGERPRINT_SIZE = 16
+
+
+def fingerprint(request_or_response, size=FINGERPRINT_SIZE):
+	"""first size bytes of scrapy's request fingerprint,
+	of method, canonical url and body. Responses use their request."""
+	request = request_or_response
+	if isinstance(request, Response):
+		request = request.request or Request(request.url)
+	return bytes.fromhex(request_fingerprint(request))[:size]
+
+
+def serialize(request, spider=None):
+	"""compressed pickle of the request. None if it can't be pickled,
+	such as when its callback isn't a method of spider"""
+	try:
+		return zlib.compress(pickle.dumps(request_to_dict(request, spider=spider), protocol=4))
+	except (ValueError, TypeError, AttributeError, pickle.PicklingError):
+		return None
+
+
+def make_request(spider, url, callback=None, priority=0, data=None):
+	"""a cached request, rebuilt exactly if it was serialized, otherwise from
+	its url, callback and priority, which is also the fallback for data that
+	can't be read, such as when it's corrupt or from other code. None if spider
+	has no such callback, such as when it was renamed or removed since the
+	request was cached"""
+	if data is not None:
+		try:
+			return request_from_dict(pickle.loads(zlib.decompress(data)), spider=spider)
+		except (ValueError, AttributeError, ImportError, EOFError, zlib.error, pickle.UnpicklingError) as e:
+			spider.logger.error(f"can't rebuild cached request of {url} on {spider.name}, "
+				f"making it from its url: {e!r}")
+	callback = callback or 'parse'
+	fn = getattr(spider, callback, None)
+	if fn is None:
+		spider.logger.error(f"{callback} not registered on {spider.name}")
+		return None
+	return Request(url=url, callback=fn, priority=priority)
+
+
+class SqliteFrontier(object):
+	"""frontier in a sqlite file. Inserts and resolves are kept in memory
+	and written in bulk by flush, which runs once flush_size writes are pending."""
+
+	def __init__(self, path, flush_size=FLUSH_SIZE, spider=None):
+		self.path = path
+		self.flush_size = flush_size
+		self.spider = spider
+		self.inserts = collections.OrderedDict()
+		self.resolves = set()
+		directory = os.path.dirname(path)
+		if directory:
+			os.makedirs(directory, exist_ok=True)
+		self.conn = sqlite3.connect(path)
+		self.conn.execute('PRAGMA journal_mode=WAL')
+		self.conn.execute('PRAGMA synchronous=NORMAL')
+		# one crawl per file, so there's no need to share it
+		self.conn.execute('PRAGMA locking_mode=EXCLUSIVE')
+		self.conn.execute(f'PRAGMA cache_size=-{CACHE_KB}')
+		self.conn.execute("""CREATE TABLE IF NOT EXISTS request (
+			fingerprint BLOB NOT NULL PRIMARY KEY,
+			domain TEXT NOT NULL,
+			priority INTEGER NOT NULL,
+			url TEXT NOT NULL,
+			callback TEXT,
+			request BLOB,
+			crawled INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID""")
+		# the per domain queues, only pending requests are indexed
+		self.conn.execute("""CREATE INDEX IF NOT EXISTS request_queue
+			ON request (domain, priority, fingerprint) WHERE crawled = 0""")
+		self.conn.commit()
+
+	@classmethod
+	def for_spider(cls, directory, spider_name, **kwargs):
+		"""the frontier of a spider, one file per spider name"""
+		return cls(os.path.join(directory, f'{spider_name}.sqlite'), **kwargs)
+
+	def __len__(self):
+		return len(self.inserts) + len(self.resolves)
+
+	def _flush_if_full(self):
+		if self.flush_size and len(self) >= self.flush_size:
+			self.flush()
+
+	def add(self, key, url, callback=None, priority=0, domain=None, data=None):
+		"""queues a request by its fingerprint, unless it's already there"""
+		if key not in self.inserts:
+			self.inserts[key] = (key, get_domain(url) if domain is None else domain, priority, url, callback, data)
+			self._flush_if_full()
+
+	def mark_crawled(self, key):
+		"""queues marking the request with fingerprint key as crawled"""
+		self.resolves.add(key)
+		self._flush_if_full()
+
+	def insert(self, request):
+		"""queues a request, unless it's already there"""
+		self.add(fingerprint(request), request.url,
+			callback=getattr(request.callback, '__name__', None),
+			priority=request.priority,
+			data=serialize(request, self.spider))
+
+	def resolve(self, response):
+		"""queues marking the request of response as crawled"""
+		self.mark_crawled(fingerprint(response))
+
+	def flush(self):
+		"""writes pending inserts and resolves in one transaction, returns how many"""
+		inserts, self.inserts = list(self.inserts.values()), collections.OrderedDict()
+		resolves, self.resolves = [(key, ) for key in self.resolves], set()
+		if not inserts and not resolves:
+			return 0
+		with self.conn:
+			self.conn.executemany("""INSERT OR IGNORE INTO request
+				(fingerprint, domain, priority, url, callback, request) VALUES (?, ?, ?, ?, ?, ?)""", inserts)
+			self.conn.executemany('UPDATE request SET crawled = 1 WHERE fingerprint = ?', resolves)
+		return len(inserts) + len(resolves)
+
+	def domains(self):
+		"""domains with pending requests"""
+		self.flush()
+		return [row[0] for row in self.conn.execute('SELECT DISTINCT domain FROM request WHERE crawled = 0')]
+
+	def _domain_chunks(self, domain, chunk_size):
+		"""chunks of the pending requests of domain, by priority. Pages on
+		fingerprint within each priority, so each chunk is a range scan of the queue index"""
+		priorities = [row[0] for row in self.conn.execute("""SELECT DISTINCT priority FROM request
+			WHERE domain = ? AND crawled = 0 ORDER BY priority DESC""", (domain, ))]
+		for priority in priorities:
+			key = b''
+			while True:
+				rows = self.conn.execute("""SELECT fingerprint, url, callback, request FROM request
+					WHERE domain = ? AND priority = ? AND crawled = 0 AND fingerprint > ?
+					ORDER BY fingerprint LIMIT ?""", (domain, priority, key, chunk_size)).fetchall()
+				if rows:
+					yield [(url, callback, priority, data) for (_, url, callback, data) in rows]
+				if len(rows) < chunk_size:
+					break
+				key = rows[-1][0]
+
+	def iter_pending(self, chunk_size=CHUNK_SIZE):
+		"""(url, callback, priority, serialized request) of pending requests,
+		see make_request. Takes a chunk
+		from each domain's queue in turn, so no domain is stuck behind another"""
+		queues = collections.deque(self._domain_chunks(domain, chunk_size) for domain in self.domains())
+		while queues:
+			chunks = queues.popleft()
+			chunk = next(chunks, None)
+			if chunk is not None:
+				yield from chunk
+				queues.append(chunks)
+
+	def close(self):
+		self.flush()
+		self.conn.close()
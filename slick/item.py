@@ -36,12 +36,16 @@ class BaseLoader(ItemLoader):
 	"""base class for loading items from responses"""
 	default_output_processor = processors.TakeFirst()
 
-	_dependents = []
+	def __init__(self, *args, **kwargs):
+		"""dependents are tracked per loader, so items don't share them"""
+		super().__init__(*args, **kwargs)
+		self._dependents = []
 
 	def add_dependent(self, name, the_item):
 		"""adds a dependent item to the item loader"""
 
-		self._dependents.append(name)
+		if name not in self._dependents:
+			self._dependents.append(name)
 
 		if the_item is not None:
 			self.add_value(name, the_item)
@@ -1,15 +1,25 @@
 """data storage"""
+import collections
 import datetime
 import json
+import sys
+import threading
+import time
+import weakref
 from contextlib import contextmanager
 
 import sqlalchemy
+from sqlalchemy.dialects import mysql
+from sqlalchemy.dialects.mysql.dml import Insert as MySQLInsert
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ColumnElement
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm.interfaces import MANYTOONE
 import scrapy
 
 import env
 import lib
-from slick import parser, item
+from slick import parser, item, timing
 
 
 DEFAULT_ENGINE_ARGS = {
@@ -17,10 +27,27 @@ DEFAULT_ENGINE_ARGS = {
 		"connect_timeout": 1
 	},
 	'isolation_level': 'READ_COMMITTED',
-	'poolclass': sqlalchemy.pool.StaticPool,
-	'pool_recycle': 5 * 60,
+}
+# scrapy settings that override pool config from env, and their getters
+POOL_SETTINGS = {
+	'MYSQL_POOL': 'get',
+	'MYSQL_POOL_SIZE': 'getint',
+	'MYSQL_POOL_OVERFLOW': 'getint',
+	'MYSQL_POOL_TIMEOUT': 'getint',
+	'MYSQL_POOL_RECYCLE': 'getint',
+	'MYSQL_POOL_PRE_PING': 'getbool',
 }
 ITEM_MODEL_ATTRIBUTE = '_model_klass'
+# name batch flushes and commits are timed under, since they span item classes
+BATCH_TIMING_NAME = 'batch'
+# session info key set while core statements are uncommitted, see execute
+EXECUTED_INFO_KEY = 'slick_executed'
+# session info key of models inserted with core statements, see is_unchanged
+INSERTED_INFO_KEY = 'slick_inserted'
+# max number of lookup keys sent in one IN (...) query
+LOOKUP_CHUNK_SIZE = 500
+# max number of objects kept in the lookup cache, 0 disables it
+LOOKUP_CACHE_SIZE = 10000
 DEFAULT_COLLATION = 'utf8mb4_unicode_ci'
 URL_LENGTH = 512
 
@@ -33,12 +60,98 @@ def truncated_nowfn():
 	return datetime.datetime.utcnow().replace(microsecond=0)
 
 
+class InstrumentedQueuePool(sqlalchemy.pool.QueuePool):
+	"""QueuePool that counts checkouts and how long they waited for a connection"""
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.checkouts = 0
+		self.wait_time = 0.0
+		self.wait_time_max = 0.0
+
+	def _do_get(self):
+		started = time.time()
+		conn = super()._do_get()
+		waited = time.time() - started
+		self.checkouts += 1
+		self.wait_time += waited
+		self.wait_time_max = max(self.wait_time_max, waited)
+		return conn
+
+	def stats(self):
+		"""counters for publishing in crawler stats"""
+		return {
+			"checkouts": self.checkouts,
+			"wait_time": self.wait_time,
+			"wait_time_max": self.wait_time_max,
+			"checked_out": self.checkedout(),
+			"overflow": max(self.overflow(), 0),
+		}
+
+
+POOL_CLASSES = {
+	'static': sqlalchemy.pool.StaticPool,
+	'queue': InstrumentedQueuePool,
+	'null': sqlalchemy.pool.NullPool,
+}
+
+"""pool config from scrapy settings, see configure_pool"""
+_pool_settings = {}
+
+"""engines by url and args, so sessions share connection pools"""
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def _pool_setting(key):
+	"""pool config from scrapy settings, falling back to env"""
+	try:
+		return _pool_settings[key]
+	except KeyError:
+		return getattr(env, key.lower())
+
+
+def get_pool_args():
+	"""engine args for the configured pool, MYSQL_POOL is one of POOL_CLASSES"""
+	name = _pool_setting('MYSQL_POOL')
+	poolclass = POOL_CLASSES.get(name)
+	if poolclass is None:
+		raise ValueError(f"unknown MYSQL_POOL {name}, expected one of {', '.join(POOL_CLASSES)}")
+
+	args = {
+		'poolclass': poolclass,
+		'pool_recycle': _pool_setting('MYSQL_POOL_RECYCLE'),
+		'pool_pre_ping': _pool_setting('MYSQL_POOL_PRE_PING'),
+	}
+	if issubclass(poolclass, sqlalchemy.pool.QueuePool):
+		args.update({
+			'pool_size': _pool_setting('MYSQL_POOL_SIZE'),
+			'max_overflow': _pool_setting('MYSQL_POOL_OVERFLOW'),
+			'pool_timeout': _pool_setting('MYSQL_POOL_TIMEOUT'),
+		})
+	return args
+
+
+def configure_pool(settings):
+	"""overrides env pool config with scrapy settings, rebinding
+	SqlSession if anything changed. That has to happen before SqlSession
+	opens any session, see ReloadableSession._reload"""
+	configured = {key: getattr(settings, getter)(key)
+		for key, getter in POOL_SETTINGS.items() if settings.get(key) is not None}
+	if any(_pool_settings.get(key) != value for key, value in configured.items()):
+		_pool_settings.update(configured)
+		rebind()
+
+
 def get_engine(user=None, password=None, host=None, port=None, db=None, charset=None, **kwargs):
-	"""Gets sqlalchemy engine. Can also be configured using environment variables."""
-	# We use a null pool since we don't have that much load, and want to avoid Ops errors.
+	"""Gets sqlalchemy engine. Can also be configured using environment variables.
+	Engines are reused for the same connection string and args."""
+	# StaticPool is the default, since we don't have that much load, and want to avoid Ops errors.
 	# http://docs.sqlalchemy.org/en/latest/core/pooling.html#sqlalchemy.pool.SingletonThreadPool
 	# Singleton is discouraged in production, and I've seen intermittend 'Mysql has gone away' erorrs with it
-	_args = dict(DEFAULT_ENGINE_ARGS, **kwargs)
+	# Threaded writers should set MYSQL_POOL=queue.
+	_args = dict(DEFAULT_ENGINE_ARGS, **get_pool_args())
+	_args.update(kwargs)
 	mysql_dict = {
 		"user": user or env.mysql_user,
 		"password": password or env.mysql_password,
@@ -50,7 +163,48 @@ def get_engine(user=None, password=None, host=None, port=None, db=None, charset=
 
 	mysql_str = u"mysql+pymysql://{user}:{password}@{host}:{port}/{db}?charset={charset}".format(**mysql_dict)
 
-	return sqlalchemy.create_engine(mysql_str, **_args)
+	return _get_or_create_engine(mysql_str, **_args)
+
+
+def _get_or_create_engine(url, **kwargs):
+	"""gets the registered engine for url and kwargs, creating it if needed"""
+	key = (url, repr(sorted(kwargs.items(), key=lambda kv: kv[0])))
+	with _engines_lock:
+		engine = _engines.get(key)
+		if engine is None:
+			engine = _engines[key] = sqlalchemy.create_engine(url, **kwargs)
+		return engine
+
+
+def dispose_engine(engine):
+	"""closes pooled connections of engine and forgets it"""
+	with _engines_lock:
+		for key, registered in list(_engines.items()):
+			if registered is engine:
+				del _engines[key]
+	engine.dispose()
+
+
+def dispose_engines():
+	"""closes pooled connections of every engine, such as before forking,
+	so processes don't share them. Engines reconnect when next used"""
+	with _engines_lock:
+		engines = list(_engines.values())
+	for engine in engines:
+		engine.dispose()
+
+
+def get_pool_stats():
+	"""pool counters summed over registered engines, for pools that keep them"""
+	totals = collections.Counter()
+	with _engines_lock:
+		engines = list(_engines.values())
+	for engine in engines:
+		if isinstance(engine.pool, InstrumentedQueuePool):
+			pool_stats = engine.pool.stats()
+			totals.update({k: v for k, v in pool_stats.items() if k != 'wait_time_max'})
+			totals['wait_time_max'] = max(totals['wait_time_max'], pool_stats['wait_time_max'])
+	return dict(totals)
 
 
 class BaseObject(object):
@@ -64,6 +218,9 @@ class BaseObject(object):
 	_do_not_set_attributes = []
 	"""use to automatically wire db queries for looking up models from items"""
 	_lookup_attributes = []
+	"""opts in to upserting batches with INSERT ... ON DUPLICATE KEY UPDATE on mysql.
+	Only set it when the _lookup_attributes are covered by a unique key."""
+	_native_upsert = False
 
 	updated_at = sqlalchemy.Column(sqlalchemy.DateTime(), onupdate=truncated_nowfn, default=truncated_nowfn, index=True)
 	created_at = sqlalchemy.Column(sqlalchemy.DateTime(), default=truncated_nowfn, index=True)
@@ -97,6 +254,72 @@ class BaseObject(object):
 
 		return db.query(model_klass).filter(*attributes).one_or_none()
 
+	@classmethod
+	def get_lookup_key(cls, the_item):
+		"""the tuple of _lookup_attributes values that identifies the_item"""
+		return tuple(the_item.get(attr) for attr in cls._lookup_attributes)
+
+	@classmethod
+	def get_many_from_items(cls, db, items, chunk_size=LOOKUP_CHUNK_SIZE):
+		"""bulk version of get_from_item. Resolves all items with a handful of
+		WHERE (a, b) IN (...) queries, and returns a dict mapping every
+		looked up key (see get_lookup_key) to its model, or None if not found.
+		Keys with null values can't be matched with IN, and are left out.
+
+		Rows are matched to keys by their values, but the db compares with its
+		collation, e.g. mysql's _ci ones ignore case and trailing spaces, so
+		'VALVE' can find the row 'Valve'. Keys no row equals are matched to the
+		rows case and trailing space insensitively, and if rows are still left
+		over, the keys left are looked up one by one, so they're never taken
+		for new rows."""
+		if not cls._lookup_attributes:
+			raise ValueError(f"no _lookup_attributes registered on {cls.__name__}")
+
+		keys = {cls.get_lookup_key(the_item) for the_item in items}
+		keys = [key for key in keys if None not in key]
+		found = {key: None for key in keys}
+
+		columns = [getattr(cls, attr) for attr in cls._lookup_attributes]
+		for i in range(0, len(keys), chunk_size):
+			chunk = keys[i:i + chunk_size]
+			if len(columns) == 1:
+				condition = columns[0].in_([key[0] for key in chunk])
+			else:
+				condition = sqlalchemy.tuple_(*columns).in_(chunk)
+
+			rows = db.query(cls).filter(condition).all()
+			for obj in rows:
+				key = tuple(getattr(obj, attr) for attr in cls._lookup_attributes)
+				if key in found:
+					found[key] = obj
+			missing = [key for key in chunk if found[key] is None]
+			if missing and rows:
+				cls._match_collated(db, missing, rows, found)
+
+		return found
+
+	@classmethod
+	def _match_collated(cls, db, keys, rows, found):
+		"""sets found for keys whose rows the db returned with other values, see get_many_from_items"""
+		by_folded = {}
+		for obj in rows:
+			by_folded.setdefault(_collation_key(getattr(obj, attr) for attr in cls._lookup_attributes), obj)
+		for key in keys:
+			found[key] = by_folded.get(_collation_key(key))
+
+		matched = {id(obj) for obj in found.values() if obj is not None}
+		if all(id(obj) in matched for obj in rows):
+			return
+		# the db's collation is looser still, e.g. ignores accents
+		for key in keys:
+			if found[key] is None:
+				found[key] = db.query(cls).filter_by(**dict(zip(cls._lookup_attributes, key))).first()
+
+
+def _collation_key(values):
+	"""values folded the way case insensitive collations that ignore trailing spaces compare them"""
+	return tuple(value.rstrip(' ').casefold() if isinstance(value, str) else value for value in values)
+
 
 class Placeholder(object):
 	"""adds fields to the item derived from a model, but doesn't
@@ -116,18 +339,45 @@ def get_model_class_from_item(the_item):
 	except AttributeError:
 		return None
 
+class TrackedSession(sqlalchemy.orm.Session):
+	"""session that knows if it was closed"""
+	closed = False
+
+	def close(self):
+		super().close()
+		self.closed = True
+
+
 class ReloadableSession(object):
 	"""wrapper around session, to register
 	custom _reload function that rebinds engine"""
 
 	def __init__(self):
-		self.session = sqlalchemy.orm.sessionmaker(bind=get_engine())
+		self.session = sqlalchemy.orm.sessionmaker(bind=get_engine(), class_=TrackedSession)
+		self.sessions = weakref.WeakSet()
+
+	def __call__(self, **kwargs):
+		session = self.session(**kwargs)
+		self.sessions.add(session)
+		return session
 
-	def __call__(self):
-		return self.session()
+	def open_sessions(self):
+		"""sessions made here that haven't been closed"""
+		return [session for session in list(self.sessions) if not session.closed]
 
 	def _reload(self):
-		self.session = sqlalchemy.orm.sessionmaker(bind=get_engine())
+		"""binds to the currently configured engine, disposing the old one if it changed.
+		Raises RuntimeError instead if sessions are still open on the old one"""
+		old_engine = self.session.kw['bind']
+		engine = get_engine()
+		if engine is old_engine:
+			return
+		open_sessions = self.open_sessions()
+		if open_sessions:
+			raise RuntimeError(f"can't rebind the db engine with {len(open_sessions)} sessions open on it, "
+				"configure the pool before opening sessions")
+		self.session = sqlalchemy.orm.sessionmaker(bind=engine, class_=TrackedSession)
+		dispose_engine(old_engine)
 
 
 """The base class for SQLAlchemy models that we register"""
@@ -137,6 +387,147 @@ BaseModel = declarative_base(cls=BaseObject)  # SQLAlchemy syntax fore registeri
 SqlSession = ReloadableSession()
 
 
+class LookupCache(object):
+	"""bounded LRU cache mapping (model class, lookup key) to persistent
+	models, so looking up the same object again, such as a developer that
+	is a dependent of many games, doesn't go back to the db.
+
+	Each thread has entries of its own, since pipeline worker threads
+	each have a session of their own, see DBPipeline, and objects only
+	belong to one. Entries are only returned for the session they're
+	attached to, and others are dropped, counting as evictions. The
+	entries of a thread are dropped when its session rolls back."""
+
+	def __init__(self, maxsize=LOOKUP_CACHE_SIZE):
+		self.maxsize = maxsize
+		self.local = threading.local()
+		# entries of every thread, for stats and resizes
+		self.all_entries = []
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.lock = threading.RLock()
+
+	@property
+	def entries(self):
+		"""the entries of the calling thread"""
+		entries = getattr(self.local, 'entries', None)
+		if entries is None:
+			entries = self.local.entries = collections.OrderedDict()
+			with self.lock:
+				self.all_entries.append(entries)
+		return entries
+
+	def _lookup(self, db, model_klass, key):
+		"""returns the cached model iff it's still attached to db"""
+		cache_key = (model_klass, key)
+		entries = self.entries
+		obj = entries.get(cache_key)
+		if obj is not None and obj not in db:
+			del entries[cache_key]
+			self.evictions += 1
+			obj = None
+		return obj
+
+	def contains(self, db, model_klass, key):
+		"""true iff key is cached for db, doesn't count as a hit or miss"""
+		with self.lock:
+			return bool(self.maxsize) and self._lookup(db, model_klass, key) is not None
+
+	def get(self, db, model_klass, key):
+		"""gets cached model for key, or None"""
+		if not self.maxsize or not key or None in key:
+			return None
+
+		with self.lock:
+			obj = self._lookup(db, model_klass, key)
+			if obj is None:
+				self.misses += 1
+				return None
+
+			self.entries.move_to_end((model_klass, key))
+			self.hits += 1
+			return obj
+
+	def put(self, model_klass, key, obj):
+		"""caches obj under key, evicting the least recently used entry when full"""
+		if not self.maxsize or not key or None in key:
+			return
+
+		with self.lock:
+			entries = self.entries
+			entries[(model_klass, key)] = obj
+			entries.move_to_end((model_klass, key))
+			self._evict(entries)
+
+	def resize(self, maxsize):
+		"""changes max size, evicting entries that don't fit"""
+		with self.lock:
+			self.maxsize = maxsize
+			for entries in self.all_entries:
+				self._evict(entries)
+
+	def _evict(self, entries):
+		"""drops least recently used entries until we fit"""
+		while len(entries) > self.maxsize:
+			entries.popitem(last=False)
+			self.evictions += 1
+
+	def clear(self):
+		"""drops the entries of the calling thread, e.g. when its objects are invalidated by a rollback"""
+		with self.lock:
+			self.entries.clear()
+
+	def stats(self):
+		"""counters for publishing in crawler stats"""
+		with self.lock:
+			return {
+				"hits": self.hits,
+				"misses": self.misses,
+				"evictions": self.evictions,
+				"size": sum(len(entries) for entries in self.all_entries),
+			}
+
+
+"""The process wide lookup cache used by _get_or_create"""
+lookup_cache = LookupCache()
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_soft_rollback')
+def _clear_lookup_cache(session, previous_transaction):
+	"""rolled back objects may no longer exist, so we forget them all"""
+	lookup_cache.clear()
+	_clear_executed(session)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _clear_executed(session):
+	"""statements executed in the session are committed"""
+	session.info.pop(EXECUTED_INFO_KEY, None)
+	session.info.pop(INSERTED_INFO_KEY, None)
+
+
+def execute(db, statement, *multiparams):
+	"""executes a core statement in the session, remembering
+	that it has uncommitted writes, see has_changes"""
+	db.info[EXECUTED_INFO_KEY] = True
+	return db.execute(statement, *multiparams)
+
+
+def has_changes(db):
+	"""true iff committing db would write anything: new, deleted or modified
+	objects, or statements run with execute"""
+	if db.new or db.deleted or db.info.get(EXECUTED_INFO_KEY):
+		return True
+	return any(db.is_modified(obj) for obj in db.dirty)
+
+
+def is_unchanged(db, obj):
+	"""true iff obj is a model that was neither created nor modified in db"""
+	return isinstance(obj, BaseObject) and obj not in db.new and \
+		obj not in db.info.get(INSERTED_INFO_KEY, ()) and not db.is_modified(obj)
+
+
 def get_registered_models():
 	"""gets models that have subclassed BaseModel, e.g. are "pipelineable"."""
 	return BaseModel.__subclasses__()
@@ -175,38 +566,97 @@ def _is_one_col_match_key(key, col_list):
 			return True
 	return False
 
-def _is_primary_key(key, obj):
-	"""true iff key is the primary key on an object
+def _is_primary_key(key, model_klass):
+	"""true iff key is the primary key on a model class
 	that defines a simple (non-compound) primary key"""
-	model_klass = obj.__class__
 	primary_keys = model_klass.__mapper__.primary_key
 	return _is_one_col_match_key(key, primary_keys)
 
 
-def _is_foreign_key(key, obj):
-	for column in obj.__class__.__table__.c:
+def _is_foreign_key(key, model_klass):
+	for column in model_klass.__table__.c:
 		if column.name == key and column.foreign_keys:
 			return True
 	return False
 
 
-def update_model_from_item(obj, the_item):
-	"""sets all matching fields on db model from item"""
-	item_dependents = [name for name, _ in the_item.get_dependents()]
-	for key, value in the_item.items():
-		if key[0] != '_' and \
-				hasattr(obj, key) and \
-				key not in obj.__class__._do_not_set_attributes and \
-				key not in item_dependents and \
-				not _is_primary_key(key, obj) and \
-				not _is_foreign_key(key, obj) and \
-				key not in _get_relationship_properties(obj.__class__):
-			setattr(obj, key, value)
+def _is_settable(key, model_klass, relationships):
+	"""true iff key on an item should be written to a model_klass object"""
+	return key[0] != '_' and \
+		hasattr(model_klass, key) and \
+		key not in model_klass._do_not_set_attributes and \
+		not _is_primary_key(key, model_klass) and \
+		not _is_foreign_key(key, model_klass) and \
+		key not in relationships
+
+
+class WritePlan(object):
+	"""what gets written from items of one class to models of another.
+	Inspecting the mapper is slow, so it's done once per class pair
+	instead of for every key of every item."""
+
+	def __init__(self, item_klass, model_klass):
+		relationships = frozenset(_get_relationship_properties(model_klass))
+		fields = frozenset(item_klass.fields)
+
+		"""item fields that are set on the model"""
+		self.columns = frozenset(key for key in fields if _is_settable(key, model_klass, relationships))
+		"""the subset of columns that are actual table columns, for writing rows"""
+		self.table_columns = frozenset(key for key in self.columns if key in model_klass.__table__.c)
+		"""item fields that are never set: keys, relationships and private fields"""
+		self.skipped = fields - self.columns
+		"""relationships, which dependents are wired to"""
+		self.dependents = relationships
+		self.getters = tuple(model_klass._getters.items())
+
+	def _settable(self, the_item, columns):
+		"""columns of the_item that aren't registered as its dependents"""
+		if the_item._dependents:
+			return columns.difference(the_item._dependents)
+		return columns
+
+	def values(self, the_item):
+		"""table column values for a row, including getters"""
+		columns = self._settable(the_item, self.table_columns)
+		row = {key: value for key, value in the_item.items() if key in columns}
+		for key, getter in self.getters:
+			row[key] = getter(the_item)
+		return row
+
+	def apply(self, obj, the_item):
+		"""sets all planned fields on obj from the_item. On objects
+		loaded from the db only changed values are set, so unchanged
+		objects aren't marked as modified and don't get UPDATEd"""
+		columns = self._settable(the_item, self.columns)
+		values = [(key, value) for key, value in the_item.items() if key in columns]
+		values += [(key, getter(the_item)) for key, getter in self.getters]
+
+		if sqlalchemy.inspect(obj).has_identity:
+			for key, value in values:
+				if getattr(obj, key) != value:
+					setattr(obj, key, value)
+		else:
+			for key, value in values:
+				setattr(obj, key, value)
+
+		return obj
+
+
+"""write plans by (item class, model class), see get_write_plan"""
+_write_plans = {}
+
+
+def get_write_plan(item_klass, model_klass):
+	"""gets the write plan for a pair of classes, making it on first use"""
+	plan = _write_plans.get((item_klass, model_klass))
+	if plan is None:
+		plan = _write_plans[(item_klass, model_klass)] = WritePlan(item_klass, model_klass)
+	return plan
 
-	for key, getter in obj._getters.items():
-		setattr(obj, key, getter(the_item))
 
-	return obj
+def update_model_from_item(obj, the_item):
+	"""sets all matching fields on db model from item"""
+	return get_write_plan(the_item.__class__, obj.__class__).apply(obj, the_item)
 
 
 def new_model_from_item(klass, the_item):
@@ -225,37 +675,26 @@ def sqlalchemy_column_to_field(col, processors=None):
 	Note that all classes from sqlalchemy are registered, so
 	make sure you add them here if you start relying on new ones."""
 
-	default_processors = []
+	# a fused processor per type, see slick.parser
+	default_processor = None
 
 	_type = col.type
 
 	if isinstance(_type, sqlalchemy.Integer):
-		default_processors = [
-			parser.strip_tags,
-			parser.strip_whitespace,
-			parser.read_int]
+		default_processor = parser.clean_int
 
 	elif isinstance(_type, sqlalchemy.String):
-		default_processors = [
-			parser.strip_whitespace]
+		default_processor = parser.strip_whitespace
 
 	elif isinstance(_type, sqlalchemy.Unicode):
-		default_processors = [
-			parser.strip_tags,
-			parser.strip_whitespace]
+		default_processor = parser.clean_text
 
 	elif isinstance(_type, sqlalchemy.Float):
-		default_processors = [
-			parser.strip_tags,
-			parser.strip_whitespace,
-			parser.read_float]
+		default_processor = parser.clean_float
 
 	elif isinstance(_type, sqlalchemy.Boolean):
 		# detects presence of tags
-		default_processors = [lambda x: True if x is not None else False]
-		# parser.strip_tags,
-		# parser.strip_whitespace,
-		# parser.read_bool]
+		default_processor = parser.is_present
 
 	elif isinstance(_type, sqlalchemy.DateTime):
 		pass
@@ -264,25 +703,36 @@ def sqlalchemy_column_to_field(col, processors=None):
 		raise NotImplementedError(f"Missing column to field mapping for {col}-{_type}")
 
 	processors = processors if processors is not None else []
-	all_processors = default_processors + processors
+	all_processors = ([default_processor] if default_processor else []) + processors
 
 	if not all_processors:
 		return scrapy.Field()
 
-	return scrapy.Field(
-		input_processor=scrapy.loader.processors.MapCompose(
-			*all_processors))
+	if processors:
+		# may return lists or take the loader context, which only MapCompose handles
+		return scrapy.Field(
+			input_processor=scrapy.loader.processors.MapCompose(
+				*all_processors))
+
+	return scrapy.Field(input_processor=parser.MapValues(default_processor))
 
 
 def _get_relationship_properties(model_klass):
 	for relationship_property in model_klass.__mapper__.relationships:
-		yield str(relationship_property).split('.')[-1]
+		yield relationship_property.key
 
 
-def realize_item_class(klassname, model_klass):
-	"""creates a Scrapy.Item class from a sqlalchemy definition"""
+def realize_item_class(klassname, model_klass, dedup_attribute=None, module=None):
+	"""creates a Scrapy.Item class from a sqlalchemy definition.
+	dedup_attribute sets the field that ItemDeduplicationPipeline dedups on.
+	The class belongs to module, by default the caller's, so that its items
+	can be pickled, as long as it's assigned to a variable named klassname."""
 	fields = {column.name: sqlalchemy_column_to_field(column) for column in model_klass.__table__.columns}
 	fields[ITEM_MODEL_ATTRIBUTE] = model_klass
+	if dedup_attribute is not None:
+		if dedup_attribute not in fields:
+			raise ValueError(f"dedup attribute {dedup_attribute} is not a column of {model_klass.__name__}")
+		fields['_dedup_attribute'] = dedup_attribute
 
 	# any joined realtinship can be a field on an item.
 	# However, they include no mappers, they are added "raw"
@@ -297,12 +747,36 @@ def realize_item_class(klassname, model_klass):
 	for field_name in extra_fields:
 		fields[field_name] = scrapy.Field()
 
-	return type(klassname,
+	item_klass = type(klassname,
 			(item.BaseItem, ),
 			fields)
+	item_klass.__module__ = module or sys._getframe(1).f_globals.get('__name__', __name__)
+	get_write_plan(item_klass, model_klass)
+
+	return item_klass
 
 
-def insert(db, realized_model, the_item, logger=logger, **kwargs):
+def try_commit(db, logger=logger, description=None, timer=timing.NULL_TIMER, name=None, reraise=()):
+	"""commits the session, rolling back on failure.
+	Swallows and logs exceptions, returns true iff commit succeeded.
+	Exceptions in reraise are raised after the rollback instead, for callers that retry.
+	Flush and commit are timed as stages of name by timer."""
+	try:
+		with timer.time(name, 'flush'):
+			db.flush()
+		with timer.time(name, 'commit'):
+			db.commit()
+	except sqlalchemy.exc.SQLAlchemyError as e:
+		db.rollback()
+		if isinstance(e, reraise):
+			raise
+		if logger:
+			logger.exception(f"couldn't insert {description}")
+		return False
+	return True
+
+
+def insert(db, realized_model, the_item, logger=logger, timer=timing.NULL_TIMER, **kwargs):
 	"""inserts a model object into the db.
 	Assumes it's already been added/merged
 	to session.
@@ -321,49 +795,395 @@ def insert(db, realized_model, the_item, logger=logger, **kwargs):
 	# assign to processed to returned item
 	# out['related'][related_attr] = obj.as_dict()
 
-	try:
-		db.commit()
-	except sqlalchemy.exc.SQLAlchemyError:
-		db.logger()
-		if logger:
-			logger.exception(f"couldn't insert {the_item}")
+	try_commit(db, logger=logger, description=the_item, timer=timer, name=the_item.__class__.__name__)
 
 	return realized_model
 
 
-def _get_or_create(db, model_klass, the_item, **kwargs):
-	"""looks up object, creates new if not found"""
-	existing = model_klass.get_from_item(db, the_item)
+def _get_or_create(db, model_klass, the_item, resolved=None, timer=timing.NULL_TIMER, **kwargs):
+	"""looks up object, creates new if not found.
+
+	resolved is an optional dict of model class -> lookup key -> model,
+	(see resolve_items) which is used instead of querying when it
+	contains the item's key. New objects are added to it, so items
+	sharing a key within a batch map to the same object.
+	The lookup, merge and dependents stages are timed by timer."""
+	found = resolved.setdefault(model_klass, {}) if resolved is not None else None
+	key = model_klass.get_lookup_key(the_item)
+	name = the_item.__class__.__name__
+
+	with timer.time(name, 'lookup'):
+		existing = lookup_cache.get(db, model_klass, key)
+		if existing is None:
+			if found is not None and key in found:
+				existing = found[key]
+			else:
+				existing = model_klass.get_from_item(db, the_item)
+
+	with timer.time(name, 'merge'):
+		if existing:
+			update_model_from_item(existing, the_item)
+		else:
+			# constructs a new empty instance and adds it
+			existing = update_model_from_item(model_klass(), the_item)
+			# adds to session so it's inserted
+			db.add(existing)
+			if found is not None and None not in key:
+				found[key] = existing
+
+		lookup_cache.put(model_klass, key, existing)
+
+	with timer.time(name, 'dependents'):
+		for dependent_name, dependent_item in the_item.get_dependents():
+			if not hasattr(existing, dependent_name):
+				raise ValueError(f"'{dependent_name}' is not an attribute on {existing.__class__}")
+			dependent_model_class = get_model_class_from_item(dependent_item)
+			if not dependent_model_class:
+				raise ValueError(f"dependent model {dependent_name} can not be realized to model")
+
+			dependent_model = _get_or_create(db,
+					dependent_model_class,
+					dependent_item,
+					resolved=resolved,
+					timer=timer,
+					**kwargs)
+
+			setattr(existing, dependent_name, dependent_model)
 
-	if existing:
-		update_model_from_item(existing, the_item)
-	else:
-		# constructs a new empty instance and adds it
-		existing = update_model_from_item(model_klass(), the_item)
-		# adds to session so it's inserted
-		db.add(existing)
+	return existing
 
+
+def upsert(db, model_klass, the_item, commit=True, **kwargs):
+	"""looks up object from the_item, does insert
+	iff new object created. With commit=False the object
+	is only added to the session, and the caller commits."""
+	existing = _get_or_create(db, model_klass, the_item, **kwargs)
+	if not commit:
+		return existing
+	out = insert(db, existing, the_item, **kwargs)
+
+	return out
+
+
+def _iter_with_dependents(items):
+	"""yields items and, recursively, all their dependents"""
+	for the_item in items:
+		yield the_item
+		yield from _iter_with_dependents(
+			[dependent for _, dependent in the_item.get_dependents()])
+
+
+def resolve_items(db, items, timer=timing.NULL_TIMER, **kwargs):
+	"""bulk looks up items and all their dependents, one
+	get_many_from_items call per model class, timed as lookups. Returns a dict of
+	model class -> lookup key -> model (or None), for _get_or_create.
+	Items already in the lookup cache are skipped."""
+	by_class = {}
+	for the_item in _iter_with_dependents(items):
+		model_klass = get_model_class_from_item(the_item)
+		if model_klass is not None and model_klass._lookup_attributes and \
+				not lookup_cache.contains(db, model_klass, model_klass.get_lookup_key(the_item)):
+			by_class.setdefault(model_klass, []).append(the_item)
+
+	resolved = {}
+	for model_klass, class_items in by_class.items():
+		with timer.time(class_items[0].__class__.__name__, 'lookup'):
+			resolved[model_klass] = model_klass.get_many_from_items(db, class_items, **kwargs)
+	return resolved
+
+
+def _item_levels(items):
+	"""groups items and, recursively, their dependents by height in the
+	dependency graph: level 0 holds the leaves, level 1 items that only
+	depend on leaves, and so on. Returns a list of levels, each a list of items."""
+	heights = collections.OrderedDict()
+
+	def _height(the_item):
+		key = id(the_item)
+		if key not in heights:
+			dependents = [dependent for _, dependent in the_item.get_dependents()]
+			heights[key] = (1 + max((_height(dependent) for dependent in dependents), default=-1), the_item)
+		return heights[key][0]
+
+	for the_item in items:
+		_height(the_item)
+
+	levels = [[] for _ in range(1 + max((height for height, _ in heights.values()), default=-1))]
+	for height, the_item in heights.values():
+		levels[height].append(the_item)
+	return levels
+
+
+def _foreign_key_values(model_klass, the_item, models):
+	"""foreign key column values for the_item's many-to-one dependents,
+	taken from their already written models"""
+	relationships = model_klass.__mapper__.relationships
+	values = {}
 	for dependent_name, dependent_item in the_item.get_dependents():
-		if not hasattr(existing, dependent_name):
-			raise ValueError(f"'{dependent_name}' is not an attribute on {existing.__class__}")
-		dependent_model_class = get_model_class_from_item(dependent_item)
-		if not dependent_model_class:
-			raise ValueError(f"dependent model {dependent_name} can not be realized to model")
+		relationship = relationships.get(dependent_name)
+		dependent_model = models.get(id(dependent_item))
+		if relationship is None or relationship.direction is not MANYTOONE or dependent_model is None:
+			continue
+		dependent_mapper = sqlalchemy.inspect(dependent_model).mapper
+		for local, remote in relationship.local_remote_pairs:
+			values[local.name] = getattr(dependent_model, dependent_mapper.get_property_by_column(remote).key)
+	return values
+
+
+def _wire_dependents(obj, the_item, models):
+	"""sets the models of the_item's dependents on obj"""
+	for dependent_name, dependent_item in the_item.get_dependents():
+		if not hasattr(obj, dependent_name):
+			raise ValueError(f"'{dependent_name}' is not an attribute on {obj.__class__}")
+		setattr(obj, dependent_name, models[id(dependent_item)])
+
+
+def _bulk_insert(db, model_klass, class_items, models):
+	"""inserts new items of one class with one executemany per set of columns.
+	Items sharing a lookup key become one row, later items winning."""
+	rows = collections.OrderedDict()
+	for the_item in class_items:
+		row = rows.setdefault(model_klass.get_lookup_key(the_item), {})
+		row.update(get_write_plan(the_item.__class__, model_klass).values(the_item))
+		row.update(_foreign_key_values(model_klass, the_item, models))
+
+	by_keys = collections.OrderedDict()
+	for row in rows.values():
+		by_keys.setdefault(tuple(sorted(row.keys())), []).append(row)
+	for same_key_rows in by_keys.values():
+		execute(db, model_klass.__table__.insert(), same_key_rows)
+
+
+def _upsert_level(db, level_items, models, resolved, timer=timing.NULL_TIMER):
+	"""upserts one level of the dependency graph, whose dependents are
+	already in models. Per model class, new rows are bulk inserted and
+	read back with one lookup, so their primary keys can be wired into
+	the next level. Models without lookup attributes can't be read back,
+	and are added to the session one by one.
+	Inserts are timed as flush, setting values and dependents as merge."""
+	by_class = collections.OrderedDict()
+	for the_item in level_items:
+		by_class.setdefault(get_model_class_from_item(the_item), []).append(the_item)
+
+	for model_klass, class_items in by_class.items():
+		found = resolved.setdefault(model_klass, {})
+		name = class_items[0].__class__.__name__
+
+		def _existing(the_item):
+			key = model_klass.get_lookup_key(the_item)
+			return lookup_cache.get(db, model_klass, key) or found.get(key)
+
+		if model_klass._lookup_attributes:
+			new = [the_item for the_item in class_items
+				if None not in model_klass.get_lookup_key(the_item) and _existing(the_item) is None]
+			if new:
+				with timer.time(name, 'flush'):
+					if db.new:
+						# dependents without lookup attributes need their primary keys
+						db.flush()
+					_bulk_insert(db, model_klass, new, models)
+					inserted = model_klass.get_many_from_items(db, new)
+				found.update(inserted)
+				db.info.setdefault(INSERTED_INFO_KEY, weakref.WeakSet()).update(
+					obj for obj in inserted.values() if obj is not None)
+
+		with timer.time(name, 'merge'):
+			for the_item in class_items:
+				key = model_klass.get_lookup_key(the_item)
+				obj = _existing(the_item) if model_klass._lookup_attributes else None
+				if obj is None:
+					obj = model_klass()
+					db.add(obj)
+					if model_klass._lookup_attributes and None not in key:
+						found[key] = obj
+				update_model_from_item(obj, the_item)
+				_wire_dependents(obj, the_item, models)
+				lookup_cache.put(model_klass, key, obj)
+				models[id(the_item)] = obj
+
+
+def upsert_graph(db, items, resolved=None, timer=timing.NULL_TIMER, **kwargs):
+	"""upserts items and all their dependents level by level, leaves first
+	(see _item_levels), so the number of queries grows with the depth of
+	the graph, not the number of items. resolved is the optional result of
+	resolve_items. Returns a dict of id(item) -> model, for all items and dependents."""
+	if resolved is None:
+		resolved = resolve_items(db, items, timer=timer)
+	models = {}
+	for level_items in _item_levels(items):
+		_upsert_level(db, level_items, models, resolved, timer=timer)
+	return models
+
+
+def _supports_native_upsert(db, model_klass, the_item):
+	"""true iff the_item can be written with native_upsert: the model opted in,
+	we're on mysql, and all dependents are many-to-one, so they map to
+	foreign key columns on the row"""
+	if not model_klass._native_upsert or db.get_bind().dialect.name != 'mysql':
+		return False
+	relationships = model_klass.__mapper__.relationships
+	return all(name in relationships and relationships[name].direction is MANYTOONE
+		for name, _ in the_item.get_dependents())
+
+
+# the alias of the inserted rows in native upserts, where the server supports one
+NATIVE_UPSERT_ROW_ALIAS = 'new'
+
+
+def supports_row_alias(db):
+	"""true iff db's server can alias inserted rows (INSERT ... AS new), mysql 8.0.19 and up,
+	which replaces VALUES() in ON DUPLICATE KEY UPDATE, deprecated since 8.0.20"""
+	dialect = db.get_bind().dialect
+	return dialect.name == 'mysql' and not getattr(dialect, '_is_mariadb', False) and \
+		tuple(dialect.server_version_info or ()) >= (8, 0, 19)
+
+
+class AliasedInsert(MySQLInsert):
+	"""mysql INSERT that aliases its rows as row_alias, if given,
+	so ON DUPLICATE KEY UPDATE can refer to them"""
+
+	def __init__(self, table, row_alias=None, **kwargs):
+		super().__init__(table, **kwargs)
+		self.row_alias = row_alias
+
+
+@compiles(AliasedInsert, 'mysql')
+def _compile_aliased_insert(insert, compiler, **kwargs):
+	"""renders the row alias between the rows and ON DUPLICATE KEY UPDATE"""
+	sql = compiler.visit_insert(insert, **kwargs)
+	if not insert.row_alias:
+		return sql
+	on_duplicate = " ON DUPLICATE KEY UPDATE "
+	return sql.replace(on_duplicate, f" AS {compiler.preparer.quote(insert.row_alias)}{on_duplicate}", 1)
+
+
+class InsertedValue(ColumnElement):
+	"""the value of column in the inserted row, in ON DUPLICATE KEY UPDATE:
+	row_alias.column if the insert aliases its rows, VALUES(column) otherwise.
+	stmt.inserted can't be used inside expressions, sqlalchemy renders
+	those as VALUES() of the column being assigned"""
+
+	def __init__(self, column, row_alias=None):
+		self.column = column
+		self.row_alias = row_alias
+		self.type = column.type
+
+
+@compiles(InsertedValue, 'mysql')
+def _compile_inserted_value(value, compiler, **kwargs):
+	"""quotes the names, as sqlalchemy does for the table's"""
+	name = compiler.preparer.quote(value.column.name)
+	if value.row_alias:
+		return f"{compiler.preparer.quote(value.row_alias)}.{name}"
+	return f"VALUES({name})"
+
+
+def native_upsert_statement(model_klass, rows, row_alias=None):
+	"""builds one INSERT ... ON DUPLICATE KEY UPDATE for rows, which must all
+	have the same keys. Only those columns are updated on duplicates, and
+	updated_at is only bumped if one of them changed, like the ORM's onupdate.
+	Inserted values are referred to with row_alias if given (see supports_row_alias),
+	VALUES() otherwise.
+
+	InnoDB reserves an auto increment id for every row of the statement before
+	it knows whether the row is a duplicate, so rows that update instead of
+	inserting leave gaps in the ids. native_upsert leaves unchanged rows out,
+	but ids still grow with the number of changed rows, not just new ones."""
+	table = model_klass.__table__
+	stmt = AliasedInsert(table, row_alias=row_alias).values(rows)
+	columns = [key for key in rows[0].keys() if key not in ('created_at', 'updated_at')]
+
+	def inserted(key):
+		return InsertedValue(table.c[key], row_alias=row_alias)
+
+	unchanged = sqlalchemy.and_(*[
+		table.c[key].op('<=>')(inserted(key)) for key in columns])
+	# mysql assigns left to right, so updated_at must compare against the old values
+	updates = [('updated_at', sqlalchemy.func.IF(unchanged, table.c.updated_at, inserted('updated_at')))]
+	updates += [(key, inserted(key)) for key in columns]
+
+	return stmt.on_duplicate_key_update(updates)
+
+
+def _has_values(obj, row):
+	"""true iff obj already has all the column values of row"""
+	return all(getattr(obj, key) == value for key, value in row.items())
+
+
+def native_upsert(db, model_klass, items, models=None, timer=timing.NULL_TIMER, **kwargs):
+	"""upserts items of one model class in bulk with INSERT ... ON DUPLICATE KEY UPDATE.
+	Dependents are written first with upsert_graph, unless models (its result)
+	already has them, and their primary keys go in the foreign key columns.
+	The rows are looked up first, with one get_many_from_items, and items their
+	row already matches are left out of the statement, so they're neither written
+	nor counted as changes, see is_unchanged and has_changes.
+	Returns the items, or the row's model for unchanged ones, in order."""
+	dependents = [dependent for the_item in items for _, dependent in the_item.get_dependents()]
+	if models is None or any(id(dependent) not in models for dependent in dependents):
+		models = upsert_graph(db, dependents, timer=timer)
+	if dependents:
+		db.flush()
+	now = truncated_nowfn()
+	name = items[0].__class__.__name__
+
+	with timer.time(name, 'lookup'):
+		existing = model_klass.get_many_from_items(db, items)
+
+	rows = []
+	out = []
+	changed = []
+	for the_item in items:
+		row = get_write_plan(the_item.__class__, model_klass).values(the_item)
+		row.update(_foreign_key_values(model_klass, the_item, models))
+		obj = existing.get(model_klass.get_lookup_key(the_item))
+		if obj is not None and _has_values(obj, row):
+			out.append(obj)
+			continue
+		row['created_at'] = now
+		row['updated_at'] = now
+		rows.append(row)
+		out.append(the_item)
+		changed.append(the_item)
+
+	by_keys = collections.OrderedDict()
+	for row in rows:
+		by_keys.setdefault(tuple(sorted(row.keys())), []).append(row)
+	row_alias = NATIVE_UPSERT_ROW_ALIAS if rows and supports_row_alias(db) else None
+	with timer.time(name, 'flush'):
+		for same_key_rows in by_keys.values():
+			execute(db, native_upsert_statement(model_klass, same_key_rows, row_alias=row_alias))
+
+	# session copies of upserted rows are now stale
+	for the_item in changed:
+		obj = existing.get(model_klass.get_lookup_key(the_item))
+		if obj is not None:
+			db.expire(obj)
 
-		dependent_model = _get_or_create(db,
-				dependent_model_class,
-				dependent_item,
-				**kwargs)
+	return out
 
-		setattr(existing, dependent_name, dependent_model)
 
-	return existing
+def upsert_many(db, items, commit=True, logger=logger, timer=timing.NULL_TIMER, **kwargs):
+	"""upserts many items, of any model classes, with upsert_graph, so existing
+	objects are looked up and new ones inserted in bulk, level by level.
+	Models that opted in with _native_upsert are written with native_upsert
+	on mysql, and returned as items, unless they're unchanged.
+	Returns the list of models, in item order."""
+	native, orm = lib.split_list(items,
+		lambda the_item: _supports_native_upsert(db, get_model_class_from_item(the_item), the_item))
 
+	models = upsert_graph(db, orm + [dependent for the_item in native for _, dependent in the_item.get_dependents()],
+		timer=timer)
 
-def upsert(db, model_klass, the_item, **kwargs):
-	"""looks up object from the_item, does insert
-	iff new object created."""
-	existing = _get_or_create(db, model_klass, the_item, **kwargs)
-	out = insert(db, existing, the_item, **kwargs)
+	by_class = collections.OrderedDict()
+	for the_item in native:
+		by_class.setdefault(get_model_class_from_item(the_item), []).append(the_item)
+	for model_klass, class_items in by_class.items():
+		written = native_upsert(db, model_klass, class_items, models=models, timer=timer, **kwargs)
+		models.update((id(the_item), out) for the_item, out in zip(class_items, written))
+
+	out = [models.get(id(the_item), the_item) for the_item in items]
+
+	if commit:
+		try_commit(db, logger=logger, description=f"{len(items)} items", timer=timer, name=BATCH_TIMING_NAME)
 
 	return out
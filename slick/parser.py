@@ -1,7 +1,12 @@
 import datetime
 import re
 
-from w3lib import html
+from itemloaders.utils import arg_to_iter
+
+# what w3lib's remove_tags removes, when no tags are kept
+_TAGS = re.compile('</?([^ >/]+).*?>', re.DOTALL | re.IGNORECASE)
+_NUMBER = re.compile(r'[.\d]+')
+_NUMBER_JUNK = str.maketrans('', '', '"\'\n,')
 
 # Value Parsers
 
@@ -14,10 +19,7 @@ def read_bool(value):
 
 
 def _strip_number(value):
-	repls = ('"', "'", "\n", ',')
-	for rep in repls:
-		value = value.replace(rep, '')
-	return strip_whitespace(value)
+	return value.translate(_NUMBER_JUNK).strip()
 
 
 def read_int(value):
@@ -28,7 +30,9 @@ def read_int(value):
 		return 0
 
 	stripped = _strip_number(value)
-	reg = re.search(r'[.\d]+', stripped)
+	if stripped.isdecimal():
+		return int(stripped)
+	reg = _NUMBER.search(stripped)
 	result = reg[0] if reg else stripped
 
 	if (result.find('.') != -1):
@@ -69,8 +73,8 @@ def strip_query_string(value):
 
 def strip_tags(value):
 	"""removes tags"""
-	if isinstance(value, str):
-		return html.remove_tags(value)
+	if isinstance(value, str) and '<' in value:
+		return _TAGS.sub('', value)
 	return value
 
 
@@ -79,6 +83,47 @@ def strip_unicode(value):
 		return value.encode('ascii', 'ignore').decode()
 	return value
 
+# Fused Processors, each does what a chain of the ones above does in one call
+
+
+def clean_text(value):
+	"""strip_tags, then strip_whitespace"""
+	if isinstance(value, str):
+		if '<' in value:
+			value = _TAGS.sub('', value)
+		return value.strip()
+	return strip_whitespace(value)
+
+
+def clean_int(value):
+	"""strip_tags, strip_whitespace, then read_int"""
+	return read_int(clean_text(value))
+
+
+def clean_float(value):
+	"""strip_tags, strip_whitespace, then read_float"""
+	return read_float(clean_text(value))
+
+
+def is_present(value):
+	"""true for any value, for fields set by the presence of tags"""
+	return value is not None
+
+
+class MapValues(object):
+	"""input processor applying functions in turn to a whole list of values,
+	dropping Nones, as MapCompose does for functions that return single values"""
+
+	def __init__(self, *functions):
+		self.functions = functions
+
+	def __call__(self, values):
+		values = arg_to_iter(values)
+		for fn in self.functions:
+			values = [v for v in map(fn, values) if v is not None]
+		return values
+
+
 # Value Parser Factories
 
 def make_date_parser(format_strings):
@@ -1,74 +1,216 @@
 # -*- coding: utf-8 -*-
-import inspect
+import threading
+import time
+
+import sqlalchemy
 from scrapy.exceptions import DropItem
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import threadpool
 
-from slick import model
+from slick import dedup, model, timing
 
 ITEM_CLASS_ATTRIBUTE = "_item_classes"
+# min seconds between copying timing percentiles to stats, since sorting samples isn't free
+TIMING_RECORD_SECONDS = 1
 
 
 class ItemDeduplicators(object):
 	"""A generic way to handle deduplication
 
-	Supported items have a deduplication attribute,
-	which this class checks and against duplicates stored
-	internally as a set in memory"""
+	Supported items have a deduplication attribute, which this
+	class checks against the values seen before. Values are kept
+	per item class in a backend from slick.dedup: an exact set, or
+	a bloom filter that keeps memory small at a low false positive rate.
+	For bloom filters, the number of new values taken for seen ones is
+	estimated from the false positive rate at each new value."""
+
+	def __init__(self, backends=None, default_backend=dedup.DEFAULT_BACKEND, index=None, **backend_kwargs):
+		"""backends maps item class names to backend names, other classes
+		use default_backend. backend_kwargs, such as capacity and
+		error_rate, are passed to the backends. With a dedup.SqliteIndex
+		as index, values are remembered across runs."""
+		self.backends = backends or {}
+		self.default_backend = default_backend
+		self.index = index
+		self.backend_kwargs = backend_kwargs
+		self.dedupers = {}
+		self.false_positives = {}
 
-	def __init__(self, klasses=[]):
-		self.dedupers = {klass: set() for klass in klasses}
+	def _get_deduper(self, klass):
+		"""the backend for an item class, made on first use"""
+		deduper = self.dedupers.get(klass)
+		if deduper is None:
+			backend = self.backends.get(klass.__name__, self.default_backend)
+			deduper = dedup.make_backend(backend, **self.backend_kwargs)
+			if self.index is not None:
+				deduper = dedup.PersistentBackend(deduper, self.index, klass.__name__)
+			self.dedupers[klass] = deduper
+		return deduper
 
 	def is_duplicate(self, item):
-		"""checks if item is duplicate. Adds it to set if it is.
+		"""checks if item is duplicate. Remembers it if it isn't.
 		Returns true iff item is duplicate, false otherwise"""
-		if not self._supports_dedup(item):
+		if not getattr(item, '_dedup_attribute', None):
 			return False
 
-		for im, deduper in self.dedupers.items():
-			if im.match(item):
-				dedup_val = self._get_dedup_value(item)
-				if dedup_val is not None:
-					if dedup_val in deduper:
-						return True
-					deduper.add(dedup_val)
+		dedup_val = item._get_dedup_value()
+		if dedup_val is None:
+			return False
 
+		deduper = self._get_deduper(item.__class__)
+		rate = dedup.false_positive_rate(deduper)
+		if deduper.add(dedup_val):
+			return True
+		if rate:
+			# had it been taken for a seen value, it would have been dropped
+			self.false_positives[item.__class__] = self.false_positives.get(item.__class__, 0.0) + rate
 		return False
 
+	def stats(self):
+		"""number of values remembered per item class name"""
+		return {klass.__name__: len(deduper) for klass, deduper in self.dedupers.items()}
 
-def get_default_import_string(spider):
-	"""the default import string for a spider is [spider.name].items"""
-	return f"{spider.__name__}.items"
+	def false_positive_stats(self):
+		"""estimated number of new items dropped as duplicates, per item class name of lossy backends"""
+		return {klass.__name__: estimate for klass, estimate in self.false_positives.items()}
 
 
-# TODO add custom setting
-def yield_item_classes(import_string=None):
-	"""finds all item classes registered in the import_string scope"""
-	if import_string is None:
-		import_string = get_default_import_string()
-	for name, obj in inspect.getmembers(import_string):
-		if inspect.isclass(obj):
-			yield obj
+class ItemDeduplicationPipeline(object):
+	"""drops items whose _dedup_attribute value was already seen in
+	this crawl, so duplicates never reach the DBPipeline.
 
+	DEDUP_BACKEND picks the backend (set, the default, bloom or scalable),
+	and DEDUP_BACKENDS overrides it per item class name. Bloom filters are
+	sized by DEDUP_CAPACITY and DEDUP_ERROR_RATE, and the new items they
+	probably dropped are estimated in dedup/suspected_false_positives stats.
 
-class ItemDeduplicationPipeline(object):
-	"""uses dudplication logic to drop items"""
+	Setting DEDUP_INDEX_DIR remembers values across runs, in a sqlite
+	file per spider there, for DEDUP_INDEX_TTL seconds (0 is forever)."""
+
+	def __init__(self, stats=None, backends=None, default_backend=dedup.DEFAULT_BACKEND,
+			capacity=dedup.DEFAULT_CAPACITY, error_rate=dedup.DEFAULT_ERROR_RATE,
+			index_dir=None, index_ttl=0):
+		self.stats = stats
+		self.index_dir = index_dir
+		self.index_ttl = index_ttl
+		self.index = None
+		self.backends = backends
+		self.default_backend = default_backend
+		self.capacity = capacity
+		self.error_rate = error_rate
+
+	@classmethod
+	def from_crawler(cls, crawler):
+		"""reads backend config from settings"""
+		settings = crawler.settings
+		return cls(
+			stats=crawler.stats,
+			backends=settings.getdict('DEDUP_BACKENDS'),
+			default_backend=settings.get('DEDUP_BACKEND', dedup.DEFAULT_BACKEND),
+			capacity=settings.getint('DEDUP_CAPACITY', dedup.DEFAULT_CAPACITY),
+			error_rate=settings.getfloat('DEDUP_ERROR_RATE', dedup.DEFAULT_ERROR_RATE),
+			index_dir=settings.get('DEDUP_INDEX_DIR'),
+			index_ttl=settings.getint('DEDUP_INDEX_TTL'))
 
 	def open_spider(self, spider):
-		"""registers deduplicator instance on spider"""
-		super(ItemDeduplicationPipeline, self).open_spider(spider)
-		self.deduplicator = ItemDeduplicators([c for c in yield_item_classes()])
+		"""registers deduplicator instance on spider, loading the
+		values of earlier runs that haven't expired"""
+		if self.index_dir:
+			self.index = dedup.SqliteIndex.for_spider(self.index_dir, spider.name, ttl=self.index_ttl)
+			expired = self.index.expire()
+			if self.stats is not None:
+				self.stats.set_value('dedup/expired', expired)
+		self.deduplicator = ItemDeduplicators(
+			backends=self.backends,
+			default_backend=self.default_backend,
+			index=self.index,
+			capacity=self.capacity,
+			error_rate=self.error_rate)
+
+	def close_spider(self, spider):
+		"""records how many values were remembered per item class, and persists them"""
+		if self.stats is not None:
+			for name, size in self.deduplicator.stats().items():
+				self.stats.set_value(f'dedup/size/{name}', size)
+		for name, estimate in self.deduplicator.false_positive_stats().items():
+			if self.stats is not None:
+				self.stats.set_value(f'dedup/suspected_false_positives/{name}', round(estimate, 2))
+			if estimate >= 1:
+				spider.logger.warning(f"about {estimate:.0f} new {name}s were probably dropped "
+					f"as duplicates by a bloom filter, use the set backend for them")
+		if self.index is not None:
+			self.index.close()
 
 	def process_item(self, item, spider):
 		"""drops item on duplication"""
-		item = super(ItemDeduplicationPipeline, self).process_item(item, spider)
-
-		if self.deduplicator.check_duplicate(item):
-			raise DropItem("item is duplicate")
+		if self.deduplicator.is_duplicate(item):
+			if self.stats is not None:
+				self.stats.inc_value('dedup/dropped')
+			raise DropItem(f"{item.__class__.__name__} {item._get_dedup_value()} is duplicate")
 
 		return item
 
 
 class DBPipeline(object):
-	"""inserts crawl objects to db"""
+	"""inserts crawl objects to db.
+
+	By default every item is upserted and committed on its own.
+	Setting DBPIPELINE_BATCH_SIZE and/or DBPIPELINE_BATCH_SECONDS
+	enables batching, where items are buffered and upserted in the
+	same session, then committed once per batch.
+
+	Setting DBPIPELINE_THREADS moves writes off the reactor, to a pool
+	of worker threads with a session each. process_item then returns a
+	Deferred, and at most DBPIPELINE_QUEUE_DEPTH writes are queued; the
+	rest wait, which makes scrapy stop feeding us new responses.
+
+	Items that match what's stored don't UPDATE their rows, and are counted
+	as dbpipeline/skipped_writes. With DBPIPELINE_SKIP_UNCHANGED (the default)
+	writes and batches where nothing changed aren't committed either.
+
+	DBPIPELINE_TIMING times the lookup, dependents, merge, flush and commit
+	stages of writes per item class, and records their percentiles as
+	slick/timing/<item class>/<stage>/p50 (and p95, p99) stats."""
+
+	def __init__(self, stats=None, batch_size=0, batch_seconds=0, lookup_cache_size=None,
+			threads=0, queue_depth=0, skip_unchanged=True, timed=False):
+		"""batch_size and batch_seconds of 0 disable batching.
+		lookup_cache_size resizes the model lookup cache, if set.
+		threads of 0 writes synchronously on the reactor thread."""
+		self.stats = stats
+		self.skip_unchanged = skip_unchanged
+		self.timer = timing.StageTimer() if timed else timing.NULL_TIMER
+		self.timing_recorded = 0
+		if lookup_cache_size is not None:
+			model.lookup_cache.resize(lookup_cache_size)
+		self.batch_size = batch_size
+		self.batch_seconds = batch_seconds
+		self.batch = []
+		self.batch_started = None
+		self.flush_task = None
+		self.threads = threads
+		self.queue_depth = queue_depth or threads
+		self.pool = None
+		self.pending = set()
+
+	@classmethod
+	def from_crawler(cls, crawler):
+		"""reads batching, threading and pool config from settings"""
+		settings = crawler.settings
+		model.configure_pool(settings)
+		return cls(
+			stats=crawler.stats,
+			batch_size=settings.getint('DBPIPELINE_BATCH_SIZE'),
+			batch_seconds=settings.getfloat('DBPIPELINE_BATCH_SECONDS'),
+			lookup_cache_size=settings.getint('DBPIPELINE_LOOKUP_CACHE_SIZE', model.LOOKUP_CACHE_SIZE),
+			threads=settings.getint('DBPIPELINE_THREADS'),
+			queue_depth=settings.getint('DBPIPELINE_QUEUE_DEPTH'),
+			skip_unchanged=settings.getbool('DBPIPELINE_SKIP_UNCHANGED', True),
+			timed=settings.getbool('DBPIPELINE_TIMING'))
+
+	def is_batching(self):
+		"""true iff items are buffered instead of committed one by one"""
+		return bool(self.batch_size or self.batch_seconds)
 
 	def open_spider(self, spider, db=None):
 		"""opens db connection"""
@@ -76,7 +218,8 @@ class DBPipeline(object):
 			super(DBPipeline, self).open_spider(spider)
 		except AttributeError:
 			pass
-		self.db = model.SqlSession() if db is None else db
+		# objects aren't expired on commit, so cached lookups stay loaded
+		self.db = model.SqlSession(expire_on_commit=False) if db is None else db
 		found_item_classes = False
 		try:
 			found_item_classes = getattr(spider, ITEM_CLASS_ATTRIBUTE)
@@ -88,12 +231,76 @@ class DBPipeline(object):
 
 		self.item_classes = [c for c in found_item_classes]
 
+		if self.threads:
+			self._open_pool(db)
+
+		if self.batch_seconds:
+			# flushes quiet crawls, where the batch doesn't fill up
+			self.flush_task = task.LoopingCall(self._flush_if_expired, spider)
+			self.flush_task.start(self.batch_seconds, now=False)
+
+	def _open_pool(self, db=None):
+		"""starts worker threads. Each gets its own session, from an engine
+		with a connection pool big enough for all of them"""
+		if db is not None:
+			engine = db.get_bind()
+		else:
+			engine = model.get_engine(
+				poolclass=model.InstrumentedQueuePool,
+				pool_size=self.threads,
+				max_overflow=0)
+		self.session_maker = sqlalchemy.orm.sessionmaker(bind=engine, expire_on_commit=False)
+		self.sessions = []
+		self.local = threading.local()
+		self.semaphore = defer.DeferredSemaphore(self.queue_depth)
+		self.pool = threadpool.ThreadPool(minthreads=1, maxthreads=self.threads, name='DBPipeline')
+		self.pool.start()
+
+	def _thread_db(self):
+		"""the session of the calling worker thread"""
+		db = getattr(self.local, 'db', None)
+		if db is None:
+			db = self.local.db = self.session_maker()
+			self.sessions.append(db)
+		return db
+
+	def _defer_write(self, fn, *args):
+		"""runs fn in the worker pool, once there's room in the queue"""
+		d = self.semaphore.run(threads.deferToThreadPool, reactor, self.pool, fn, *args)
+		self.pending.add(d)
+
+		def _done(result):
+			self.pending.discard(d)
+			return result
+
+		return d.addBoth(_done)
+
 	def close_spider(self, spider):
-		"""close db on spider close"""
+		"""flushes pending items and closes db on spider close.
+		When threaded, returns a Deferred that fires after all writes are done."""
 		try:
 			super(DBPipeline, self).close_spider(spider)
 		except AttributeError:
 			pass
+		if self.flush_task and self.flush_task.running:
+			self.flush_task.stop()
+		self.flush(spider)
+
+		if not self.pool:
+			self._close()
+			return None
+
+		d = defer.DeferredList(list(self.pending))
+		d.addBoth(lambda _: self._close())
+		return d
+
+	def _close(self):
+		"""stops workers and closes all sessions"""
+		if self.pool:
+			self.pool.stop()
+			for db in self.sessions:
+				db.close()
+		self._record_db_stats(force=True)
 		self.db.close()
 
 	def process_item(self, item, spider):
@@ -110,9 +317,158 @@ class DBPipeline(object):
 				if model_klass is None:
 					raise DropItem(f"{item} has not registered model.")
 
-				item = model.upsert(self.db, model_klass, item, logger=spider.logger)
+				if self.is_batching():
+					flushed = self._add_to_batch(model_klass, item, spider)
+					if flushed is not None:
+						# the item that fills the batch waits for it, for backpressure
+						return flushed.addCallback(lambda _: item)
+				elif self.pool:
+					d = self._defer_write(self._write_item_in_thread, model_klass, item, spider)
+					return d.addCallback(self._record_write)
+				else:
+					item = self._record_write(self._write_item(self.db, model_klass, item, spider))
 
 				# each item can only have one model class, so we break
 				break
 
 		return item
+
+	def _write_item(self, db, model_klass, item, spider, retry=True):
+		"""upserts and commits one item, unless it's unchanged and skip_unchanged is set.
+		Worker threads can race to insert the same new row, e.g. a dependent
+		of two items, and the loser's flush fails on the unique key. It's rolled
+		back and upserted once more, finding the row the winner inserted.
+		Returns the model and whether it was unchanged"""
+		try:
+			out = model.upsert(db, model_klass, item, commit=False, logger=spider.logger, timer=self.timer)
+			unchanged = model.is_unchanged(db, out)
+			if not (self.skip_unchanged and not model.has_changes(db)):
+				model.try_commit(db, logger=spider.logger, description=item, timer=self.timer,
+					name=item.__class__.__name__, reraise=(sqlalchemy.exc.IntegrityError, ) if retry else ())
+		except sqlalchemy.exc.IntegrityError:
+			db.rollback()
+			if not retry:
+				raise
+			spider.logger.info(f"retrying {item}, inserted concurrently")
+			return self._write_item(db, model_klass, item, spider, retry=False)
+		return out, unchanged
+
+	def _write_item_in_thread(self, model_klass, item, spider):
+		"""_write_item with the worker thread's session"""
+		return self._write_item(self._thread_db(), model_klass, item, spider)
+
+	def _record_write(self, result):
+		"""records a _write_item result in crawler stats, and returns its model"""
+		out, unchanged = result
+		self._record_db_stats()
+		if unchanged and self.stats is not None:
+			self.stats.inc_value('dbpipeline/skipped_writes')
+		return out
+
+	def _add_to_batch(self, model_klass, item, spider):
+		"""buffers item, flushing when the batch is full or too old.
+		Returns the flush Deferred if threaded and flushed."""
+		if not self.batch:
+			self.batch_started = time.time()
+		self.batch.append((model_klass, item))
+
+		if self.batch_size and len(self.batch) >= self.batch_size:
+			return self.flush(spider)
+		return self._flush_if_expired(spider)
+
+	def _flush_if_expired(self, spider):
+		"""flushes iff the oldest buffered item has waited batch_seconds"""
+		if self.batch and self.batch_seconds and \
+				time.time() - self.batch_started >= self.batch_seconds:
+			return self.flush(spider)
+		return None
+
+	def flush(self, spider):
+		"""writes all buffered items, see write_batch.
+		When threaded, the batch is written by a worker, and
+		a Deferred firing when it's done is returned."""
+		if not self.batch:
+			return None
+		batch, self.batch = self.batch, []
+
+		if self.pool:
+			d = self._defer_write(self._write_batch_in_thread, batch, spider)
+			return d.addCallback(lambda result: self._record_batch(*result))
+
+		self._record_batch(*self._write_batch(self.db, batch, spider))
+		return None
+
+	def _write_batch_in_thread(self, batch, spider):
+		"""_write_batch with the worker thread's session"""
+		return self._write_batch(self._thread_db(), batch, spider)
+
+	def _write_batch(self, db, batch, spider):
+		"""upserts all items in one session and commits once.
+		If the batch commit fails, the batch is replayed item by item,
+		so one bad item doesn't lose the rest.
+		Returns the batch size, commit latency (None if there was no commit),
+		whether the batch was written and the number of unchanged items."""
+		latency = None
+		committed = False
+		unchanged = 0
+		try:
+			out = model.upsert_many(db, [item for _, item in batch], commit=False, timer=self.timer)
+		except Exception:
+			spider.logger.exception(f"couldn't add batch of {len(batch)} to session")
+			db.rollback()
+		else:
+			unchanged = sum(1 for obj in out if model.is_unchanged(db, obj))
+			if self.skip_unchanged and not model.has_changes(db):
+				committed = True
+			else:
+				started = time.time()
+				committed = model.try_commit(db, logger=spider.logger, description=f"batch of {len(batch)}",
+					timer=self.timer, name=model.BATCH_TIMING_NAME)
+				latency = time.time() - started
+
+		if not committed:
+			for model_klass, item in batch:
+				try:
+					model.upsert(db, model_klass, item, logger=spider.logger, timer=self.timer)
+				except Exception:
+					spider.logger.exception(f"couldn't upsert {item}")
+					db.rollback()
+
+		return len(batch), latency, committed, unchanged
+
+	def _record_batch(self, size, latency, committed, unchanged=0):
+		"""records batch size, commit latency and unchanged items in crawler stats"""
+		self._record_db_stats()
+		if self.stats is None:
+			return
+		if not committed:
+			self.stats.inc_value('dbpipeline/batch_errors')
+		if unchanged:
+			self.stats.inc_value('dbpipeline/skipped_writes', unchanged)
+		if committed and latency is None:
+			self.stats.inc_value('dbpipeline/skipped_commits')
+		if latency is None:
+			return
+		self.stats.inc_value('dbpipeline/batches')
+		self.stats.inc_value('dbpipeline/batched_items', size)
+		self.stats.set_value('dbpipeline/batch_size', size)
+		self.stats.max_value('dbpipeline/batch_size_max', size)
+		self.stats.set_value('dbpipeline/commit_latency', latency)
+		self.stats.max_value('dbpipeline/commit_latency_max', latency)
+		self.stats.inc_value('dbpipeline/commit_latency_total', latency)
+
+	def _record_db_stats(self, force=False):
+		"""copies lookup cache and connection pool counters to crawler stats,
+		and timing percentiles at most every TIMING_RECORD_SECONDS unless forced"""
+		if self.stats is None:
+			return
+		for key, value in model.lookup_cache.stats().items():
+			self.stats.set_value(f'dbpipeline/lookup_cache/{key}', value)
+		for key, value in model.get_pool_stats().items():
+			self.stats.set_value(f'dbpipeline/pool/{key}', value)
+
+		now = time.time()
+		if self.timer.enabled and (force or now - self.timing_recorded >= TIMING_RECORD_SECONDS):
+			self.timing_recorded = now
+			for key, value in self.timer.stats().items():
+				self.stats.set_value(key, value)
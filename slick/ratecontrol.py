@@ -0,0 +1,309 @@
+"""per domain rate control, so every domain is crawled as fast as it lets us.
+
+AdaptiveRateMiddleware keeps a DomainRate per download slot, a domain by
+default, and sets the slot's delay and concurrency from what it sees:
+successes speed a domain up, blocks (429, 403 and 5xx), errors and rising
+latency slow it down. When a domain keeps blocking us its circuit opens,
+and the domain is paused for a cooldown: its requests are taken out of the
+downloader and parked by the middleware until then, so they don't take up
+CONCURRENT_REQUESTS other domains could use. After the cooldown they're
+scheduled again, a single probe request is let through, and the others are
+parked until it's answered. The circuit closes again if the probe isn't
+blocked, or opens for twice as long if it is. Responses RecrawlMiddleware
+drops as unchanged, before they get here, count as answers too."""
+import collections
+import time
+
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider, IgnoreRequest, NotConfigured
+from scrapy.utils.httpobj import urlparse_cached
+
+from slick import recrawl
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+BLOCKED_STATUSES = {403, 429}
+# outcomes the error rate is computed over
+WINDOW_SIZE = 50
+# the circuit opens once this share of the window was blocked
+TRIP_RATE = 0.5
+# or once this many requests in a row were
+TRIP_STREAK = 5
+# the window must have this many outcomes for the rate to count
+MIN_SAMPLES = 10
+# latencies this many times the fastest seen count as congestion
+LATENCY_FACTOR = 3
+LATENCY_SMOOTHING = 0.2
+# successes in a row before concurrency goes up by one
+SPEEDUP_STREAK = 20
+SPEEDUP = 0.9
+BACKOFF = 2
+
+
+def is_blocked(status):
+	return status in BLOCKED_STATUSES or status >= 500
+
+
+class DomainRate(object):
+	"""delay, concurrency and circuit state of a domain"""
+
+	def __init__(self, delay=0.0, concurrency=1, min_delay=0.0, max_delay=60.0,
+			max_concurrency=8, cooldown=60.0, max_cooldown=1800.0, probe_timeout=180.0, clock=time.monotonic):
+		self.delay = delay
+		self.concurrency = concurrency
+		self.min_delay = min_delay
+		self.max_delay = max_delay
+		self.max_concurrency = max_concurrency
+		self.base_cooldown = cooldown
+		self.cooldown = cooldown
+		self.max_cooldown = max_cooldown
+		self.probe_timeout = probe_timeout
+		self.clock = clock
+		self.state = CLOSED
+		self.open_until = 0.0
+		self.probe_until = 0.0
+		self.outcomes = collections.deque(maxlen=WINDOW_SIZE)
+		self.blocked_streak = 0
+		self.success_streak = 0
+		self.latency = None
+		self.fastest = None
+		self.trips = 0
+
+	def error_rate(self):
+		if len(self.outcomes) < MIN_SAMPLES:
+			return 0.0
+		return sum(self.outcomes) / len(self.outcomes)
+
+	def _slow_down(self):
+		self.delay = min(self.max_delay, max(self.delay, self.min_delay, 0.25) * BACKOFF)
+		self.concurrency = max(1, self.concurrency // 2)
+		self.success_streak = 0
+
+	def _speed_up(self):
+		self.delay = max(self.min_delay, self.delay * SPEEDUP)
+		self.success_streak += 1
+		if self.success_streak >= SPEEDUP_STREAK:
+			self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+			self.success_streak = 0
+
+	def _trip(self):
+		"""opens the circuit, pausing the domain for the cooldown"""
+		if self.state == HALF_OPEN:
+			self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+		self.state = OPEN
+		self.open_until = self.clock() + self.cooldown
+		self.trips += 1
+		self.outcomes.clear()
+		self.blocked_streak = 0
+
+	def allow_probe(self):
+		"""half opens the circuit once the cooldown is over, true iff it did and
+		the caller may send the probe. Another probe is allowed if one isn't
+		answered within probe_timeout, e.g. because it was dropped"""
+		now = self.clock()
+		if self.state == OPEN and now >= self.open_until or \
+				self.state == HALF_OPEN and now >= self.probe_until:
+			self.state = HALF_OPEN
+			self.concurrency = 1
+			self.probe_until = now + self.probe_timeout
+			return True
+		return False
+
+	def resume_at(self):
+		"""when requests held back while open or probing may try again, by clock"""
+		return self.open_until if self.state == OPEN else self.probe_until
+
+	def record(self, blocked, latency=None):
+		"""updates the rate with the outcome of a request"""
+		if self.state == OPEN:
+			# requests that were in flight when the circuit opened
+			return
+		if latency is not None:
+			self.fastest = latency if self.fastest is None else min(self.fastest, latency)
+			self.latency = latency if self.latency is None else \
+				LATENCY_SMOOTHING * latency + (1 - LATENCY_SMOOTHING) * self.latency
+
+		if self.state == HALF_OPEN:
+			if blocked:
+				self._trip()
+			else:
+				self.state = CLOSED
+				self.cooldown = self.base_cooldown
+				self._slow_down()
+			return
+
+		self.outcomes.append(blocked)
+		if blocked:
+			self.blocked_streak += 1
+			if self.blocked_streak >= TRIP_STREAK or self.error_rate() >= TRIP_RATE:
+				self._trip()
+			else:
+				self._slow_down()
+			return
+
+		self.blocked_streak = 0
+		if self.latency is not None and self.latency > LATENCY_FACTOR * self.fastest:
+			self._slow_down()
+		else:
+			self._speed_up()
+
+	def slot_delay(self):
+		"""the delay the download slot should have, the rest of the cooldown when open"""
+		if self.state == OPEN:
+			return max(self.delay, self.open_until - self.clock())
+		return self.delay
+
+
+class AdaptiveRateMiddleware(object):
+	"""downloader middleware applying a DomainRate to each download slot,
+	enabled by RATECONTROL_ENABLED. Should come after RetryMiddleware,
+	so it sees responses before they're retried.
+	RATECONTROL_START_DELAYS sets the delay domains start at, by host name.
+	Domains start at RATECONTROL_START_CONCURRENCY, CONCURRENT_REQUESTS_PER_DOMAIN
+	by default, so enabling rate control doesn't slow down healthy domains.
+
+	Requests to paused domains are parked: process_request ignores them, and
+	they're handed back to the engine once the domain may be tried again.
+	The spider isn't closed while requests are parked."""
+
+	def __init__(self, crawler, start_delay=0.0, start_delays=None, start_concurrency=1,
+			reactor=None, **rate_kwargs):
+		if reactor is None:
+			from twisted.internet import reactor
+		self.crawler = crawler
+		self.start_delay = start_delay
+		self.start_delays = start_delays or {}
+		self.start_concurrency = start_concurrency
+		self.reactor = reactor
+		self.rate_kwargs = rate_kwargs
+		self.rates = {}
+		# parked requests and the call releasing them, by key
+		self.parked = {}
+		self.releases = {}
+
+	@classmethod
+	def from_crawler(cls, crawler):
+		settings = crawler.settings
+		if not settings.getbool('RATECONTROL_ENABLED'):
+			raise NotConfigured
+		s = cls(crawler,
+			start_delay=settings.getfloat('RATECONTROL_START_DELAY', settings.getfloat('DOWNLOAD_DELAY')),
+			start_delays=settings.getdict('RATECONTROL_START_DELAYS'),
+			start_concurrency=settings.getint('RATECONTROL_START_CONCURRENCY',
+				settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN')),
+			min_delay=settings.getfloat('RATECONTROL_MIN_DELAY', 0.0),
+			max_delay=settings.getfloat('RATECONTROL_MAX_DELAY', 60.0),
+			max_concurrency=settings.getint('RATECONTROL_MAX_CONCURRENCY',
+				settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN')),
+			cooldown=settings.getfloat('RATECONTROL_COOLDOWN', 60.0),
+			max_cooldown=settings.getfloat('RATECONTROL_MAX_COOLDOWN', 1800.0),
+			probe_timeout=settings.getfloat('RATECONTROL_PROBE_TIMEOUT', settings.getfloat('DOWNLOAD_TIMEOUT')))
+		crawler.signals.connect(s.request_skipped, signal=recrawl.request_skipped)
+		crawler.signals.connect(s.spider_idle, signal=signals.spider_idle)
+		crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+		return s
+
+	def _key(self, request):
+		return request.meta.get('download_slot') or urlparse_cached(request).hostname or ''
+
+	def get_rate(self, key):
+		rate = self.rates.get(key)
+		if rate is None:
+			rate = self.rates[key] = DomainRate(
+				delay=float(self.start_delays.get(key, self.start_delay)),
+				concurrency=max(1, min(self.start_concurrency, self.rate_kwargs.get('max_concurrency', self.start_concurrency))),
+				**self.rate_kwargs)
+		return rate
+
+	def _apply(self, key, rate, spider):
+		"""sets the download slot of key to the rate, publishing changes"""
+		slot = self.crawler.engine.downloader.slots.get(key) if self.crawler.engine else None
+		if slot is not None:
+			slot.delay = rate.slot_delay()
+			slot.concurrency = rate.concurrency
+		stats = self.crawler.stats
+		stats.set_value(f'ratecontrol/{key}/delay', round(rate.delay, 3), spider=spider)
+		stats.set_value(f'ratecontrol/{key}/concurrency', rate.concurrency, spider=spider)
+		stats.set_value(f'ratecontrol/{key}/state', rate.state, spider=spider)
+
+	def _publish(self, key, rate, spider):
+		if hasattr(spider, 'metric'):
+			spider.metric('rate_control', {
+				"domain": key,
+				"state": rate.state,
+				"delay": rate.delay,
+				"concurrency": rate.concurrency,
+				"error_rate": rate.error_rate(),
+			})
+
+	def _record(self, request, spider, blocked):
+		key = self._key(request)
+		rate = self.get_rate(key)
+		state, trips = rate.state, rate.trips
+		rate.record(blocked, latency=request.meta.get('download_latency'))
+		if rate.trips != trips:
+			self.crawler.stats.inc_value(f'ratecontrol/{key}/trips', spider=spider)
+			spider.logger.warning(f"{key} is blocking us, pausing it for {rate.cooldown:.0f}s")
+		if rate.state != state:
+			self._publish(key, rate, spider)
+		self._apply(key, rate, spider)
+		if state == HALF_OPEN and rate.state != state:
+			# the probe was answered
+			self._release(key, spider)
+
+	def _park(self, key, rate, request, spider):
+		"""takes request out of the downloader until the paused key may be tried again"""
+		self.parked.setdefault(key, []).append(request.replace(dont_filter=True))
+		if key not in self.releases:
+			self.releases[key] = self.reactor.callLater(
+				max(0.0, rate.resume_at() - rate.clock()), self._release, key, spider)
+		self.crawler.stats.inc_value(f'ratecontrol/{key}/parked', spider=spider)
+		raise IgnoreRequest(f"{key} is paused, parked {request}")
+
+	def _release(self, key, spider):
+		"""schedules the requests parked for key again"""
+		release = self.releases.pop(key, None)
+		if release is not None and release.active():
+			release.cancel()
+		for request in self.parked.pop(key, []):
+			self.crawler.engine.crawl(request, spider)
+
+	def process_request(self, request, spider):
+		key = self._key(request)
+		rate = self.get_rate(key)
+		if rate.state != CLOSED:
+			if not rate.allow_probe():
+				self._park(key, rate, request, spider)
+			spider.logger.info(f"probing {key}")
+			self._publish(key, rate, spider)
+		self._apply(key, rate, spider)
+		return None
+
+	def process_response(self, request, response, spider):
+		self._record(request, spider, is_blocked(response.status))
+		return response
+
+	def process_exception(self, request, exception, spider):
+		self._record(request, spider, True)
+		return None
+
+	def request_skipped(self, request, spider):
+		"""records unchanged pages RecrawlMiddleware dropped, which were answered fine"""
+		self._record(request, spider, False)
+
+	def spider_idle(self, spider):
+		"""keeps the spider open while requests are parked"""
+		if self.parked:
+			raise DontCloseSpider
+
+	def spider_closed(self, spider):
+		for release in self.releases.values():
+			if release.active():
+				release.cancel()
+		self.releases.clear()
+		self.parked.clear()
+		for key, rate in self.rates.items():
+			spider.logger.info(f"{key}: {rate.state}, delay {rate.delay:.2f}s, "
+				f"concurrency {rate.concurrency}, {rate.trips} trips")
@@ -0,0 +1,223 @@
+"""conditional recrawls, which skip pages that haven't changed since the last run.
+
+RecrawlMiddleware remembers the ETag, Last-Modified and a hash of the body
+of every page, by request fingerprint, in a sqlite file per spider.
+Recrawls send them as If-None-Match and If-Modified-Since, and pages that
+come back 304 or with the same body are dropped before the spider sees
+them, so neither the callback nor the pipeline runs.
+
+Only requests with recrawl set to True in meta are recrawled conditionally,
+which should be pages that don't lead to others, such as detail pages: when
+a listing is skipped, the requests it would yield are skipped with it.
+
+New validators are only stored once the callback of the page has run
+through, see RecrawlSpiderMiddleware, so pages that failed to parse are
+parsed again on the next run. Skipped requests are sent with the
+request_skipped signal, so the url cache can mark them as crawled."""
+import hashlib
+import os
+import sqlite3
+import time
+
+from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+
+from slick import frontier
+
+# where spider validators are kept, unless RECRAWL_DIR is set
+DEFAULT_DIR = '.recrawl'
+# new validators are written in batches of this size
+PERSIST_SIZE = 1000
+META_KEY = 'recrawl'
+# validators of a changed page, stored once it's parsed
+VALIDATORS_KEY = 'recrawl_validators'
+
+# sent with request and spider when a request is skipped
+request_skipped = object()
+# sent with response and spider when the callback of a response ran through
+response_parsed = object()
+
+
+def body_hash(body):
+	return hashlib.blake2b(body, digest_size=16).digest()
+
+
+class ValidatorStore(object):
+	"""validators by request fingerprint, in a sqlite db in WAL mode.
+	Validators expire ttl seconds after they were stored, so pages are
+	parsed at least once per ttl. A ttl of 0 keeps them forever."""
+
+	def __init__(self, path, ttl=0, persist_size=PERSIST_SIZE):
+		self.path = path
+		self.ttl = ttl
+		self.persist_size = persist_size
+		self.pending = {}
+		directory = os.path.dirname(path)
+		if directory:
+			os.makedirs(directory, exist_ok=True)
+		self.conn = sqlite3.connect(path)
+		self.conn.execute('PRAGMA journal_mode=WAL')
+		self.conn.execute('PRAGMA synchronous=NORMAL')
+		self.conn.execute("""CREATE TABLE IF NOT EXISTS validator (
+			fingerprint BLOB NOT NULL PRIMARY KEY,
+			etag TEXT,
+			last_modified TEXT,
+			body_hash BLOB,
+			stored_at REAL NOT NULL) WITHOUT ROWID""")
+		self.conn.commit()
+
+	@classmethod
+	def for_spider(cls, directory, spider_name, **kwargs):
+		"""the store of a spider, one file per spider name"""
+		return cls(os.path.join(directory, f'{spider_name}.sqlite'), **kwargs)
+
+	def expire(self, now=None):
+		"""deletes validators older than ttl, returns how many"""
+		if not self.ttl:
+			return 0
+		now = time.time() if now is None else now
+		deleted = self.conn.execute('DELETE FROM validator WHERE stored_at < ?', (now - self.ttl, )).rowcount
+		self.conn.commit()
+		return deleted
+
+	def get(self, key):
+		"""(etag, last modified, body hash) of key, None if unknown"""
+		if key in self.pending:
+			return self.pending[key][1:4]
+		row = self.conn.execute("""SELECT etag, last_modified, body_hash
+			FROM validator WHERE fingerprint = ?""", (key, )).fetchone()
+		return tuple(row) if row else None
+
+	def set(self, key, etag, last_modified, digest):
+		"""remembers validators of key, written with the next persist"""
+		self.pending[key] = (key, etag, last_modified, digest, time.time())
+		if len(self.pending) >= self.persist_size:
+			self.persist()
+
+	def persist(self):
+		"""writes pending validators"""
+		if self.pending:
+			self.conn.executemany("""INSERT OR REPLACE INTO validator
+				(fingerprint, etag, last_modified, body_hash, stored_at) VALUES (?, ?, ?, ?, ?)""",
+				list(self.pending.values()))
+			self.conn.commit()
+			self.pending = {}
+
+	def close(self):
+		self.persist()
+		self.conn.close()
+
+
+def _header(headers, name):
+	value = headers.get(name)
+	return value.decode('latin1') if value is not None else None
+
+
+class RecrawlMiddleware(object):
+	"""downloader middleware for conditional recrawls, enabled by RECRAWL_ENABLED.
+	Should come before HttpCompressionMiddleware, so bodies are hashed decompressed."""
+
+	def __init__(self, stats=None, directory=DEFAULT_DIR, ttl=0, signals=None):
+		self.stats = stats
+		self.directory = directory
+		self.ttl = ttl
+		self.signals = signals
+		self.store = None
+
+	@classmethod
+	def from_crawler(cls, crawler):
+		settings = crawler.settings
+		if not settings.getbool('RECRAWL_ENABLED'):
+			raise NotConfigured
+		s = cls(
+			stats=crawler.stats,
+			directory=settings.get('RECRAWL_DIR') or DEFAULT_DIR,
+			ttl=settings.getint('RECRAWL_TTL'),
+			signals=crawler.signals)
+		crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+		crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+		crawler.signals.connect(s.response_parsed, signal=response_parsed)
+		return s
+
+	def spider_opened(self, spider):
+		self.store = ValidatorStore.for_spider(self.directory, spider.name, ttl=self.ttl)
+		expired = self.store.expire()
+		if self.stats is not None:
+			self.stats.set_value('recrawl/expired', expired, spider=spider)
+
+	def spider_closed(self, spider):
+		self.store.close()
+
+	def _inc(self, key, spider):
+		if self.stats is not None:
+			self.stats.inc_value(f'recrawl/{key}', spider=spider)
+
+	def _applies(self, request):
+		return request.method == 'GET' and request.meta.get(META_KEY, False)
+
+	def _skip(self, key, request, spider):
+		self._inc(key, spider)
+		if self.signals is not None:
+			self.signals.send_catch_log(signal=request_skipped, request=request, spider=spider)
+		raise IgnoreRequest(f"{key.replace('_', ' ')}: {request.url}")
+
+	def response_parsed(self, response, spider):
+		"""stores the validators of a changed page, once it's parsed"""
+		validators = response.meta.get(VALIDATORS_KEY)
+		if validators and self.store is not None:
+			self.store.set(frontier.fingerprint(response), *validators)
+
+	def process_request(self, request, spider):
+		"""sends the validators of the last crawl"""
+		if not self._applies(request):
+			return None
+		validators = self.store.get(frontier.fingerprint(request))
+		if validators:
+			etag, last_modified, _ = validators
+			if etag:
+				request.headers.setdefault('If-None-Match', etag)
+			if last_modified:
+				request.headers.setdefault('If-Modified-Since', last_modified)
+		return None
+
+	def process_response(self, request, response, spider):
+		"""drops pages that haven't changed, keeps validators of the rest
+		in meta, to be stored once they're parsed"""
+		if not self._applies(request):
+			return response
+		key = frontier.fingerprint(request)
+		if response.status == 304 and self.store.get(key):
+			self._skip('not_modified', request, spider)
+		if response.status != 200:
+			return response
+
+		digest = body_hash(response.body)
+		known = self.store.get(key)
+		if known and known[2] == digest:
+			# kept as they were, so they still expire ttl after the page last changed
+			self._skip('unchanged', request, spider)
+		request.meta[VALIDATORS_KEY] = (
+			_header(response.headers, 'ETag'),
+			_header(response.headers, 'Last-Modified'),
+			digest)
+		self._inc('changed' if known else 'new', spider)
+		return response
+
+
+class RecrawlSpiderMiddleware(object):
+	"""spider middleware sending response_parsed once the callback of a page
+	recrawled conditionally ran through, enabled by RECRAWL_ENABLED"""
+
+	def __init__(self, signals):
+		self.signals = signals
+
+	@classmethod
+	def from_crawler(cls, crawler):
+		if not crawler.settings.getbool('RECRAWL_ENABLED'):
+			raise NotConfigured
+		return cls(crawler.signals)
+
+	def process_spider_output(self, response, result, spider):
+		yield from result
+		if VALIDATORS_KEY in response.meta:
+			self.signals.send_catch_log(signal=response_parsed, response=response, spider=spider)
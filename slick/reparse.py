@@ -0,0 +1,146 @@
+"""re-parses archived responses on every core, see slick.archive.
+
+The segments of a spider's archive are spread over a process pool. Each
+worker has a spider of its own, and runs the callbacks records were crawled
+with, which are pure functions of the response for our loaders. Items are
+sent back to the main process, which runs them through the item pipelines,
+so there's a single db writer. Items are written in archive order, so
+newer captures of a page overwrite older ones."""
+import collections
+import logging
+import multiprocessing
+import os
+import time
+
+from scrapy import Request, Spider
+from scrapy.exceptions import DropItem
+from scrapy.utils.conf import build_component_list
+from scrapy.utils.misc import create_instance, load_object
+from scrapy.utils.spider import iterate_spider_output
+
+from slick import archive, frontier, model
+
+logger = logging.getLogger(__name__)
+
+# the spider of a worker process, see _init_worker
+_spider = None
+
+
+def make_parse_spider(spidercls, **kwargs):
+	"""a spider that only runs callbacks. Only Spider.__init__ runs, not the
+	__init__ of spidercls and its mixins, which connect to the db and query
+	start urls, which parsing doesn't need"""
+	spider = spidercls.__new__(spidercls)
+	Spider.__init__(spider, **kwargs)
+	return spider
+
+
+def _init_worker(spidercls, spider_kwargs):
+	global _spider
+	_spider = make_parse_spider(spidercls, **spider_kwargs)
+
+
+def _pool(spidercls, processes=None, spider_kwargs=None):
+	"""a pool of processes with parse spiders. Connections are closed
+	before forking, so workers don't share the parent's"""
+	model.dispose_engines()
+	return multiprocessing.Pool(processes, initializer=_init_worker, initargs=(spidercls, spider_kwargs or {}))
+
+
+def _parse_segment(path):
+	"""parses the records of a segment with the worker's spider.
+	Returns the worker pid, pages parsed, seconds taken and the items"""
+	start = time.perf_counter()
+	pages = 0
+	items = []
+	for record in archive.iter_segment(path):
+		request = frontier.make_request(_spider, record['url'], record['callback'], data=record['request'])
+		if request is None or archive.is_robots(request):
+			continue
+		response = archive.make_response(record, request=request)
+		callback = request.callback or _spider.parse
+		for result in iterate_spider_output(callback(response)):
+			if not isinstance(result, Request):
+				items.append(result)
+		pages += 1
+	return os.getpid(), pages, time.perf_counter() - start, items
+
+
+def parse_segments(spidercls, segments, processes=None, spider_kwargs=None):
+	"""parses segments in a pool of processes, cpu count by default.
+	Yields (worker pid, pages, seconds, items) per segment, in the order of segments."""
+	with _pool(spidercls, processes, spider_kwargs) as pool:
+		yield from pool.imap(_parse_segment, segments)
+
+
+class WorkerStats(object):
+	"""pages parsed and seconds spent per worker"""
+
+	def __init__(self):
+		self.pages = collections.Counter()
+		self.seconds = collections.Counter()
+
+	def add(self, pid, pages, seconds):
+		self.pages[pid] += pages
+		self.seconds[pid] += seconds
+
+	def rates(self):
+		"""pages/sec by worker pid"""
+		return {pid: self.pages[pid] / self.seconds[pid] if self.seconds[pid] else 0.0 for pid in self.pages}
+
+
+def _open_pipelines(crawler, spider):
+	paths = build_component_list(crawler.settings.getwithbase('ITEM_PIPELINES'))
+	pipelines = [create_instance(load_object(path), crawler.settings, crawler) for path in paths]
+	for pipeline in pipelines:
+		if hasattr(pipeline, 'open_spider'):
+			pipeline.open_spider(spider)
+	return pipelines
+
+
+def _process_item(pipelines, item, spider):
+	"""runs item through pipelines, returns false iff it was dropped"""
+	for pipeline in pipelines:
+		try:
+			item = pipeline.process_item(item, spider)
+		except DropItem:
+			return False
+	return True
+
+
+def reparse(crawler, directory, processes=None):
+	"""re-parses the archive in directory of the crawler's spider, writing
+	items through its pipelines. Pipelines run without threads in the
+	main process, so DBPIPELINE_THREADS should be 0. Returns WorkerStats."""
+	spidercls = crawler.spidercls
+	spider = crawler.spider = spidercls.from_crawler(crawler)
+	stats = crawler.stats
+	stats.open_spider(spider)
+	workers = WorkerStats()
+	segments = archive.iter_segments(archive.spider_directory(directory, spider.name))
+	logger.info(f"re-parsing {len(segments)} segments of {spider.name}")
+
+	start = time.perf_counter()
+	# forked before pipelines connect to the db
+	pool = _pool(spidercls, processes)
+	pipelines = _open_pipelines(crawler, spider)
+	try:
+		for pid, pages, seconds, items in pool.imap(_parse_segment, segments):
+			workers.add(pid, pages, seconds)
+			stats.inc_value('reparse/pages', pages, spider=spider)
+			for item in items:
+				stats.inc_value('reparse/items' if _process_item(pipelines, item, spider) else 'reparse/dropped', spider=spider)
+	finally:
+		pool.terminate()
+		pool.join()
+		for pipeline in pipelines:
+			if hasattr(pipeline, 'close_spider'):
+				pipeline.close_spider(spider)
+		stats.close_spider(spider, 'finished')
+
+	elapsed = time.perf_counter() - start
+	for pid, rate in sorted(workers.rates().items()):
+		logger.info(f"worker {pid}: {workers.pages[pid]} pages, {rate:.0f} pages/s")
+	total = sum(workers.pages.values())
+	logger.info(f"re-parsed {total} pages in {elapsed:.1f}s, {total / elapsed if elapsed else 0:.0f} pages/s")
+	return workers
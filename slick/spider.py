@@ -4,6 +4,12 @@ from metrics import get_engine
 
 class DBMixin(object):
 	"""holds a connection to the DB"""
+	@classmethod
+	def from_crawler(cls, crawler, *args, **kwargs):
+		"""configures the pool from settings before the db is opened"""
+		model.configure_pool(crawler.settings)
+		return super().from_crawler(crawler, *args, **kwargs)
+
 	def __init__(self, *args, **kwargs):
 		"""opens db"""
 		super().__init__(*args, **kwargs)
@@ -0,0 +1,122 @@
+"""timing instrumentation, recorded as percentiles in crawler stats"""
+import collections
+import threading
+import time
+
+# samples kept per histogram, older ones are dropped
+HISTOGRAM_SIZE = 1024
+PERCENTILES = (50, 95, 99)
+STATS_PREFIX = 'slick/timing'
+
+
+class Histogram(object):
+	"""percentiles over the most recent samples, plus count and max of all of them"""
+
+	def __init__(self, size=HISTOGRAM_SIZE):
+		self.samples = collections.deque(maxlen=size)
+		self.count = 0
+		self.max = 0.0
+
+	def add(self, value):
+		self.samples.append(value)
+		self.count += 1
+		if value > self.max:
+			self.max = value
+
+	def percentile(self, p):
+		"""nearest rank percentile of the kept samples, None if there are none"""
+		return _nearest_rank(sorted(self.samples), p)
+
+	def summary(self):
+		"""percentiles, count and max as a dict"""
+		ordered = sorted(self.samples)
+		out = {f'p{p}': _nearest_rank(ordered, p) for p in PERCENTILES}
+		out['count'] = self.count
+		out['max'] = self.max
+		return out
+
+
+def _nearest_rank(ordered, p):
+	"""the p-th percentile of sorted values, None if empty"""
+	if not ordered:
+		return None
+	rank = int(round(p / 100.0 * len(ordered))) - 1
+	return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+
+class _Timing(object):
+	"""context manager adding its duration to a histogram"""
+
+	__slots__ = ('timer', 'key', 'started')
+
+	def __init__(self, timer, key):
+		self.timer = timer
+		self.key = key
+
+	def __enter__(self):
+		self.started = time.perf_counter()
+		return self
+
+	def __exit__(self, *args):
+		self.timer.add(self.key, time.perf_counter() - self.started)
+		return False
+
+
+class StageTimer(object):
+	"""times stages of writes per item class, such as lookup or commit.
+
+	with timer.time(the_item, 'lookup'):
+		...
+
+	Histograms are shared by threads, so adding is locked."""
+
+	enabled = True
+
+	def __init__(self, size=HISTOGRAM_SIZE):
+		self.size = size
+		self.histograms = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	def time(self, name, stage):
+		"""context manager timing stage for name, an item class name"""
+		return _Timing(self, (name, stage))
+
+	def add(self, key, value):
+		with self.lock:
+			histogram = self.histograms.get(key)
+			if histogram is None:
+				histogram = self.histograms[key] = Histogram(self.size)
+			histogram.add(value)
+
+	def stats(self, prefix=STATS_PREFIX):
+		"""flat dict of {prefix}/{name}/{stage}/{p50,p95,p99,count,max} for crawler stats"""
+		with self.lock:
+			summaries = [(key, histogram.summary()) for key, histogram in self.histograms.items()]
+		return {f'{prefix}/{name}/{stage}/{k}': v
+			for (name, stage), summary in summaries for k, v in summary.items()}
+
+
+class _NullTiming(object):
+	"""context manager doing nothing"""
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		return False
+
+
+class NullTimer(object):
+	"""StageTimer that doesn't time, used when timing is off"""
+
+	enabled = False
+	_timing = _NullTiming()
+
+	def time(self, name, stage):
+		return self._timing
+
+	def stats(self, prefix=STATS_PREFIX):
+		return {}
+
+
+NULL_TIMER = NullTimer()
@@ -24,13 +24,13 @@ EMAIL_REGEX = r"([a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.([a-zA-Z0-9-.]+))"
 
 SteamSearchResultItem = model.realize_item_class("SteamSearchResultItem", models.SteamSearchResult)
 
-DeveloperItem = model.realize_item_class("DeveloperItem", models.Developer)
+DeveloperItem = model.realize_item_class("DeveloperItem", models.Developer, dedup_attribute="name")
 
-GameItem = model.realize_item_class("GameItem", models.Game)
+GameItem = model.realize_item_class("GameItem", models.Game, dedup_attribute="name")
 
-ForumPageItem = model.realize_item_class("ForumPageItem", models.ForumPage)
+ForumPageItem = model.realize_item_class("ForumPageItem", models.ForumPage, dedup_attribute="url")
 
-EmailItem = model.realize_item_class("EmailItem", models.Email)
+EmailItem = model.realize_item_class("EmailItem", models.Email, dedup_attribute="email")
 
 ConcurrentPlayersItem = model.realize_item_class("ConcurrentPlayersItem", models.ConcurrentPlayers)
 
@@ -1,30 +1,105 @@
 import scrapy
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
 
-from steam.models import UrlCache
+from slick import frontier, model, recrawl
+from steam.models import UrlCache, UrlCacheBuffer, URLCACHE_FLUSH_SIZE, URLCACHE_RESUME_CHUNK_SIZE
+
+# seconds between flushes of the url cache
+URLCACHE_FLUSH_SECONDS = 5
+# where pending urls are kept: sql, the UrlCache table of the spider's db,
+# or sqlite, a local SqliteFrontier file per spider in URLCACHE_DIR
+URLCACHE_BACKENDS = ('sql', 'sqlite')
 
-from steam.spiders import GameDeveloperParsingMixin
 
 class CachingMiddleware(object):
-	"""caches url crawls in db. so can be resumed"""
+	"""caches url crawls, so they can be resumed.
+	Writes are buffered and flushed every URLCACHE_FLUSH_SECONDS, when
+	URLCACHE_FLUSH_SIZE are pending, and when the spider closes."""
+
+	def __init__(self, flush_size=URLCACHE_FLUSH_SIZE, flush_seconds=URLCACHE_FLUSH_SECONDS,
+			resume_chunk_size=URLCACHE_RESUME_CHUNK_SIZE, backend='sql', directory=frontier.DEFAULT_DIR):
+		if backend not in URLCACHE_BACKENDS:
+			raise ValueError(f"unknown url cache backend {backend}, expected one of {', '.join(URLCACHE_BACKENDS)}")
+		self.flush_size = flush_size
+		self.flush_seconds = flush_seconds
+		self.resume_chunk_size = resume_chunk_size
+		self.backend = backend
+		self.directory = directory
+		self.cache = None
+		self.flush_task = None
+
+	@classmethod
+	def from_crawler(cls, crawler):
+		settings = crawler.settings
+		if not settings.getbool('URLCACHE_ENABLED', True):
+			raise NotConfigured
+		s = cls(
+			flush_size=settings.getint('URLCACHE_FLUSH_SIZE', URLCACHE_FLUSH_SIZE),
+			flush_seconds=settings.getfloat('URLCACHE_FLUSH_SECONDS', URLCACHE_FLUSH_SECONDS),
+			resume_chunk_size=settings.getint('URLCACHE_RESUME_CHUNK_SIZE', URLCACHE_RESUME_CHUNK_SIZE),
+			backend=settings.get('URLCACHE_BACKEND', 'sql'),
+			directory=settings.get('URLCACHE_DIR') or frontier.DEFAULT_DIR)
+		crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+		crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+		crawler.signals.connect(s.request_skipped, signal=recrawl.request_skipped)
+		return s
 
 	def has_db(self, spider):
 		return hasattr(spider, 'db')
 
+	def spider_opened(self, spider):
+		"""opens the cache. The sql cache is only used by spiders with a db,
+		and buffers writes in a session of its own, apart from the spider's.
+		It's left off if the url_cache table isn't on the current schema,
+		which `migrate` brings older tables to."""
+		if self.backend == 'sqlite':
+			self.cache = frontier.SqliteFrontier.for_spider(self.directory, spider.name,
+					flush_size=self.flush_size, spider=spider)
+		elif self.has_db(spider):
+			db = model.SqlSession()
+			if UrlCache.is_current(db):
+				self.cache = UrlCacheBuffer(db, spider.name,
+						flush_size=self.flush_size, logger=spider.logger, spider=spider)
+			else:
+				db.close()
+				spider.logger.error(f"{UrlCache.__tablename__} needs creating or migrating, "
+					f"run `create` or `migrate` first, urls won't be cached")
+		if self.cache is not None and self.flush_seconds:
+			self.flush_task = task.LoopingCall(self.cache.flush)
+			self.flush_task.start(self.flush_seconds, now=False)
+
+	def spider_closed(self, spider):
+		"""writes what's left in the buffer"""
+		if self.flush_task and self.flush_task.running:
+			self.flush_task.stop()
+		if self.cache is not None:
+			self.cache.close()
+			self.cache = None
+
 	def process_spider_input(self, response, spider):
 		"""marks response as crawled"""
-		if self.has_db(spider):
-			UrlCache.resolve(spider, response)
+		if self.cache is not None:
+			self.cache.resolve(response)
+
+	def request_skipped(self, request, spider):
+		"""marks requests skipped by recrawls as crawled, since they never reach the spider"""
+		if self.cache is not None:
+			self.cache.resolve(request)
 
 	def process_spider_output(self, response, result, spider):
-		"""marks a url as crawled"""
+		"""caches requests, so they're crawled if the crawl is resumed"""
 
 		for i in result:
-			if isinstance(i, scrapy.Request) and self.has_db(spider):
-				UrlCache.insert(spider, i)
+			if isinstance(i, scrapy.Request) and self.cache is not None:
+				self.cache.insert(i)
 			yield i
 
 	def process_start_requests(self, start_requests, spider):
-		"""loads cached requets from db"""
+		"""loads cached requests, lazily and a chunk at a time,
+		as the scheduler asks for them. Requests are rebuilt as they were
+		cached, with their cookies, meta and priority"""
 		# Called with the start requests of the spider, and works
 		# similarly to the process_spider_output() method, except
 		# that it doesn’t have a response associated.
@@ -33,15 +108,8 @@ class CachingMiddleware(object):
 		for r in start_requests:
 				yield r
 
-		if self.has_db(spider):
-			for cached in UrlCache.get(spider.db, spider.name):
-				callback_name = 'parse' if not cached.callback else cached.callback
-				fn = getattr(spider, callback_name)
-				if fn:
-					# TODO this is a bit ugly, should just pickle whole thing
-					if callback_name == 'parse_game':
-						yield GameDeveloperParsingMixin.make_game_request(cached.url, fn)
-					else:
-						yield scrapy.Request(url=cached.url, callback=fn)
-				else:
-					spider.logger.error(f"{callback_name} not registered on {spider.name}")
+		if self.cache is not None:
+			for url, callback, priority, data in self.cache.iter_pending(chunk_size=self.resume_chunk_size):
+				request = frontier.make_request(spider, url, callback, priority, data)
+				if request is not None:
+					yield request
@@ -1,8 +1,12 @@
-import hashlib
+import collections
+import logging
 
-from slick import model
+import scrapy
+import sqlalchemy
 
-from sqlalchemy import Column, DateTime, Integer, String, ForeignKey, Boolean
+from slick import frontier, model
+
+from sqlalchemy import BINARY, Column, DateTime, Integer, LargeBinary, String, ForeignKey, Boolean, and_
 from sqlalchemy.orm import relationship
 
 
@@ -11,6 +15,7 @@ class Game(model.BaseModel):
 
 	__tablename__ = "game"
 	_lookup_attributes = ('name', )
+	_native_upsert = True
 
 	id = Column(Integer, primary_key=True)
 	name = Column(String(256), unique=True)
@@ -37,6 +42,7 @@ class Developer(model.BaseModel):
 
 	__tablename__ = "developer"
 	_lookup_attributes = ('name', )
+	_native_upsert = True
 
 	id = Column(Integer, primary_key=True)
 	name = Column(String(256), unique=True)
@@ -80,6 +86,7 @@ class ForumPage(model.BaseModel):
 class Email(model.BaseModel):
 	__tablename__ = "email"
 	_lookup_attributes = ('email', )
+	_native_upsert = True
 
 	id = Column(Integer, primary_key=True)
 	email = Column(String(256), unique=True)
@@ -92,61 +99,219 @@ class Email(model.BaseModel):
 			back_populates="emails")
 
 
+# pending writes that trigger a flush of UrlCacheBuffer
+URLCACHE_FLUSH_SIZE = 500
+# pending urls read per query when resuming a crawl
+URLCACHE_RESUME_CHUNK_SIZE = 1000
+# bytes of the request fingerprint kept as url cache keys
+URL_FINGERPRINT_SIZE = 16
+
+
+def _insert_ignore(table):
+	"""multi-row insert that skips rows whose key exists"""
+	return table.insert()\
+		.prefix_with('IGNORE', dialect='mysql')\
+		.prefix_with('OR IGNORE', dialect='sqlite')
+
+
 class UrlCache(model.BaseModel):
-	"""we store urls here while they process so we can interrupt crawls and restart them"""
+	"""we store urls here while they process so we can interrupt crawls and restart them.
+	Urls are keyed by a binary fingerprint of their request, the primary key
+	is the only index."""
 
 	__tablename__ = "url_cache"
 
-	crawl_name = Column(String(32), index=True, primary_key=True)
-	url_hash = Column(String(64), index=True, primary_key=True)
-	url = Column(String(512), index=True)
+	crawl_name = Column(String(32), primary_key=True)
+	fingerprint = Column(BINARY(URL_FINGERPRINT_SIZE), primary_key=True)
+	url = Column(String(512))
 	callback = Column(String(64))
+	# the whole request, see slick.frontier.serialize
+	request = Column(LargeBinary)
 	crawled = Column(Boolean, default=0)
 
 	@staticmethod
-	def make(spider, request_or_response):
-		url = request_or_response.url
-		callback = None
-		try:
-			callback = request_or_response.callback.__name__
-		except AttributeError:
-			pass
-		m = hashlib.md5()
-		m.update(url.encode('utf8', 'ignore'))
-		return UrlCache(
-			crawl_name=spider.name,
-			url_hash=m.hexdigest(),
-			callback=callback,
-			url=url)
+	def fingerprint_of(request_or_response):
+		"""compact fingerprint of a request, or of the request of a response"""
+		return frontier.fingerprint(request_or_response, size=URL_FINGERPRINT_SIZE)
 
 	@staticmethod
-	def insert(spider, response):
-		db = spider.db
-		db.add(UrlCache.make(spider, response))
-		try:
-			db.commit()
-		except Exception:
-			db.rollback()
+	def get(db, name):
+		return db.query(UrlCache).filter(
+			UrlCache.crawl_name == name,
+			UrlCache.crawled == 0)
 
 	@staticmethod
-	def resolve(spider, response):
-		"""marks a url as crawled"""
-		db = spider.db
-		cached = UrlCache.make(spider, response)
-		db.query(UrlCache).filter(
-			UrlCache.crawl_name == cached.crawl_name,
-			UrlCache.url_hash == cached.url_hash)\
-			.update({UrlCache.crawled: 1})
-		try:
+	def iter_pending(db, name, chunk_size=URLCACHE_RESUME_CHUNK_SIZE):
+		"""(url, callback, serialized request) of pending urls, read chunk_size
+		at a time by paginating on the primary key, so they're never all in memory"""
+		last = None
+		while True:
+			query = db.query(UrlCache.fingerprint, UrlCache.url, UrlCache.callback, UrlCache.request).filter(
+				UrlCache.crawl_name == name,
+				UrlCache.crawled == 0)
+			if last is not None:
+				query = query.filter(UrlCache.fingerprint > last)
+			rows = query.order_by(UrlCache.fingerprint).limit(chunk_size).all()
+			for row in rows:
+				yield row.url, row.callback, row.request
+			if len(rows) < chunk_size:
+				return
+			last = rows[-1].fingerprint
+
+	@staticmethod
+	def is_current(db):
+		"""true iff url_cache exists with the current schema, so it needs neither
+		creating nor migrating (see migrate) before urls can be cached"""
+		inspector = sqlalchemy.inspect(db.get_bind())
+		if UrlCache.__tablename__ not in inspector.get_table_names():
+			return False
+		columns = {c['name'] for c in inspector.get_columns(UrlCache.__tablename__)}
+		return 'fingerprint' in columns and 'request' in columns
+
+	@staticmethod
+	def migrate(db, logger=None, chunk_size=URLCACHE_RESUME_CHUNK_SIZE):
+		"""migrates url_cache to the current schema, returns how many rows were moved.
+		Tables keyed by md5 hex strings, with an index per column, are moved to
+		fingerprint keys. Tables without serialized requests get the column."""
+		logger = logger or logging.getLogger(__name__)
+		name = UrlCache.__tablename__
+		inspector = sqlalchemy.inspect(db.get_bind())
+		if name not in inspector.get_table_names():
+			return 0
+		columns = {c['name'] for c in inspector.get_columns(name)}
+		if 'url_hash' in columns:
+			return UrlCache._migrate_fingerprints(db, logger, chunk_size)
+		if 'request' not in columns:
+			logger.info(f"adding request to {name}")
+			db.execute(f"ALTER TABLE {name} ADD COLUMN request {UrlCache.request.type.compile(db.get_bind().dialect)}")
 			db.commit()
-		except Exception:
-			db.rollback()
+		else:
+			logger.info(f"{name} is up to date")
+		return 0
 
 	@staticmethod
-	def get(db, name):
-		return db.query(UrlCache).filter(
-			UrlCache.crawl_name == name,
-			UrlCache.crawled == 0)
+	def _migrate_fingerprints(db, logger, chunk_size):
+		"""moves rows keyed by md5 to a new table. Cached requests were
+		all GETs without bodies, so fingerprints are made from urls."""
+		name = UrlCache.__tablename__
+		old_name = f"{name}_md5"
+		logger.info(f"moving {name} to {old_name}")
+		db.execute(f"ALTER TABLE {name} RENAME TO {old_name}")
+		old = sqlalchemy.Table(old_name, sqlalchemy.MetaData(), autoload=True, autoload_with=db.connection())
+		UrlCache.__table__.create(db.connection())
+
+		moved = 0
+		last = None
+		while True:
+			query = sqlalchemy.select([old.c.crawl_name, old.c.url_hash, old.c.url, old.c.callback, old.c.crawled])
+			if last is not None:
+				query = query.where(sqlalchemy.or_(
+					old.c.crawl_name > last[0],
+					and_(old.c.crawl_name == last[0], old.c.url_hash > last[1])))
+			rows = db.execute(query.order_by(old.c.crawl_name, old.c.url_hash).limit(chunk_size)).fetchall()
+			if rows:
+				db.execute(_insert_ignore(UrlCache.__table__), [{
+					'crawl_name': row.crawl_name,
+					'fingerprint': UrlCache.fingerprint_of(scrapy.Request(row.url)),
+					'url': row.url,
+					'callback': row.callback,
+					'crawled': row.crawled,
+				} for row in rows])
+				moved += len(rows)
+				logger.info(f"moved {moved} rows")
+			if len(rows) < chunk_size:
+				break
+			last = (rows[-1].crawl_name, rows[-1].url_hash)
+
+		old.drop(db.connection())
+		db.commit()
+		return moved
+
+
+class UrlCacheBuffer(object):
+	"""write-behind buffer for UrlCache. Inserts and resolves are kept
+	in memory and written in bulk by flush, as one INSERT IGNORE
+	and one UPDATE ... IN per chunk. Flushes itself once flush_size
+	writes are pending, so a crash loses at most that many."""
+
+	def __init__(self, db, crawl_name, flush_size=URLCACHE_FLUSH_SIZE, logger=None, spider=None):
+		self.db = db
+		self.crawl_name = crawl_name
+		self.spider = spider
+		self.flush_size = flush_size
+		self.logger = logger or logging.getLogger(__name__)
+		self.inserts = collections.OrderedDict()
+		self.resolves = set()
+
+	def __len__(self):
+		return len(self.inserts) + len(self.resolves)
+
+	def _flush_if_full(self):
+		if self.flush_size and len(self) >= self.flush_size:
+			self.flush()
+
+	def insert(self, request):
+		"""queues a request for insert, unless it's already cached"""
+		fingerprint = UrlCache.fingerprint_of(request)
+		if fingerprint not in self.inserts:
+			callback = getattr(request.callback, '__name__', None)
+			self.inserts[fingerprint] = {
+				'crawl_name': self.crawl_name,
+				'fingerprint': fingerprint,
+				'url': request.url,
+				'callback': callback,
+				'request': frontier.serialize(request, self.spider),
+				'crawled': False,
+			}
+			self._flush_if_full()
+
+	def resolve(self, response):
+		"""queues marking the request of response as crawled"""
+		fingerprint = UrlCache.fingerprint_of(response)
+		pending = self.inserts.get(fingerprint)
+		if pending is not None:
+			pending['crawled'] = True
+		# the row may exist from an earlier flush or run, which the insert ignores
+		self.resolves.add(fingerprint)
+		self._flush_if_full()
+
+	def iter_pending(self, chunk_size=URLCACHE_RESUME_CHUNK_SIZE):
+		"""(url, callback, priority, serialized request) of pending urls, like
+		SqliteFrontier. Priorities are only kept in the serialized request"""
+		for url, callback, request in UrlCache.iter_pending(self.db, self.crawl_name, chunk_size=chunk_size):
+			yield url, callback, 0, request
+
+	def close(self):
+		self.flush()
+		self.db.close()
+
+	def flush(self):
+		"""writes pending inserts and resolves in one transaction,
+		returns how many were written. Writes are dropped if it fails."""
+		inserts, self.inserts = list(self.inserts.values()), collections.OrderedDict()
+		resolves, self.resolves = list(self.resolves), set()
+		if not inserts and not resolves:
+			return 0
+
+		table = UrlCache.__table__
+		try:
+			if inserts:
+				# executemany, which the mysql driver sends as multi-row inserts
+				model.execute(self.db, _insert_ignore(table), inserts)
+			chunk_size = model.LOOKUP_CHUNK_SIZE
+			for i in range(0, len(resolves), chunk_size):
+				statement = table.update()\
+					.where(and_(
+						table.c.crawl_name == self.crawl_name,
+						table.c.fingerprint.in_(resolves[i:i + chunk_size])))\
+					.values(crawled=True)
+				model.execute(self.db, statement)
+			self.db.commit()
+		except Exception as e:
+			self.db.rollback()
+			self.logger.error(f"dropped {len(inserts)} url cache inserts and {len(resolves)} resolves: {e}")
+			return 0
+		return len(inserts) + len(resolves)
 
 
 class SteamSearchResult(model.BaseModel):
@@ -24,19 +24,63 @@ ROBOTSTXT_OBEY = True
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 SPIDER_MIDDLEWARES = {
 		'slick.middlewares.TransactionRecoverMiddleware': 300,
-		#'steam.middlewares.CachingMiddleware': 543,
+		'steam.middlewares.CachingMiddleware': 543,
+		'slick.recrawl.RecrawlSpiderMiddleware': 550,
 }
 
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 DOWNLOADER_MIDDLEWARES = {
 		'slick.middlewares.MetricsDownloaderMiddleware': 543,
+		# after RetryMiddleware, so it sees blocks before they're retried
+		'slick.ratecontrol.AdaptiveRateMiddleware': 560,
+		# before HttpCompressionMiddleware, so it sees decompressed bodies
+		'slick.archive.ArchiveMiddleware': 570,
+		'slick.recrawl.RecrawlMiddleware': 580,
 }
 
+# skips pages that haven't changed since the last run, for requests with
+# meta={'recrawl': True}, see slick/recrawl.py.
+# Validators are kept in a sqlite file per spider, for RECRAWL_TTL seconds.
+RECRAWL_ENABLED = True
+RECRAWL_TTL = 7 * 24 * 60 * 60
+#RECRAWL_DIR = '.recrawl'
+
+# sets delay and concurrency per domain from blocks, errors and latency,
+# and pauses domains that keep blocking us, see slick/ratecontrol.py
+RATECONTROL_ENABLED = True
+#RATECONTROL_START_DELAY = 0
+#RATECONTROL_START_DELAYS = {'steamcommunity.com': 3}
+#RATECONTROL_START_CONCURRENCY = 8
+#RATECONTROL_MIN_DELAY = 0
+#RATECONTROL_MAX_DELAY = 60
+#RATECONTROL_MAX_CONCURRENCY = 8
+#RATECONTROL_COOLDOWN = 60
+#RATECONTROL_MAX_COOLDOWN = 1800
+#RATECONTROL_PROBE_TIMEOUT = 180
+
+# archives downloaded pages, so they can be re-parsed with `python <project>.py reparse <spider>`
+#ARCHIVE_ENABLED = True
+#ARCHIVE_DIR = '.archive'
+
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
+		'slick.pipeline.ItemDeduplicationPipeline': 200,
 		'slick.pipeline.DBPipeline': 300,
 }
 
+# ItemDeduplicationPipeline remembers seen items in exact sets. Item classes where
+# dropping a few new items is ok can use bounded memory bloom filters instead,
+# whose probable losses are counted in dedup/suspected_false_positives stats.
+DEDUP_BACKEND = 'set'
+#DEDUP_BACKENDS = {'ForumPageItem': 'scalable'}
+DEDUP_CAPACITY = 100000
+DEDUP_ERROR_RATE = 0.001
+# remembers items and requests across runs, in a sqlite file per spider,
+# for DEDUP_INDEX_TTL seconds. Spiders can set their own ttl in custom_settings.
+#DEDUP_INDEX_DIR = '.dedup'
+#DEDUP_INDEX_TTL = 24 * 60 * 60
+#DUPEFILTER_CLASS = 'slick.dedup.PersistentDupeFilter'
+
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
 EXTENSIONS = {
 	'slick.extensions.PublishMetricsExtension': 300,
@@ -45,6 +89,35 @@ EXTENSIONS = {
 LOG_LEVEL = "INFO"
 PUBLISHMETRICS_INTERVAL = 60
 
+# DBPipeline buffers items and commits once per batch,
+# flushing when either limit is hit. 0 disables a limit.
+DBPIPELINE_BATCH_SIZE = 100
+DBPIPELINE_BATCH_SECONDS = 10
+# max objects kept in slick.model.lookup_cache, 0 disables it
+#DBPIPELINE_LOOKUP_CACHE_SIZE = 10000
+# writes batches in this many threads, off the reactor. 0 writes on the reactor.
+#DBPIPELINE_THREADS = 4
+# max writes queued for the threads before the pipeline applies backpressure
+#DBPIPELINE_QUEUE_DEPTH = 4
+# skips commits when items match what's stored
+#DBPIPELINE_SKIP_UNCHANGED = True
+# records percentiles of write stages per item class as slick/timing/* stats
+#DBPIPELINE_TIMING = True
+# url cache writes are buffered, and flushed when either limit is hit or the spider closes
+#URLCACHE_FLUSH_SIZE = 500
+#URLCACHE_FLUSH_SECONDS = 5
+# pending urls read per query when a crawl is resumed
+#URLCACHE_RESUME_CHUNK_SIZE = 1000
+# sql keeps pending urls in the url_cache table, sqlite in a local file per spider in URLCACHE_DIR
+#URLCACHE_BACKEND = 'sqlite'
+#URLCACHE_DIR = '.frontier'
+# connection pool, overrides the MYSQL_POOL* env vars. One of static, queue or null.
+#MYSQL_POOL = 'queue'
+#MYSQL_POOL_SIZE = 5
+#MYSQL_POOL_OVERFLOW = 10
+#MYSQL_POOL_PRE_PING = True
+#MYSQL_POOL_RECYCLE = 300
+
 # FOR breadth-first:
 #DEPTH_PRIORITY = 1
 #SCHEDULER_DISK_QUEUE = 'scrapy.squeues.PickleFifoDiskQueue'
@@ -10,8 +10,10 @@ class DeveloperParsingMixin(object):
 	"""mixin for generating developer requests and parsing them"""
 
 	def developer_request(self, url):
+		# developer pages lead nowhere, so they can be skipped when unchanged, see slick.recrawl
 		return scrapy.Request(url,
-				callback=self.parse_developer)
+				callback=self.parse_developer,
+				meta={'recrawl': True})
 
 	def parse_developer(self, response):
 		"""parse game landing page"""
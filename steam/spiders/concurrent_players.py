@@ -34,7 +34,6 @@ class ConcurrentPlayersSpider(spider.DBMixin,
 	def __init__(self, *args, **kwargs):
 		"""sets start urls from db"""
 		super().__init__(*args, **kwargs)
-		#self.download_delay = 2  # not sure this is necessary, but they have blocked other things, and there's no real rush
 
 		self.start_urls = [
 			make_steamcharts_url(f'top/p.{i}') for i in range(1, LAST_PAGE_NUM)
@@ -45,6 +45,8 @@ class EmailSpider(scrapy.Spider):
 
 	name = "email"
 	_item_classes = (items.EmailItem, )
+	# follows links within developer domains, none when only parsing, see slick.reparse
+	extractor = None
 
 	def __init__(self, *args, **kwargs):
 		"""conencts to db"""
@@ -63,7 +65,8 @@ class EmailSpider(scrapy.Spider):
 
 	def parse(self, response):
 		"""finds emails in a rudimentary but effective way using regular expressions"""
-		for link in self.extractor.extract_links(response):
-			yield scrapy.Request(url=link.url)
+		if self.extractor is not None:
+			for link in self.extractor.extract_links(response):
+				yield scrapy.Request(url=link.url)
 
 		yield from items.load_emails(response)
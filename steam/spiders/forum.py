@@ -26,11 +26,11 @@ class ForumSpider(spider.DBMixin,
 
 	start_urls = [QUERY_URL]
 
-	def __init__(self):
-		"""steam community isn't friendly to scraping, blocks you,
-		so we run this spider at a slower rate"""
-		super().__init__()
-		self.download_delay = 3
+	# steam community isn't friendly to scraping, and blocks you,
+	# so it starts slow, and slick.ratecontrol speeds it up as far as it lets us
+	custom_settings = {
+		'RATECONTROL_START_DELAYS': {'steamcommunity.com': 3},
+	}
 
 	def parse(self, response):
 		"""initial parse parses search result, and yields all request for all pages"""
@@ -0,0 +1,100 @@
+import os
+
+from scrapy import Request, Spider
+from scrapy.exceptions import IgnoreRequest
+from scrapy.http import HtmlResponse
+from scrapy.settings import Settings
+from scrapy.utils.conf import build_component_list
+from scrapy.utils.test import get_crawler
+
+import pytest
+
+from slick import archive
+
+
+class FakeSpider(Spider):
+	name = 'fake'
+
+	def parse_page(self, response):
+		yield {'title': response.css('title::text').get(), 'page': response.meta.get('page')}
+		yield Request('http://a.com/next', callback=self.parse_page)
+
+
+def test_archive_replays_responses(tmp_path):
+	"""archived pages are re-parsed by the callback they were crawled with"""
+	crawler = get_crawler(FakeSpider, {'ARCHIVE_ENABLED': True, 'ARCHIVE_DIR': str(tmp_path)})
+	spider = crawler._create_spider()
+	middleware = archive.ArchiveMiddleware.from_crawler(crawler)
+	middleware.spider_opened(spider)
+	for i in range(3):
+		request = Request(f'http://a.com/{i}', callback=spider.parse_page, meta={'page': i})
+		response = HtmlResponse(request.url, body=f'<title>page {i}</title>'.encode('utf8'), request=request)
+		assert middleware.process_response(request, response, spider) is response
+	middleware.spider_closed(spider)
+	assert crawler.stats.get_value('archive/responses') == 3
+
+	replay = archive.ReplaySpiderMiddleware(directory=str(tmp_path))
+	downloader = archive.ReplayDownloaderMiddleware()
+	items = []
+	for request in replay.process_start_requests([Request('http://a.com/start')], spider):
+		response = downloader.process_request(request, spider)
+		assert isinstance(response, HtmlResponse)
+		items.extend(replay.process_spider_output(response, request.callback(response), spider))
+	# requests the callbacks make are dropped
+	assert items == [{'title': f'page {i}', 'page': i} for i in range(3)]
+
+	with pytest.raises(IgnoreRequest):
+		downloader.process_request(Request('http://a.com/start'), spider)
+
+
+def test_truncated_segments_are_read(tmp_path):
+	"""segments cut short by a crash are read up to where they end"""
+	writer = archive.ArchiveWriter(str(tmp_path))
+	for i in range(100):
+		writer.write({'i': i, 'body': os.urandom(100)})
+	writer.close()
+	(path, ) = archive.iter_segments(str(tmp_path))
+	with open(path, 'rb') as f:
+		data = f.read()
+	with open(path, 'wb') as f:
+		f.write(data[:len(data) // 2])
+	records = list(archive.iter_records(str(tmp_path)))
+	assert 0 < len(records) < 100
+	assert [r['i'] for r in records] == list(range(len(records)))
+
+
+def test_configure_replay():
+	settings = archive.configure_replay(Settings({'DOWNLOAD_DELAY': 3, 'RECRAWL_ENABLED': True}), directory='archived')
+	assert settings.get('ARCHIVE_DIR') == 'archived'
+	assert settings.getfloat('DOWNLOAD_DELAY') == 0
+	assert not settings.getbool('RECRAWL_ENABLED')
+	assert 'slick.archive.ReplayDownloaderMiddleware' in settings.getdict('DOWNLOADER_MIDDLEWARES')
+
+
+def test_replay_keeps_every_version(tmp_path):
+	"""every archived version of a page is replayed, oldest first, and not deduplicated"""
+	spider = FakeSpider()
+	writer = archive.ArchiveWriter(archive.spider_directory(str(tmp_path), spider.name))
+	for version in ['old', 'new']:
+		request = Request('http://a.com/game', callback=spider.parse_page)
+		response = HtmlResponse(request.url, body=f'<title>{version}</title>'.encode('utf8'), request=request)
+		writer.write(archive.make_record(request, response, spider))
+		writer.close()
+
+	settings = archive.configure_replay(Settings({
+		'ITEM_PIPELINES': {
+			'slick.pipeline.ItemDeduplicationPipeline': 200,
+			'slick.pipeline.DBPipeline': 300,
+		},
+		'DEDUP_INDEX_DIR': '.dedup',
+	}), directory=str(tmp_path))
+	assert build_component_list(settings.getwithbase('ITEM_PIPELINES')) == ['slick.pipeline.DBPipeline']
+	assert not settings.get('DEDUP_INDEX_DIR')
+
+	replay = archive.ReplaySpiderMiddleware(directory=settings.get('ARCHIVE_DIR'))
+	downloader = archive.ReplayDownloaderMiddleware()
+	titles = []
+	for request in replay.process_start_requests([], spider):
+		response = downloader.process_request(request, spider)
+		titles.extend(i['title'] for i in replay.process_spider_output(response, request.callback(response), spider))
+	assert titles == ['old', 'new']
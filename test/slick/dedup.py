@@ -0,0 +1,93 @@
+import time
+
+import pytest
+from scrapy import Request
+from scrapy.http import Response
+
+from slick import dedup
+
+
+@pytest.mark.parametrize('backend', ['set', 'bloom', 'scalable'])
+def test_backends_remember_values(backend):
+	"""values are only new the first time they're added"""
+	deduper = dedup.make_backend(backend, capacity=100, error_rate=0.01)
+	assert deduper.add('a') is False
+	assert deduper.add('a') is True
+	assert 'a' in deduper
+	assert len(deduper) == 1
+
+
+def test_bloom_filter_error_rate():
+	"""false positives stay around the configured rate at capacity"""
+	bloom = dedup.BloomFilter(capacity=10000, error_rate=0.01)
+	for i in range(10000):
+		bloom.add(f'seen{i}')
+	false_positives = sum(1 for i in range(10000) if f'unseen{i}' in bloom)
+	assert false_positives < 200
+
+
+def test_scalable_bloom_filter_grows():
+	"""past capacity, bigger filters are added and every value is still found"""
+	bloom = dedup.ScalableBloomFilter(capacity=100, error_rate=0.01)
+	for i in range(1000):
+		bloom.add(i)
+	assert len(bloom.filters) > 1
+	assert all(i in bloom for i in range(1000))
+	assert sum(1 for i in range(1000, 3000) if i in bloom) < 40
+
+
+def test_unknown_backend():
+	with pytest.raises(ValueError):
+		dedup.make_backend('nope')
+
+
+def test_sqlite_index_expires(tmp_path):
+	"""keys are kept across opens until they're older than ttl"""
+	index = dedup.SqliteIndex.for_spider(str(tmp_path), 'spider', ttl=60, persist_size=2)
+	index.add('Item', b'a')
+	assert list(index.keys('Item')) == []
+	index.add('Item', b'b')
+	# written once persist_size keys are pending
+	assert sorted(index.keys('Item')) == [b'a', b'b']
+	index.close()
+
+	index = dedup.SqliteIndex.for_spider(str(tmp_path), 'spider', ttl=60)
+	assert index.expire() == 0
+	assert list(index.keys('Other')) == []
+	assert index.expire(now=time.time() + 120) == 2
+	assert list(index.keys('Item')) == []
+	index.close()
+
+
+def test_persistent_dupefilter(tmp_path):
+	"""requests seen in an earlier run are filtered"""
+	request = Request('http://example.com/a')
+	dupefilter = dedup.PersistentDupeFilter('spider', directory=str(tmp_path))
+	dupefilter.open()
+	assert not dupefilter.request_seen(request)
+	assert dupefilter.request_seen(request)
+	dupefilter.response_received(Response(request.url, request=request), request, None)
+	dupefilter.close('finished')
+
+	dupefilter = dedup.PersistentDupeFilter('spider', directory=str(tmp_path), backend='set')
+	dupefilter.open()
+	assert dupefilter.request_seen(request)
+	assert not dupefilter.request_seen(Request('http://example.com/b'))
+	dupefilter.close('finished')
+
+
+def test_persistent_dupefilter_resumes(tmp_path):
+	"""requests that were scheduled but not crawled before a crash aren't filtered on resume"""
+	crawled, pending = Request('http://example.com/crawled'), Request('http://example.com/pending')
+	dupefilter = dedup.PersistentDupeFilter('spider', directory=str(tmp_path))
+	dupefilter.open()
+	assert not dupefilter.request_seen(crawled)
+	assert not dupefilter.request_seen(pending)
+	dupefilter.response_received(Response(crawled.url, request=crawled), crawled, None)
+	dupefilter.close('shutdown')
+
+	dupefilter = dedup.PersistentDupeFilter('spider', directory=str(tmp_path))
+	dupefilter.open()
+	assert dupefilter.request_seen(crawled)
+	assert not dupefilter.request_seen(pending)
+	dupefilter.close('finished')
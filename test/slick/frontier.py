@@ -0,0 +1,99 @@
+import zlib
+
+from scrapy import Request, Spider
+from scrapy.http import Response
+
+from slick import frontier
+
+
+class FakeSpider(Spider):
+	name = 'fake'
+
+	def parse_page(self, response):
+		pass
+
+
+def test_sqlite_frontier_resumes(tmp_path):
+	"""pending requests survive a restart, crawled ones don't"""
+	def parse(response):
+		pass
+
+	queue = frontier.SqliteFrontier.for_spider(str(tmp_path), 'fake', flush_size=3)
+	queue.insert(Request('http://a.com/1', callback=parse))
+	queue.insert(Request('http://a.com/2'))
+	assert len(queue) == 2
+	queue.resolve(Response('http://a.com/2'))
+	# filled up, so written
+	assert len(queue) == 0
+	queue.insert(Request('http://a.com/1'))
+	queue.insert(Request('http://b.com/1', priority=5))
+	queue.close()
+
+	queue = frontier.SqliteFrontier.for_spider(str(tmp_path), 'fake')
+	assert sorted((url, callback, priority) for url, callback, priority, _ in queue.iter_pending()) == [
+		('http://a.com/1', 'parse', 0),
+		('http://b.com/1', None, 5)]
+	queue.close()
+
+
+def test_sqlite_frontier_queues(tmp_path):
+	"""domains take turns, and requests of a domain come by priority"""
+	queue = frontier.SqliteFrontier(str(tmp_path / 'queues.sqlite'))
+	for i in range(4):
+		queue.insert(Request(f'http://a.com/{i}'))
+	queue.insert(Request('http://a.com/first', priority=1))
+	queue.insert(Request('http://b.com/0'))
+	assert sorted(queue.domains()) == ['a.com', 'b.com']
+
+	pending = [url for url, _, _, _ in queue.iter_pending(chunk_size=2)]
+	assert len(pending) == 6
+	# a chunk per domain per turn, so b.com isn't stuck behind all of a.com
+	assert pending.index('http://b.com/0') <= 1
+	a_urls = [url for url in pending if 'a.com' in url]
+	assert a_urls[0] == 'http://a.com/first'
+	queue.close()
+
+
+def test_requests_are_rebuilt(tmp_path):
+	"""resumed requests keep their callback, cookies, meta and priority"""
+	spider = FakeSpider()
+	queue = frontier.SqliteFrontier(str(tmp_path / 'rebuilt.sqlite'), spider=spider)
+	queue.insert(Request('http://a.com/page', callback=spider.parse_page, priority=3,
+		cookies={'birthtime': '376041601'}, meta={'page': 2}))
+	# callbacks that aren't spider methods can't be serialized
+	queue.insert(Request('http://a.com/other', callback=lambda response: None))
+
+	rebuilt = {}
+	for row in queue.iter_pending():
+		request = frontier.make_request(spider, *row)
+		if request is not None:
+			rebuilt[request.url] = request
+	queue.close()
+
+	page = rebuilt['http://a.com/page']
+	assert page.callback == spider.parse_page
+	assert page.priority == 3
+	assert page.cookies == {'birthtime': '376041601'}
+	assert page.meta['page'] == 2
+	# rebuilt from url and callback name, and spider has no such method
+	assert 'http://a.com/other' not in rebuilt
+
+
+def test_missing_callbacks_are_skipped():
+	"""requests cached with a callback the spider no longer has aren't rebuilt"""
+	class RenamedSpider(Spider):
+		name = 'fake'
+
+	data = frontier.serialize(Request('http://a.com/page', callback=FakeSpider().parse_page), FakeSpider())
+	assert data is not None
+	assert frontier.make_request(RenamedSpider(), 'http://a.com/page', 'parse_page', data=data) is None
+
+
+def test_unreadable_requests_are_made_from_their_url():
+	"""corrupt data, or data pickled by other code, falls back to url, callback and priority"""
+	spider = FakeSpider()
+	for data in (b'corrupt', zlib.compress(b'cnomodule\nRequest\n.'), zlib.compress(b'garbage'), zlib.compress(b'')):
+		request = frontier.make_request(spider, 'http://a.com/page', 'parse_page', 4, data=data)
+		assert request.url == 'http://a.com/page'
+		assert request.callback == spider.parse_page
+		assert request.priority == 4
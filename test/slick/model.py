@@ -4,6 +4,8 @@ import json
 import pytest
 
 import sqlalchemy
+from scrapy.settings import Settings
+from sqlalchemy.dialects import mysql
 
 import lib
 from slick import model, item
@@ -84,6 +86,51 @@ class JoinedModel(model.BaseModel):
 	_lookup_attributes = ('name', )
 
 
+class CompoundLookupModel(model.BaseModel):
+	"""tests bulk lookups on more than one attribute"""
+	__tablename__ = 'compound_lookup'
+
+	id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+	name = sqlalchemy.Column(sqlalchemy.String(16))
+	kind = sqlalchemy.Column(sqlalchemy.String(16))
+
+	_lookup_attributes = ('name', 'kind')
+
+
+class CollatedLookupModel(model.BaseModel):
+	"""tests bulk lookups on a case insensitive column"""
+	__tablename__ = 'collated_lookup'
+
+	id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+	name = sqlalchemy.Column(sqlalchemy.String(16, collation='NOCASE'))
+
+	_lookup_attributes = ('name', )
+
+
+class NativeModel(model.BaseModel):
+	"""tests INSERT ... ON DUPLICATE KEY UPDATE upserts"""
+	__tablename__ = 'native'
+
+	id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+	name = sqlalchemy.Column(sqlalchemy.String(16), unique=True)
+	field = sqlalchemy.Column(sqlalchemy.String(16))
+
+	_lookup_attributes = ('name', )
+	_native_upsert = True
+
+
+class KeywordModel(model.BaseModel):
+	"""tests native upserts of columns named like sql keywords"""
+	__tablename__ = 'keyword'
+
+	id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+	name = sqlalchemy.Column(sqlalchemy.String(16), unique=True)
+	order = sqlalchemy.Column(sqlalchemy.Integer)
+
+	_lookup_attributes = ('name', )
+	_native_upsert = True
+
+
 class PlaceholderModel(model.BaseModel):
 	__tablename__ = 'placeholder'
 
@@ -94,7 +141,7 @@ class PlaceholderModel(model.BaseModel):
 
 session = session_factory('test.slick.model',
 	[SimpleModel, ComplexModel, LookupModel,
-		JoiningModel, JoinedModel, PlaceholderModel], logger)
+		JoiningModel, JoinedModel, CompoundLookupModel, CollatedLookupModel, NativeModel, PlaceholderModel], logger)
 
 
 @pytest.fixture()
@@ -120,9 +167,35 @@ JoiningItem = model.realize_item_class("JoiningItem", JoiningModel)
 JoinedItem = model.realize_item_class("JoinedItem", JoinedModel)
 
 
+CompoundLookupItem = model.realize_item_class("CompoundLookupItem", CompoundLookupModel)
+CollatedLookupItem = model.realize_item_class("CollatedLookupItem", CollatedLookupModel)
+
+
+NativeItem = model.realize_item_class("NativeItem", NativeModel)
+
+
 PlaceholderItem = model.realize_item_class("PlaceholderItem", PlaceholderModel)
 
 
+class QueryCounter(object):
+	"""counts sql statements executed on a session's engine"""
+	def __init__(self, db, prefix=''):
+		self.engine = db.get_bind()
+		self.prefix = prefix
+		self.count = 0
+
+	def _count(self, conn, cursor, statement, *args, **kwargs):
+		if statement.startswith(self.prefix):
+			self.count += 1
+
+	def __enter__(self):
+		sqlalchemy.event.listen(self.engine, 'before_cursor_execute', self._count)
+		return self
+
+	def __exit__(self, *args):
+		sqlalchemy.event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
 def test_get_model_class():
 	item = SimpleItem()
 	assert model.get_model_class_from_item(item) == SimpleModel
@@ -268,8 +341,358 @@ def test_doesnt_set_primary_or_foreign_keys(db):
 	assert bool(joined_model.joining) is False
 
 
+def test_write_plan():
+	"""plans are made when realizing, and skip keys and relationships"""
+	plan = model.get_write_plan(JoiningItem, JoiningModel)
+	assert plan is model.get_write_plan(JoiningItem, JoiningModel)
+	assert plan.columns == {'name', 'created_at', 'updated_at'}
+	assert plan.skipped == {'id', 'joined_id', 'joined'}
+	assert plan.dependents == {'joined'}
+
+	joining_item = JoiningItem(id=5, name='planned', joined_id=1)
+	assert plan.values(joining_item) == {'name': 'planned'}
+
+	placeholder_plan = model.get_write_plan(PlaceholderItem, PlaceholderModel)
+	assert 'placeholder' in placeholder_plan.columns
+	assert 'placeholder' not in placeholder_plan.table_columns
+
+
+def test_unchanged_values_arent_set(db):
+	"""applying an item that matches a loaded model doesn't modify it"""
+	db.add(SimpleModel(id=10, field='same'))
+	db.commit()
+
+	obj = db.query(SimpleModel).get(10)
+	model.update_model_from_item(obj, SimpleItem(id=10, field='same'))
+	assert obj not in db.dirty
+	assert not model.has_changes(db)
+
+	model.update_model_from_item(obj, SimpleItem(id=10, field='changed'))
+	assert model.has_changes(db)
+	db.rollback()
+
+
 def test_placeholder():
 	plc = "something"
 	item = PlaceholderItem(placeholder=plc)
 	mdl = model.create_model_from_item(item)
 	assert mdl.placeholder == plc
+
+
+def test_get_many_from_items(db):
+	"""bulk lookups map every key to a model or None"""
+	for name, kind in [('a', 'x'), ('a', 'y'), ('b', 'x')]:
+		db.add(CompoundLookupModel(name=name, kind=kind))
+	db.commit()
+
+	items = [CompoundLookupItem(name=name, kind=kind)
+		for name, kind in [('a', 'x'), ('b', 'x'), ('b', 'y'), ('a', 'x')]]
+
+	found = CompoundLookupModel.get_many_from_items(db, items, chunk_size=2)
+	assert set(found.keys()) == {('a', 'x'), ('b', 'x'), ('b', 'y')}
+	assert found[('a', 'x')].kind == 'x'
+	assert found[('b', 'x')].name == 'b'
+	assert found[('b', 'y')] is None
+
+	with pytest.raises(ValueError):
+		SimpleModel.get_many_from_items(db, [SimpleItem(field='a')])
+
+
+def test_get_many_from_items_collated(db):
+	"""keys the db matches by its collation map to the rows it found"""
+	db.add(CollatedLookupModel(name='Valve'))
+	db.add(CollatedLookupModel(name='Ubisoft'))
+	db.commit()
+
+	items = [CollatedLookupItem(name=name) for name in ['VALVE', 'valve', 'Valve', 'ubisoft', 'EA']]
+	found = CollatedLookupModel.get_many_from_items(db, items)
+	assert {key: obj and obj.name for key, obj in found.items()} == {
+		('VALVE', ): 'Valve',
+		('valve', ): 'Valve',
+		('Valve', ): 'Valve',
+		('ubisoft', ): 'Ubisoft',
+		('EA', ): None,
+	}
+
+
+def test_get_many_from_items_looser_collation(db, monkeypatch):
+	"""rows that can't be matched to keys by folding them make the keys left be looked up one by one"""
+	monkeypatch.setattr(model, '_collation_key', tuple)
+	items = [CollatedLookupItem(name=name) for name in ['VALVE', 'UBISOFT', 'EA']]
+	found = CollatedLookupModel.get_many_from_items(db, items)
+	assert {key: obj and obj.name for key, obj in found.items()} == {
+		('VALVE', ): 'Valve',
+		('UBISOFT', ): 'Ubisoft',
+		('EA', ): None,
+	}
+
+
+def test_upsert_many(db):
+	"""upserts a batch of joined items with one lookup per model class"""
+	db.add(JoinedModel(name='existing'))
+	db.commit()
+
+	joining_items = []
+	for i, joined_name in enumerate(['existing', 'new', 'new']):
+		loader = item.BaseLoader(JoiningItem())
+		loader.add_value('name', f'many{i}')
+		loader.add_dependent('joined', JoinedItem(name=joined_name))
+		joining_items.append(loader.load_item())
+
+	with QueryCounter(db) as counter:
+		resolved = model.resolve_items(db, joining_items)
+	assert counter.count == 2
+	assert resolved[JoinedModel][('existing', )] is not None
+	assert resolved[JoinedModel][('new', )] is None
+
+	out = model.upsert_many(db, joining_items)
+	assert [o.name for o in out] == ['many0', 'many1', 'many2']
+	assert out[0].joined.name == 'existing'
+	# items sharing a dependent within a batch share the object
+	assert out[1].joined is out[2].joined
+	assert db.query(JoinedModel).filter(JoinedModel.name == 'new').count() == 1
+
+
+def test_upsert_graph_queries_per_level(session):
+	"""a batch is written with a fixed number of queries per level, however big"""
+	def _count(prefix, n):
+		db = session()
+		joining_items = []
+		for i in range(n):
+			loader = item.BaseLoader(JoiningItem())
+			loader.add_value('name', f'{prefix}{i}')
+			loader.add_dependent('joined', JoinedItem(name=f'{prefix}{i}'))
+			joining_items.append(loader.load_item())
+
+		assert [len(level) for level in model._item_levels(joining_items)] == [n, n]
+		with QueryCounter(db) as counter:
+			out = model.upsert_many(db, joining_items)
+		assert [o.joined.name for o in out] == [f'{prefix}{i}' for i in range(n)]
+		assert db.query(JoiningModel).filter(JoiningModel.name.like(f'{prefix}%')).count() == n
+		db.close()
+		return counter.count
+
+	# a lookup per class, then an insert and a read back per level
+	assert _count('graph', 2) == _count('graphbig', 20) == 6
+
+
+def test_lookup_cache():
+	"""lru cache evicts least recently used, and counts"""
+	cache = model.LookupCache(maxsize=2)
+	db = set()
+	objs = {name: LookupModel(field=name) for name in 'abc'}
+	db.update(objs.values())
+
+	cache.put(LookupModel, ('a', ), objs['a'])
+	cache.put(LookupModel, ('b', ), objs['b'])
+	assert cache.get(db, LookupModel, ('a', )) is objs['a']
+	cache.put(LookupModel, ('c', ), objs['c'])
+
+	# b was least recently used
+	assert cache.get(db, LookupModel, ('b', )) is None
+	assert cache.get(db, LookupModel, ('c', )) is objs['c']
+	# not returned for a session the object isn't in, and dropped
+	assert cache.get(set(), LookupModel, ('c', )) is None
+	assert cache.stats() == {"hits": 2, "misses": 2, "evictions": 2, "size": 1}
+
+
+def test_lookup_cache_per_thread():
+	"""threads with sessions of their own don't evict each other's entries"""
+	import threading
+	cache = model.LookupCache(maxsize=10)
+	dbs = [set(), set()]
+	objs = [LookupModel(field='a'), LookupModel(field='a')]
+
+	turns = [threading.Semaphore(1), threading.Semaphore(0)]
+	found = []
+
+	def work(i):
+		"""the threads take turns"""
+		for turn in range(6):
+			turns[i].acquire()
+			if turn == 0:
+				dbs[i].add(objs[i])
+				cache.put(LookupModel, ('a', ), objs[i])
+			else:
+				found.append(cache.get(dbs[i], LookupModel, ('a', )) is objs[i])
+			turns[1 - i].release()
+
+	threads = [threading.Thread(target=work, args=(i, )) for i in range(2)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert all(found)
+	assert cache.stats() == {"hits": 10, "misses": 0, "evictions": 0, "size": 2}
+
+
+def test_lookup_cache_skips_queries(session):
+	"""repeated dependents are found without querying"""
+	db = session(expire_on_commit=False)
+	joining_items = []
+	for i in range(3):
+		loader = item.BaseLoader(JoiningItem())
+		loader.add_value('name', f'cached{i}')
+		loader.add_dependent('joined', JoinedItem(name='cached'))
+		joining_items.append(loader.load_item())
+
+	model.upsert(db, JoiningModel, joining_items[0])
+	hits = model.lookup_cache.hits
+	with QueryCounter(db, prefix='SELECT') as counter:
+		for joining_item in joining_items[1:]:
+			model.upsert(db, JoiningModel, joining_item, commit=False)
+	# only the two new joining lookups hit the db
+	assert counter.count == 2
+	assert model.lookup_cache.hits == hits + 2
+
+	db.rollback()
+	assert model.lookup_cache.stats()['size'] == 0
+	db.close()
+
+
+def test_native_upsert_statement():
+	"""builds a multi row upsert that keeps updated_at semantics"""
+	rows = [{"name": name, "field": "f", "created_at": None, "updated_at": None} for name in "ab"]
+	stmt = model.native_upsert_statement(NativeModel, rows)
+	sql = str(stmt.compile(dialect=mysql.dialect()))
+
+	assert sql.startswith("INSERT INTO native")
+	assert sql.count("%s") == 8
+	update = sql.split("ON DUPLICATE KEY UPDATE")[1]
+	# updated_at is assigned first, so it compares against the old values
+	assert update.strip().startswith("updated_at = IF((native.name <=> VALUES(name)) AND (native.field <=> VALUES(field))")
+	assert "field = VALUES(field)" in update
+	assert "created_at =" not in update
+
+
+def test_native_upsert_statement_row_alias():
+	"""servers that support it get the inserted rows aliased instead of VALUES()"""
+	rows = [{"name": "a", "field": "f", "created_at": None, "updated_at": None}]
+	sql = str(model.native_upsert_statement(NativeModel, rows, row_alias='new').compile(dialect=mysql.dialect()))
+
+	assert "VALUES (%s, %s, %s, %s) AS new ON DUPLICATE KEY UPDATE" in sql
+	update = sql.split("ON DUPLICATE KEY UPDATE")[1]
+	assert update.strip().startswith("updated_at = IF((native.name <=> new.name) AND (native.field <=> new.field)")
+	assert "field = new.field" in update
+	assert "VALUES(" not in update
+
+
+def test_native_upsert_statement_quotes_names():
+	"""column names that are keywords are quoted in the inserted values too"""
+	rows = [{"name": "a", "order": 1, "created_at": None, "updated_at": None}]
+	for row_alias, inserted in ((None, "VALUES(`order`)"), ('new', "new.`order`")):
+		sql = str(model.native_upsert_statement(KeywordModel, rows, row_alias=row_alias).compile(dialect=mysql.dialect()))
+		update = sql.split("ON DUPLICATE KEY UPDATE")[1]
+		assert f"(keyword.`order` <=> {inserted})" in update
+		assert f"`order` = {inserted}" in update
+
+
+def test_supports_row_alias():
+	def _db(name, version, mariadb=False):
+		dialect = type('Dialect', (), {'name': name, 'server_version_info': version, '_is_mariadb': mariadb})()
+		engine = type('Engine', (), {'dialect': dialect})()
+		return type('Session', (), {'get_bind': lambda self: engine})()
+
+	assert model.supports_row_alias(_db('mysql', (8, 0, 19)))
+	assert model.supports_row_alias(_db('mysql', (8, 4, 0)))
+	assert not model.supports_row_alias(_db('mysql', (8, 0, 18)))
+	assert not model.supports_row_alias(_db('mysql', (5, 7, 40)))
+	assert not model.supports_row_alias(_db('mysql', (10, 6, 12), mariadb=True))
+	assert not model.supports_row_alias(_db('sqlite', (3, 40, 0)))
+
+
+def test_native_upsert_falls_back(db):
+	"""native upsert is mysql only, other dialects use the orm"""
+	out = model.upsert_many(db, [NativeItem(name='native', field='orm')])
+	assert isinstance(out[0], NativeModel)
+	assert db.query(NativeModel).filter(NativeModel.name == 'native').one().field == 'orm'
+
+
+def test_native_upsert_skips_unchanged(db, monkeypatch):
+	"""rows that already have the scraped values aren't written, or counted as changes"""
+	db.add(NativeModel(name='same', field='kept'))
+	db.add(NativeModel(name='other', field='old'))
+	db.commit()
+
+	statements = []
+	monkeypatch.setattr(model, 'execute', lambda session, statement: statements.append(statement))
+
+	unchanged = NativeItem(name='same', field='kept')
+	out = model.native_upsert(db, NativeModel, [unchanged])
+	assert statements == []
+	assert isinstance(out[0], NativeModel)
+	assert model.is_unchanged(db, out[0])
+	assert not model.has_changes(db)
+
+	changed, new = NativeItem(name='other', field='changed'), NativeItem(name='new', field='new')
+	assert model.native_upsert(db, NativeModel, [unchanged, changed, new]) == [out[0], changed, new]
+	rows = statements[0].compile(dialect=mysql.dialect()).params
+	assert (rows['name_m0'], rows['field_m0'], rows['name_m1']) == ('other', 'changed', 'new')
+	assert 'name_m2' not in rows
+
+
+def test_native_upsert_groups_rows_by_columns(db, monkeypatch):
+	"""rows with the same columns share a statement, whatever order the fields were set in"""
+	statements = []
+	monkeypatch.setattr(model, 'execute', lambda session, statement: statements.append(statement))
+
+	first, second = NativeItem(), NativeItem()
+	first['name'], first['field'] = 'first', 'f'
+	second['field'], second['name'] = 's', 'second'
+	model.native_upsert(db, NativeModel, [first, second])
+	assert len(statements) == 1
+
+
+def test_engines_are_reused(monkeypatch):
+	"""same url and args share an engine, and pool config comes from settings"""
+	assert model.get_engine() is model.get_engine()
+	assert model.get_engine() is not model.get_engine(pool_recycle=1)
+
+	monkeypatch.setitem(model._pool_settings, 'MYSQL_POOL', 'queue')
+	monkeypatch.setitem(model._pool_settings, 'MYSQL_POOL_SIZE', 3)
+	args = model.get_pool_args()
+	assert args['poolclass'] is model.InstrumentedQueuePool
+	assert args['pool_size'] == 3
+
+	monkeypatch.setitem(model._pool_settings, 'MYSQL_POOL', 'nope')
+	with pytest.raises(ValueError):
+		model.get_pool_args()
+
+
+def test_configure_pool_before_sessions(monkeypatch):
+	"""the pool can't change under open sessions, only once they're closed"""
+	monkeypatch.setattr(model, '_pool_settings', {})
+	monkeypatch.setattr(model, 'SqlSession', model.ReloadableSession())
+	old_engine = model.SqlSession.session.kw['bind']
+	session = model.SqlSession()
+
+	with pytest.raises(RuntimeError):
+		model.configure_pool(Settings({'MYSQL_POOL': 'null'}))
+	assert model.SqlSession.session.kw['bind'] is old_engine
+	assert old_engine in model._engines.values()
+
+	session.close()
+	model.configure_pool(Settings({'MYSQL_POOL': 'null', 'MYSQL_POOL_RECYCLE': 60}))
+	engine = model.SqlSession.session.kw['bind']
+	assert engine is not old_engine
+	assert isinstance(engine.pool, sqlalchemy.pool.NullPool)
+	assert old_engine not in model._engines.values()
+	model.dispose_engine(engine)
+
+
+def test_pool_stats():
+	"""queue pools count checkouts"""
+	engine = model._get_or_create_engine('sqlite://', poolclass=model.InstrumentedQueuePool)
+	with engine.connect() as conn:
+		conn.execute("SELECT 1")
+		assert model.get_pool_stats()['checked_out'] == 1
+	with engine.connect() as conn:
+		conn.execute("SELECT 1")
+
+	pool_stats = model.get_pool_stats()
+	assert pool_stats['checkouts'] == 2
+	assert pool_stats['checked_out'] == 0
+	assert pool_stats['wait_time'] >= 0
+
+	model.dispose_engine(engine)
+	assert model.get_pool_stats() == {}
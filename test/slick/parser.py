@@ -44,3 +44,25 @@ def test_strip_query_string():
 	url_w_query = f"{url}?query=1"
 	assert parser.strip_query_string(url) == url
 	assert parser.strip_query_string(url_w_query) == url
+
+
+def test_fused_processors():
+	"""fused processors do what the chains they replace do"""
+	from itemloaders.processors import MapCompose
+	from w3lib import html
+
+	def remove_tags(value):
+		"""strip_tags as it was, before it was fused"""
+		return html.remove_tags(value) if isinstance(value, str) else value
+
+	def chain(*fns):
+		return MapCompose(remove_tags, parser.strip_whitespace, *fns)
+
+	numbers = ["1", " 1,001 ", "<span>2'001</span>\n", "<b>20.0</b>", "some <i>embedded</i> 10 number", 7]
+	assert chain(parser.read_int)(numbers) == parser.MapValues(parser.clean_int)(numbers)
+	floats = ["1.0", "<td> 1'001.101 </td>", 2.5]
+	assert chain(parser.read_float)(floats) == parser.MapValues(parser.clean_float)(floats)
+	texts = ["  a  ", "<a href='/x'>Some <b>Game</b></a>", "no tags", "<br/>", "a < b"]
+	assert chain()(texts) == parser.MapValues(parser.clean_text)(texts)
+	assert [True, True] == parser.MapValues(parser.is_present)(["", "<b></b>"])
+	assert [] == parser.MapValues(parser.clean_text)(None)
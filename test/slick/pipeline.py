@@ -1,9 +1,15 @@
+import pickle
+import time
+
 import pytest
 
 import sqlalchemy
+from scrapy.exceptions import DropItem
+from scrapy.utils.test import get_crawler
+from twisted.internet import reactor
 
 import lib
-from slick import model, pipeline
+from slick import dedup, model, pipeline
 from test import session_factory
 
 
@@ -19,8 +25,25 @@ class PipelineModel(model.BaseModel):
 
 PipelineItem = model.realize_item_class("PipelineItem", PipelineModel)
 
+
+class UniquePipelineModel(model.BaseModel):
+	"""looked up by a unique name, so concurrent inserts collide"""
+	__tablename__ = "pipeline_unique"
+
+	id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+	name = sqlalchemy.Column(sqlalchemy.String(16), unique=True)
+	field = sqlalchemy.Column(sqlalchemy.String(16))
+
+	_lookup_attributes = ('name', )
+
+
+UniquePipelineItem = model.realize_item_class("UniquePipelineItem", UniquePipelineModel)
+
+
+DedupItem = model.realize_item_class("DedupItem", PipelineModel, dedup_attribute="field")
+
 logger = lib.init_logger("test.slick.pipeline")
-session = session_factory('test.slick.pipeline', [PipelineModel], logger)
+session = session_factory('test.slick.pipeline', [PipelineModel, UniquePipelineModel], logger)
 
 
 @pytest.fixture()
@@ -38,7 +61,7 @@ class Pipeline(pipeline.DBPipeline):
 
 class PipelineSpider(object):
 	"""not depending on scrapy b/c we don't need to"""
-	_item_classes = (PipelineItem, )
+	_item_classes = (PipelineItem, UniquePipelineItem)
 	name = "test.slick.pipeline"
 	logger = logger
 
@@ -61,3 +84,206 @@ def test_db_pipeline(db):
 	assert found == processed
 
 	pipeliner.close_spider(spider)
+
+
+def test_batched_db_pipeline(db):
+	"""items are buffered and committed once per batch"""
+	stats = get_crawler().stats
+	pipeliner = Pipeline(stats=stats, batch_size=2)
+	spider = PipelineSpider()
+	pipeliner.open_spider(spider, db=db)
+
+	first = PipelineItem(id=2, field="first")
+	processed = pipeliner.process_item(first, spider)
+
+	# buffered, so nothing written yet
+	assert processed is first
+	assert db.query(PipelineModel).get(2) is None
+
+	pipeliner.process_item(PipelineItem(id=3, field="second"), spider)
+	assert db.query(PipelineModel).get(2).field == "first"
+	assert db.query(PipelineModel).get(3).field == "second"
+	assert stats.get_value('dbpipeline/batches') == 1
+	assert stats.get_value('dbpipeline/batch_size') == 2
+	assert stats.get_value('dbpipeline/commit_latency') is not None
+
+	# close flushes partial batches
+	pipeliner.process_item(PipelineItem(id=4, field="third"), spider)
+	pipeliner.close_spider(spider)
+	assert db.query(PipelineModel).get(4).field == "third"
+	assert stats.get_value('dbpipeline/batches') == 2
+	assert stats.get_value('dbpipeline/batched_items') == 3
+
+
+def wait(d, timeout=10):
+	"""result of a Deferred fired from worker threads, running their
+	callbacks without starting the reactor"""
+	results = []
+	d.addBoth(results.append)
+	started = time.time()
+	while not results and time.time() - started < timeout:
+		reactor.runUntilCurrent()
+		time.sleep(0.01)
+	assert results, "timed out"
+	return results[0]
+
+
+def test_threaded_db_pipeline(db):
+	"""worker threads write batches with sessions of their own"""
+	stats = get_crawler().stats
+	pipeliner = Pipeline(stats=stats, batch_size=1, threads=2)
+	spider = PipelineSpider()
+	pipeliner.open_spider(spider, db=db)
+	assert pipeliner.queue_depth == 2
+
+	item = PipelineItem(id=5, field="threaded")
+	assert wait(pipeliner.process_item(item, spider)) is item
+	assert len(pipeliner.sessions) == 1
+	assert pipeliner.sessions[0] is not db
+	assert db.query(PipelineModel).filter_by(field="threaded").count() == 1
+	assert stats.get_value('dbpipeline/batches') == 1
+
+	# nothing pending, so close finishes right away
+	wait(pipeliner.close_spider(spider))
+	assert not pipeliner.pool.started
+
+
+def test_threaded_writes_wait_for_the_queue(db, monkeypatch):
+	"""items are written one by one by the workers, and beyond the queue
+	depth wait for earlier writes. Writes that lose a race to insert the
+	same row are retried, and update the row the winner inserted"""
+	pipeliner = Pipeline(threads=2, queue_depth=1)
+	spider = PipelineSpider()
+	pipeliner.open_spider(spider, db=db)
+
+	upsert = model.upsert
+	raced = []
+
+	def _racing_upsert(session, model_klass, the_item, **kwargs):
+		out = upsert(session, model_klass, the_item, **kwargs)
+		if not raced:
+			# another writer inserts the same row between lookup and flush
+			raced.append(the_item)
+			winner = pipeliner.session_maker()
+			winner.add(UniquePipelineModel(name=the_item['name'], field="winner"))
+			winner.commit()
+			winner.close()
+		return out
+
+	monkeypatch.setattr(model, 'upsert', _racing_upsert)
+	first = pipeliner.process_item(UniquePipelineItem(name="raced", field="loser"), spider)
+	second = pipeliner.process_item(UniquePipelineItem(name="queued", field="queued"), spider)
+	assert pipeliner.semaphore.waiting
+
+	assert wait(first).field == "loser"
+	assert wait(second).field == "queued"
+	assert len(raced) == 1
+	rows = db.query(UniquePipelineModel).order_by(UniquePipelineModel.id).all()
+	assert [(row.name, row.field) for row in rows] == [("raced", "loser"), ("queued", "queued")]
+	wait(pipeliner.close_spider(spider))
+
+
+def test_unchanged_items_skip_writes(db):
+	"""recrawled items that match the db are neither updated nor committed"""
+	stats = get_crawler().stats
+	pipeliner = Pipeline(stats=stats)
+	spider = PipelineSpider()
+	pipeliner.open_spider(spider, db=db)
+
+	pipeliner.process_item(PipelineItem(id=6, field="same"), spider)
+	assert stats.get_value('dbpipeline/skipped_writes') is None
+
+	commits = []
+
+	def _committed(session):
+		commits.append(session)
+
+	sqlalchemy.event.listen(db, 'after_commit', _committed)
+	pipeliner.process_item(PipelineItem(id=6, field="same"), spider)
+	assert stats.get_value('dbpipeline/skipped_writes') == 1
+	assert commits == []
+
+	pipeliner.process_item(PipelineItem(id=6, field="changed"), spider)
+	assert stats.get_value('dbpipeline/skipped_writes') == 1
+	assert len(commits) == 1
+	sqlalchemy.event.remove(db, 'after_commit', _committed)
+
+	pipeliner.close_spider(spider)
+
+
+def test_timed_pipeline(db):
+	"""the pipeline records stage percentiles in crawler stats"""
+	stats = get_crawler().stats
+	pipeliner = Pipeline(stats=stats, timed=True)
+	spider = PipelineSpider()
+	pipeliner.open_spider(spider, db=db)
+	pipeliner.process_item(PipelineItem(id=100, field="timed"), spider)
+	pipeliner.close_spider(spider)
+
+	for stage in ('lookup', 'merge', 'dependents', 'flush', 'commit'):
+		assert stats.get_value(f'slick/timing/PipelineItem/{stage}/count') == 1
+		assert stats.get_value(f'slick/timing/PipelineItem/{stage}/p50') >= 0
+
+
+def test_item_deduplication_pipeline():
+	"""items with a dedup value seen before are dropped"""
+	stats = get_crawler().stats
+	pipeliner = pipeline.ItemDeduplicationPipeline(stats=stats, backends={'PipelineItem': 'set'})
+	spider = PipelineSpider()
+	pipeliner.open_spider(spider)
+
+	first = DedupItem(field="dup")
+	assert pipeliner.process_item(first, spider) is first
+	with pytest.raises(DropItem):
+		pipeliner.process_item(DedupItem(field="dup"), spider)
+
+	# items without a dedup attribute or value are passed on
+	for passed in [DedupItem(), PipelineItem(field="dup")]:
+		assert pipeliner.process_item(passed, spider) is passed
+
+	pipeliner.close_spider(spider)
+	assert stats.get_value('dedup/dropped') == 1
+	assert stats.get_value('dedup/size/DedupItem') == 1
+	# exact unless a bloom filter is asked for
+	assert isinstance(pipeliner.deduplicator.dedupers[DedupItem], dedup.ExactSet)
+	assert stats.get_value('dedup/suspected_false_positives/DedupItem') is None
+
+
+def test_item_deduplication_counts_false_positives():
+	"""bloom filters estimate how many new items they dropped"""
+	stats = get_crawler().stats
+	pipeliner = pipeline.ItemDeduplicationPipeline(stats=stats, backends={'DedupItem': 'bloom'},
+		capacity=100, error_rate=0.1)
+	spider = PipelineSpider()
+	pipeliner.open_spider(spider)
+	for i in range(100):
+		try:
+			pipeliner.process_item(DedupItem(field=str(i)), spider)
+		except DropItem:
+			pass
+	pipeliner.close_spider(spider)
+
+	estimate = stats.get_value('dedup/suspected_false_positives/DedupItem')
+	assert 0 < estimate < 10
+	assert isinstance(pipeliner.deduplicator.dedupers[DedupItem], dedup.BloomFilter)
+
+
+def test_item_deduplication_across_runs(tmp_path):
+	"""with an index, items seen in earlier runs are dropped"""
+	for run in range(2):
+		pipeliner = pipeline.ItemDeduplicationPipeline(index_dir=str(tmp_path))
+		spider = PipelineSpider()
+		pipeliner.open_spider(spider)
+		if run == 0:
+			pipeliner.process_item(DedupItem(field="persisted"), spider)
+		else:
+			with pytest.raises(DropItem):
+				pipeliner.process_item(DedupItem(field="persisted"), spider)
+		pipeliner.close_spider(spider)
+
+
+def test_realized_items_pickle():
+	"""realized item classes belong to the module that realizes them, so items can be pickled"""
+	assert DedupItem.__module__ == __name__
+	the_item = DedupItem(field="pickled")
+	assert pickle.loads(pickle.dumps(the_item)) == the_item
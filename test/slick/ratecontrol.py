@@ -0,0 +1,202 @@
+import pytest
+from scrapy import Request, Spider
+from scrapy.exceptions import DontCloseSpider, IgnoreRequest, NotConfigured
+from scrapy.http import Response
+from scrapy.utils.test import get_crawler
+from twisted.internet import task
+
+from slick import ratecontrol, recrawl
+
+
+class Clock(object):
+
+	def __init__(self):
+		self.now = 0.0
+
+	def __call__(self):
+		return self.now
+
+
+def test_disabled_by_default():
+	with pytest.raises(NotConfigured):
+		ratecontrol.AdaptiveRateMiddleware.from_crawler(get_crawler(Spider))
+
+
+def test_rate_speeds_up_and_backs_off():
+	rate = ratecontrol.DomainRate(delay=1.0, max_concurrency=4)
+	for _ in range(ratecontrol.SPEEDUP_STREAK):
+		rate.record(False, latency=0.1)
+	assert rate.delay < 1.0
+	assert rate.concurrency == 2
+
+	delay = rate.delay
+	rate.record(True)
+	assert rate.state == ratecontrol.CLOSED
+	assert rate.delay > delay
+	assert rate.concurrency == 1
+
+	# slow responses count as congestion
+	delay = rate.delay
+	rate.record(False, latency=10)
+	assert rate.delay > delay
+
+
+def test_circuit_opens_and_probes():
+	clock = Clock()
+	rate = ratecontrol.DomainRate(cooldown=10, clock=clock)
+	for _ in range(ratecontrol.TRIP_STREAK):
+		rate.record(True)
+	assert rate.state == ratecontrol.OPEN
+	assert rate.trips == 1
+	assert rate.slot_delay() == 10
+
+	assert not rate.allow_probe()
+	clock.now = 10
+	assert rate.allow_probe()
+	assert rate.state == ratecontrol.HALF_OPEN
+
+	# a blocked probe opens it for twice as long
+	rate.record(True)
+	assert rate.state == ratecontrol.OPEN
+	assert rate.open_until == 30
+
+	clock.now = 30
+	assert rate.allow_probe()
+	rate.record(False)
+	assert rate.state == ratecontrol.CLOSED
+	assert rate.cooldown == 10
+
+
+def test_middleware_sets_slots():
+	crawler = get_crawler(Spider, {
+		'RATECONTROL_ENABLED': True,
+		'RATECONTROL_START_DELAYS': {'slow.com': 3},
+	})
+	spider = crawler._create_spider('fake')
+	middleware = ratecontrol.AdaptiveRateMiddleware.from_crawler(crawler)
+	slot = type('Slot', (), {'delay': 0, 'concurrency': 8})()
+	crawler.engine = type('Engine', (), {})()
+	crawler.engine.downloader = type('Downloader', (), {'slots': {'slow.com': slot}})()
+
+	request = Request('http://slow.com/page')
+	middleware.process_request(request, spider)
+	assert slot.delay == 3
+	# domains start as concurrent as scrapy would crawl them
+	assert slot.concurrency == crawler.settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN')
+
+	for _ in range(ratecontrol.TRIP_STREAK):
+		response = middleware.process_response(request, Response(request.url, status=429), spider)
+		assert response.status == 429
+	assert middleware.rates['slow.com'].state == ratecontrol.OPEN
+	assert slot.delay >= middleware.rates['slow.com'].cooldown - 1
+	assert crawler.stats.get_value('ratecontrol/slow.com/trips') == 1
+	assert crawler.stats.get_value('ratecontrol/slow.com/state') == ratecontrol.OPEN
+
+	# other domains aren't affected
+	assert middleware.get_rate('fast.com').delay == 0
+
+
+def test_start_concurrency_setting():
+	crawler = get_crawler(Spider, {
+		'RATECONTROL_ENABLED': True,
+		'RATECONTROL_START_CONCURRENCY': 2,
+		'RATECONTROL_MAX_CONCURRENCY': 4,
+	})
+	middleware = ratecontrol.AdaptiveRateMiddleware.from_crawler(crawler)
+	assert middleware.get_rate('slow.com').concurrency == 2
+
+	middleware.start_concurrency = 16
+	assert middleware.get_rate('fast.com').concurrency == 4
+
+
+class Engine(object):
+	"""records requests handed back to the scheduler"""
+
+	def __init__(self):
+		self.downloader = type('Downloader', (), {'slots': {}})()
+		self.scheduled = []
+
+	def crawl(self, request, spider):
+		self.scheduled.append(request)
+
+
+def test_middleware_parks_requests_while_paused():
+	"""requests to paused domains leave the downloader until the cooldown is over,
+	then one probes while the rest are parked until it's answered"""
+	clock = task.Clock()
+	crawler = get_crawler(Spider, {'RATECONTROL_ENABLED': True, 'RATECONTROL_COOLDOWN': 10})
+	spider = crawler._create_spider('fake')
+	middleware = ratecontrol.AdaptiveRateMiddleware.from_crawler(crawler)
+	middleware.reactor = clock
+	middleware.rate_kwargs['clock'] = clock.seconds
+	crawler.engine = engine = Engine()
+
+	blocked = Request('http://slow.com/blocked')
+	for _ in range(ratecontrol.TRIP_STREAK):
+		middleware.process_response(blocked, Response(blocked.url, status=429), spider)
+	assert middleware.rates['slow.com'].state == ratecontrol.OPEN
+
+	for i in range(3):
+		with pytest.raises(IgnoreRequest):
+			middleware.process_request(Request(f'http://slow.com/{i}'), spider)
+	# other domains keep going
+	assert middleware.process_request(Request('http://fast.com/'), spider) is None
+	assert crawler.stats.get_value('ratecontrol/slow.com/parked') == 3
+	with pytest.raises(DontCloseSpider):
+		middleware.spider_idle(spider)
+
+	clock.advance(9)
+	assert engine.scheduled == []
+
+	# the cooldown is over, parked requests are scheduled again, and the first probes
+	clock.advance(1)
+	assert [r.url for r in engine.scheduled] == [f'http://slow.com/{i}' for i in range(3)]
+	assert all(r.dont_filter for r in engine.scheduled)
+	scheduled, engine.scheduled = engine.scheduled, []
+	assert middleware.process_request(scheduled[0], spider) is None
+	assert middleware.rates['slow.com'].state == ratecontrol.HALF_OPEN
+	for request in scheduled[1:]:
+		with pytest.raises(IgnoreRequest):
+			middleware.process_request(request, spider)
+
+	middleware.process_response(scheduled[0], Response(scheduled[0].url, status=200), spider)
+	assert middleware.rates['slow.com'].state == ratecontrol.CLOSED
+	assert [r.url for r in engine.scheduled] == ['http://slow.com/1', 'http://slow.com/2']
+	assert not clock.getDelayedCalls()
+	middleware.spider_idle(spider)
+
+
+def test_skipped_recrawls_answer_probes():
+	"""unchanged pages dropped by recrawl before they reach rate control still close the circuit"""
+	clock = task.Clock()
+	crawler = get_crawler(Spider, {'RATECONTROL_ENABLED': True, 'RATECONTROL_COOLDOWN': 10})
+	spider = crawler._create_spider('fake')
+	middleware = ratecontrol.AdaptiveRateMiddleware.from_crawler(crawler)
+	middleware.reactor = clock
+	middleware.rate_kwargs['clock'] = clock.seconds
+	crawler.engine = Engine()
+
+	blocked = Request('http://slow.com/blocked')
+	for _ in range(ratecontrol.TRIP_STREAK):
+		middleware.process_response(blocked, Response(blocked.url, status=429), spider)
+	clock.advance(10)
+	probe = Request('http://slow.com/unchanged')
+	assert middleware.process_request(probe, spider) is None
+	assert middleware.rates['slow.com'].state == ratecontrol.HALF_OPEN
+
+	crawler.signals.send_catch_log(signal=recrawl.request_skipped, request=probe, spider=spider)
+	assert middleware.rates['slow.com'].state == ratecontrol.CLOSED
+
+
+def test_unanswered_probes_time_out():
+	"""a dropped probe doesn't pause the domain for good"""
+	clock = task.Clock()
+	rate = ratecontrol.DomainRate(cooldown=10, probe_timeout=30, clock=clock.seconds)
+	for _ in range(ratecontrol.TRIP_STREAK):
+		rate.record(True)
+	clock.advance(10)
+	assert rate.allow_probe()
+	assert not rate.allow_probe()
+	assert rate.resume_at() == 40
+	clock.advance(30)
+	assert rate.allow_probe()
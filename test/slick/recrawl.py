@@ -0,0 +1,83 @@
+import pytest
+from scrapy import Request, Spider
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import Response
+from scrapy.utils.test import get_crawler
+
+from slick import recrawl
+
+
+def test_disabled_by_default():
+	with pytest.raises(NotConfigured):
+		recrawl.RecrawlMiddleware.from_crawler(get_crawler(Spider))
+
+
+def crawl(directory, body, status=200, headers=None, meta=None, callback=None):
+	"""a run of a spider crawling a single page, returns the request,
+	what the callback yielded, the stats and the url cache resolves"""
+	crawler = get_crawler(Spider, {'RECRAWL_ENABLED': True, 'RECRAWL_DIR': str(directory)})
+	spider = crawler._create_spider('fake')
+	skipped = []
+	crawler.signals.connect(lambda request, spider: skipped.append(request.url), signal=recrawl.request_skipped, weak=False)
+	middleware = recrawl.RecrawlMiddleware.from_crawler(crawler)
+	spider_middleware = recrawl.RecrawlSpiderMiddleware.from_crawler(crawler)
+	middleware.spider_opened(spider)
+	request = Request('http://a.com/page', meta={'recrawl': True} if meta is None else meta)
+	middleware.process_request(request, spider)
+	parsed = None
+	try:
+		response = middleware.process_response(request,
+			Response(request.url, status=status, body=body, headers=headers, request=request), spider)
+		parsed = list(spider_middleware.process_spider_output(response, (callback or (lambda r: [r.body]))(response), spider))
+	except IgnoreRequest:
+		pass
+	finally:
+		middleware.spider_closed(spider)
+	return request, parsed, crawler.stats, skipped
+
+
+def test_recrawl_skips_unchanged_pages(tmp_path):
+	"""validators are sent on recrawls, and unchanged pages dropped"""
+	request, parsed, _, _ = crawl(tmp_path, b'first', headers={'ETag': '"v1"'})
+	assert b'If-None-Match' not in request.headers
+	assert parsed == [b'first']
+
+	request, parsed, stats, skipped = crawl(tmp_path, b'', status=304)
+	assert request.headers.get('If-None-Match') == b'"v1"'
+	assert parsed is None
+	assert stats.get_value('recrawl/not_modified') == 1
+	# so the url cache marks them as crawled
+	assert skipped == [request.url]
+
+	_, parsed, stats, skipped = crawl(tmp_path, b'first')
+	assert parsed is None
+	assert stats.get_value('recrawl/unchanged') == 1
+	assert skipped == [request.url]
+
+	_, parsed, stats, skipped = crawl(tmp_path, b'second')
+	assert parsed == [b'second']
+	assert stats.get_value('recrawl/changed') == 1
+	assert skipped == []
+
+
+def test_recrawl_is_opt_in(tmp_path):
+	"""requests without recrawl in meta are always passed on"""
+	for _ in range(2):
+		request, parsed, _, skipped = crawl(tmp_path, b'same', headers={'ETag': '"v1"'}, meta={})
+		assert b'If-None-Match' not in request.headers
+		assert parsed == [b'same']
+		assert skipped == []
+
+
+def test_validators_are_stored_once_parsed(tmp_path):
+	"""pages whose callback failed are parsed again"""
+	def fail(response):
+		yield 'partial'
+		raise ValueError("broken loader")
+
+	with pytest.raises(ValueError):
+		crawl(tmp_path, b'page', callback=fail)
+	_, parsed, _, _ = crawl(tmp_path, b'page')
+	assert parsed == [b'page']
+	_, parsed, _, _ = crawl(tmp_path, b'page')
+	assert parsed is None
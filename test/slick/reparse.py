@@ -0,0 +1,66 @@
+from scrapy import Request, Spider
+from scrapy.http import HtmlResponse
+
+from slick import archive, reparse
+
+
+class FakeSpider(Spider):
+	name = 'fake'
+
+	def parse(self, response):
+		yield {'title': response.css('title::text').get(), 'start': True}
+
+	def parse_page(self, response):
+		yield {'title': response.css('title::text').get()}
+		yield Request('http://a.com/next', callback=self.parse_page)
+
+
+class DBSpider(FakeSpider):
+
+	def __init__(self, *args, **kwargs):
+		raise AssertionError("parse spiders shouldn't connect to the db")
+
+
+def test_parse_segments_in_processes(tmp_path):
+	"""every archived page is parsed once, spread over the workers"""
+	spider = FakeSpider()
+	writer = archive.ArchiveWriter(str(tmp_path), segment_size=1)
+	for i in range(8):
+		request = Request(f'http://a.com/{i}', callback=spider.parse_page)
+		response = HtmlResponse(request.url, body=f'<title>page {i}</title>'.encode('utf8'))
+		writer.write(archive.make_record(request, response, spider))
+	writer.close()
+	segments = archive.iter_segments(str(tmp_path))
+	assert len(segments) == 8
+
+	workers = reparse.WorkerStats()
+	titles = []
+	for pid, pages, seconds, items in reparse.parse_segments(FakeSpider, segments, processes=2):
+		workers.add(pid, pages, seconds)
+		titles.extend(i['title'] for i in items)
+	# in archive order
+	assert titles == [f'page {i}' for i in range(8)]
+	assert sum(workers.pages.values()) == 8
+	assert all(rate > 0 for rate in workers.rates().values())
+
+
+def test_start_url_records(tmp_path):
+	"""requests without callbacks are parsed by parse, robots.txt isn't parsed"""
+	spider = FakeSpider()
+	writer = archive.ArchiveWriter(str(tmp_path))
+	for url in ['http://a.com/robots.txt', 'http://a.com/start']:
+		request = Request(url)
+		response = HtmlResponse(request.url, body=b'<title>start</title>')
+		writer.write(archive.make_record(request, response, spider))
+	writer.close()
+
+	results = list(reparse.parse_segments(DBSpider, archive.iter_segments(str(tmp_path)), processes=2))
+	items = [i for _, _, _, segment_items in results for i in segment_items]
+	assert items == [{'title': 'start', 'start': True}]
+	assert sum(pages for _, pages, _, _ in results) == 1
+
+
+def test_make_parse_spider():
+	spider = reparse.make_parse_spider(DBSpider, category='games')
+	assert spider.name == 'fake'
+	assert spider.category == 'games'
@@ -0,0 +1,31 @@
+from slick import timing
+
+
+def test_histogram():
+	"""percentiles are nearest rank over kept samples"""
+	histogram = timing.Histogram(size=100)
+	assert histogram.percentile(50) is None
+	for value in range(1, 201):
+		histogram.add(value)
+
+	# only the last 100 samples are kept, but count and max see all of them
+	assert histogram.percentile(50) == 150
+	assert histogram.percentile(99) == 199
+	assert histogram.summary() == {'p50': 150, 'p95': 195, 'p99': 199, 'count': 200, 'max': 200}
+
+
+def test_stage_timer():
+	"""stages are timed per name"""
+	timer = timing.StageTimer()
+	with timer.time('GameItem', 'lookup'):
+		pass
+	timer.add(('GameItem', 'lookup'), 1.0)
+
+	stats = timer.stats()
+	assert stats['slick/timing/GameItem/lookup/count'] == 2
+	assert stats['slick/timing/GameItem/lookup/max'] == 1.0
+	assert 'slick/timing/GameItem/lookup/p99' in stats
+
+	assert timing.NULL_TIMER.stats() == {}
+	with timing.NULL_TIMER.time('GameItem', 'lookup'):
+		pass
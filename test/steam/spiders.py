@@ -1,7 +1,9 @@
 """tests steam spiders"""
+import hashlib
 import logging
 
 import scrapy
+import sqlalchemy
 
 from slick import model, parser
 import lib
@@ -88,16 +90,16 @@ def test_concurrent_players_search(concurrent_players_search_page):
 	assert _items[0] == '/app/730'
 
 
-def xtest_deduplication(deduplicator, developer_item, forum_page_item, game_item, email_item):
+def test_deduplication(deduplicator, developer_item, forum_page_item, game_item, email_item):
 	"""tests deduplication of items"""
 	for item in [developer_item, forum_page_item, email_item, game_item]:
 		klass = item.__class__
 		attr = item._dedup_attribute
 		assert attr is not None
-		pre_insert = deduplicator.check_duplicate(item)
+		pre_insert = deduplicator.is_duplicate(item)
 		assert pre_insert is False
 		dup = klass(**{attr: item[attr]})
-		post_insert = deduplicator.check_duplicate(dup)
+		post_insert = deduplicator.is_duplicate(dup)
 		assert post_insert is True
 
 
@@ -118,21 +120,91 @@ def test_url_cache(db, developer_page):
 		pass
 
 	spider = FakeSpider(db)
+	cache = models.UrlCacheBuffer(db, spider.name)
 	# starts off empty
 	res = [x for x in models.UrlCache.get(db, spider.name)]
 	assert not res
 
-	# one in cache after insert
-	models.UrlCache.insert(spider, developer_page)
+	# one in cache after insert is flushed
+	cache.insert(developer_page)
+	res = [x for x in models.UrlCache.get(db, spider.name)]
+	assert not res
+	assert cache.flush() == 1
 	res = [x for x in models.UrlCache.get(db, spider.name)]
 	assert res
 
 	# none in crawl after resolve
-	models.UrlCache.resolve(spider, developer_page)
+	cache.resolve(developer_page)
+	cache.flush()
 	res = [x for x in models.UrlCache.get(db, spider.name)]
 	assert not res
 
 
+def test_url_cache_buffer(db):
+	"""tests that url cache writes are buffered and flushed in bulk"""
+	spider = FakeSpider(db)
+	cache = models.UrlCacheBuffer(db, "buffered", flush_size=3)
+	urls = [f"{fixtures.DEVELOPER_URL}?page={i}" for i in range(3)]
+
+	cache.insert(scrapy.Request(url=urls[0], callback=spider.parse))
+	cache.insert(scrapy.Request(url=urls[1]))
+	# resolving a url pending insert stores it as crawled, and fills the buffer
+	cache.resolve(scrapy.http.Response(url=urls[1]))
+	assert len(cache) == 0
+	res = {x.url: x for x in models.UrlCache.get(db, "buffered")}
+	assert list(res) == [urls[0]]
+	assert res[urls[0]].callback == 'parse'
+
+	# urls already cached are ignored
+	cache.insert(scrapy.Request(url=urls[0]))
+	cache.insert(scrapy.Request(url=urls[2]))
+	cache.resolve(scrapy.http.Response(url=urls[0]))
+	assert len(cache) == 0
+	res = [x.url for x in models.UrlCache.get(db, "buffered")]
+	assert res == [urls[2]]
+
+
+def test_url_cache_iter_pending(db):
+	"""tests that pending urls are paged through by primary key"""
+	cache = models.UrlCacheBuffer(db, "paged")
+	urls = [f"{fixtures.DEVELOPER_URL}?page={i}" for i in range(5)]
+	for url in urls:
+		cache.insert(scrapy.Request(url=url))
+	cache.resolve(scrapy.http.Response(url=urls[0]))
+	cache.flush()
+
+	pending = list(models.UrlCache.iter_pending(db, "paged", chunk_size=2))
+	assert sorted(url for url, _, _ in pending) == urls[1:]
+	assert all(callback is None for _, callback, _ in pending)
+
+
+def test_url_cache_migrate(tmp_path):
+	"""tests that md5 keyed url caches are moved to fingerprint keys"""
+	engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'migrate.db'}")
+	engine.execute("""CREATE TABLE url_cache (
+		crawl_name VARCHAR(32) NOT NULL, url_hash VARCHAR(64) NOT NULL,
+		url VARCHAR(512), callback VARCHAR(64), crawled BOOLEAN,
+		PRIMARY KEY (crawl_name, url_hash))""")
+	engine.execute("CREATE INDEX ix_url_cache_url ON url_cache (url)")
+	urls = [f"{fixtures.DEVELOPER_URL}?page={i}" for i in range(5)]
+	for i, url in enumerate(urls):
+		engine.execute("INSERT INTO url_cache VALUES (?, ?, ?, ?, ?)",
+			("old", hashlib.md5(url.encode('utf8')).hexdigest(), url, 'parse', i == 0))
+
+	db = sqlalchemy.orm.sessionmaker(bind=engine)()
+	assert not models.UrlCache.is_current(db)
+	assert models.UrlCache.migrate(db, chunk_size=2) == len(urls)
+	assert models.UrlCache.is_current(db)
+	assert models.UrlCache.migrate(db) == 0
+	assert sqlalchemy.inspect(engine).get_table_names() == ['url_cache']
+
+	pending = list(models.UrlCache.iter_pending(db, "old"))
+	assert sorted(url for url, _, _ in pending) == urls[1:]
+	cached = db.query(models.UrlCache).filter(models.UrlCache.url == urls[0]).one()
+	assert cached.fingerprint == models.UrlCache.fingerprint_of(scrapy.Request(urls[0]))
+	db.close()
+
+
 class SpiderTester(object):
 	"""stubs out the processing by running parse, matching responses to stubbed
 	out ones, and yielding fake responses."""
@@ -181,6 +253,28 @@ class SpiderTester(object):
 		return items
 
 
+def test_url_cache_resolves_skipped_recrawls(tmp_path):
+	"""requests skipped by recrawls are marked as crawled"""
+	from scrapy.utils.test import get_crawler
+	from slick import recrawl
+	from steam.middlewares import CachingMiddleware
+
+	crawler = get_crawler(scrapy.Spider, {
+		'URLCACHE_BACKEND': 'sqlite',
+		'URLCACHE_DIR': str(tmp_path),
+		'URLCACHE_FLUSH_SECONDS': 0,
+	})
+	spider = crawler._create_spider('skipped')
+	middleware = CachingMiddleware.from_crawler(crawler)
+	middleware.spider_opened(spider)
+	requests = [scrapy.Request(f"{fixtures.DEVELOPER_URL}?page={i}") for i in range(2)]
+	for request in requests:
+		middleware.cache.insert(request)
+	crawler.signals.send_catch_log(signal=recrawl.request_skipped, request=requests[0], spider=spider)
+	assert [url for url, _, _, _ in middleware.cache.iter_pending()] == [requests[1].url]
+	middleware.spider_closed(spider)
+
+
 def test_tags_spider():
 	"""runs a tags crawl with predefined responses"""
 
@@ -202,3 +296,26 @@ def test_tags_spider():
 		steam_id=359550,
 		url=parser.strip_query_string(game_url),
 		skip_keys=('on_macos', 'on_linux',))
+
+
+def test_url_cache_needs_current_schema(tmp_path, monkeypatch):
+	"""the sql url cache stays off until url_cache is created or migrated"""
+	from scrapy.utils.test import get_crawler
+	from slick import model
+	from steam.middlewares import CachingMiddleware
+
+	engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'schema.db'}")
+	monkeypatch.setattr(model, 'SqlSession', sqlalchemy.orm.sessionmaker(bind=engine))
+	crawler = get_crawler(scrapy.Spider, {'URLCACHE_FLUSH_SECONDS': 0})
+	spider = crawler._create_spider('schema')
+	spider.db = None
+	middleware = CachingMiddleware.from_crawler(crawler)
+
+	middleware.spider_opened(spider)
+	assert middleware.cache is None
+	middleware.spider_closed(spider)
+
+	models.UrlCache.__table__.create(engine)
+	middleware.spider_opened(spider)
+	assert middleware.cache is not None
+	middleware.spider_closed(spider)
@@ -0,0 +1,47 @@
+"""tests whisky name extraction"""
+import datetime
+
+from whisky import extractor, parsers
+
+NAMES = [
+	"180 ml",
+	"1.5 litre",
+	"Nikka Single Malt Coffey Grain Whisky Woody & Mellow – 180ml",
+	"Some Whisky at 58.8% alc",
+	"2001 Exceptional Cask #6355-04 2019 Release",
+	"Suntory Special Reserve Whisky ’87 – Bird",
+	"Brora - 24 Year Old - 1977 Rare Malts",
+	"Macallan - 15 Year Old - Gran Reserva (2017) 70cl",
+	"Glenfarclas Family Cask No.1234 1968 43%",
+	"Yamazaki 12 Years 2150",
+	"Plain name",
+]
+
+
+def test_extract_matches_parsers():
+	t = datetime.datetime(year=2020, month=1, day=1)
+	for name in NAMES:
+		expected = {
+			'size': parsers.size(name),
+			'abv': parsers.abv(name),
+			'cask_no': parsers.cask_no(name),
+			'age': parsers.age(name),
+			'vintage': parsers.vintage(name, nowtime=t),
+			'currency': parsers.currency(name),
+		}
+		assert expected == extractor.extract(name, nowtime=t), name
+
+
+def test_extract():
+	res = extractor.extract("Brora - 37 Years Old - 2015 Release 70cl 48.1% Cask #12")
+	assert res == {
+		'size': 700.0,
+		'abv': 48.1,
+		'cask_no': '12',
+		'age': 37,
+		'vintage': 2015,
+		'currency': None,
+	}
+	# cached results aren't shared
+	res['size'] = None
+	assert extractor.extract("Brora - 37 Years Old - 2015 Release 70cl 48.1% Cask #12")['size'] == 700.0
@@ -0,0 +1,81 @@
+"""tests the distillery automaton"""
+from whisky import matcher
+
+
+def test_longest_match_wins():
+	automaton = matcher.Automaton(["Argyll", "Argyll/Mackinnon's", "Glen", "Glen Grant", "Grant", "Oban"])
+	assert "Argyll/Mackinnon's" == automaton("2001 Argyll/Mackinnon's Cask")
+	assert "Argyll" == automaton("Argyll 2010 Some Cask")
+	assert "Glen Grant" == automaton("The Glen Grant 10")
+	# leftmost of those as long
+	assert "Oban" == automaton("Oban and Glen")
+	assert automaton("Yamazaki") is None
+
+
+def test_order_doesnt_matter():
+	names = ["he", "she", "his", "hers", "ushers"]
+	for ordered in [names, names[::-1]]:
+		automaton = matcher.Automaton(ordered)
+		assert "ushers" == automaton("xushersx")
+		assert "hers" == automaton("ahishers")
+		assert "she" == automaton("ashe")
+
+
+def test_fold_case():
+	assert matcher.Automaton(["Macallan"])("MACALLAN 18") is None
+	automaton = matcher.Automaton(["Macallan", ""], fold_case=True)
+	assert "Macallan" == automaton("MACALLAN 18")
+	assert 1 == len(automaton)
+
+
+def test_cache(tmp_path):
+	source = tmp_path / 'names.txt'
+	cache = str(tmp_path / 'names.automaton')
+	source.write_text("Macallan\n")
+	assert matcher.load_cache(cache, str(source)) is None
+
+	matcher.save_cache(matcher.Automaton(["Macallan"]), cache, str(source))
+	assert "Macallan" == matcher.load_cache(cache, str(source))("Macallan 18")
+
+	# rebuilt once the names change
+	source.write_text("Macallan\nBrora\n")
+	assert matcher.load_cache(cache, str(source)) is None
+
+
+def test_unreadable_cache_is_rebuilt(tmp_path):
+	"""caches pickled by other versions raise all sorts of errors, and are treated as missing"""
+	source = tmp_path / 'names.txt'
+	source.write_text("Macallan\n")
+	cache = tmp_path / 'names.automaton'
+	for stale in (b'cnomodule\nAutomaton\n.', b'cwhisky.matcher\nOldAutomaton\n.', b'\x80\x04garbage'):
+		cache.write_bytes(stale)
+		assert matcher.load_cache(str(cache), str(source)) is None
+
+	from whisky import items
+	distillery_matcher = items.DistilleryMatcher(path=str(source), cache_path=str(cache))
+	assert "Macallan" == distillery_matcher("Macallan 18")
+	assert "Macallan" == matcher.load_cache(str(cache), str(source))("Macallan 18")
+
+
+def test_distillery_matcher_is_lazy(tmp_path):
+	from whisky import items
+	source = tmp_path / 'distilleries.txt'
+	cache = tmp_path / 'distilleries.automaton'
+	distillery_matcher = items.DistilleryMatcher(path=str(source), cache_path=str(cache))
+	source.write_text("Brora\nArdtalnaig (Lochtayside)\n")
+	assert not cache.exists()
+	assert "Ardtalnaig" == distillery_matcher("Fine specimen of Ardtalnaig")
+	assert cache.exists()
+	assert "Brora" == items.DistilleryMatcher(path=str(source), cache_path=str(cache))("Brora 1977")
+
+	assert items.DistilleryMatcher(path=str(tmp_path / 'missing.txt'), cache_path=str(cache))("Brora") is None
+
+
+def test_distillery_cache_dir(tmp_path, monkeypatch):
+	"""the cache goes in CACHE_DIR, not the package"""
+	from whisky import items
+	source = tmp_path / 'distilleries.txt'
+	source.write_text("Brora\n")
+	monkeypatch.setenv('CACHE_DIR', str(tmp_path / 'cache'))
+	assert "Brora" == items.DistilleryMatcher(path=str(source))("Brora 1977")
+	assert (tmp_path / 'cache' / items.DISTILLERIES_CACHE_NAME).exists()
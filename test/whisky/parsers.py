@@ -35,6 +35,8 @@ def test_distillery_parser():
 	assert "Argyll" == parser("Argyll 2010 Some Cask")
 	assert "Ardtalnaig" == parser("Fine specimen of Ardtalnaig")
 	assert "Argyll/Mackinnon's" == parser("2001 Argyll/Mackinnon's Exceptional Cask #6355-04 2019 Release")
+	assert parser("fine specimen of ardtalnaig") is None
+	assert "Ardtalnaig" == parsers.make_distillery_parser(test_distilleries, fold_case=True)("fine specimen of ardtalnaig")
 
 
 def test_vintage_parser():
@@ -0,0 +1,72 @@
+"""extracts every attribute of a whisky name in one call.
+
+Uses the precompiled patterns of whisky.parsers, tried in the same order,
+so results are the same as calling the parsers one by one. Each pattern
+has the literals one of which it can't match without, and is only searched
+for when the lowercased name contains one, so most patterns of most names
+are skipped with a substring check instead of a regex search. Results are
+cached by name, since the same lots are listed on many pages and re-parsed
+with every archive replay."""
+import functools
+
+from whisky import parsers
+
+# names whose results are kept
+CACHE_SIZE = 65536
+
+# attributes with their patterns, in order, and the literals each pattern needs.
+# None for patterns that can match without any
+ATTRIBUTES = (
+	('size', parsers.SIZE_REGEXS, (('ml', ), ('cl', ), ('litre', ), ('litre', ))),
+	('abv', parsers.ABV_REGEXS, (('%', ), ('%', ), ('.', ))),
+	('cask_no', parsers.CASK_NO_REGEXS, (('cask', ), ('cask', ), ('#', ))),
+	('age', parsers.AGE_REGEXS, (('year', ), ('year', ))),
+	('vintage', parsers.VINTAGE_REGEXS, (("'", '’'), None)),
+)
+
+
+def _gated(attributes):
+	res = []
+	for name, regexs, literals in attributes:
+		assert len(regexs) == len(literals), f"{name} needs literals for each of its patterns"
+		res.append((name, [(r, pp, needs) for (r, pp), needs in zip(regexs, literals)]))
+	return res
+
+
+GATED = _gated(ATTRIBUTES)
+NAMES = [name for name, _ in GATED]
+
+
+def _needed(needs, lowered):
+	if needs is None:
+		return True
+	for literal in needs:
+		if literal in lowered:
+			return True
+	return False
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _extract(txt):
+	"""attribute values of txt, in the order of ATTRIBUTES"""
+	lowered = txt.lower()
+	values = []
+	for _, patterns in GATED:
+		value = None
+		for r, pp, needs in patterns:
+			if _needed(needs, lowered):
+				found = r.search(txt)
+				if found:
+					value = found.group(1)
+					value = pp(value) if pp else value
+					break
+		values.append(value)
+	return tuple(values)
+
+
+def extract(txt, nowtime=None):
+	"""size, abv, cask_no, age, vintage and currency of txt, None if not found"""
+	res = dict(zip(NAMES, _extract(txt)))
+	res['vintage'] = parsers.check_year(res['vintage'], nowtime)
+	res['currency'] = parsers.currency(txt)
+	return res
@@ -1,23 +1,51 @@
 import json
+import os
 
 from scrapy.loader import processors
 
+import env
 import lib
 from slick import model, item, parser
-from whisky import parsers, models
+from whisky import extractor, matcher, parsers, models
 
 
 logger = lib.init_logger("whisky.items")
 
 
+DISTILLERIES_PATH = os.path.join(os.path.dirname(__file__), 'data', 'distilleries.txt')
+DISTILLERIES_CACHE_NAME = 'distilleries.automaton'
+
+
 class DistilleryMatcher(object):
-	def __init__(self):
-		self.parser = None
+	"""finds distilleries in names. The parser is built on first use, and
+	cached in cache_path for later processes, until the distilleries change.
+	cache_path defaults to a file in the CACHE_DIR env variable's directory"""
+
+	def __init__(self, path=DISTILLERIES_PATH, cache_path=None):
+		self.path = path
+		self.cache_path = cache_path
+		self._parser = None
+		self._loaded = False
+
+	def _load(self):
 		try:
-			with open('whisky/data/distilleries.txt', 'r') as f:
-				self.parser = parsers.make_distillery_parser(f.readlines())
+			cache_path = self.cache_path or os.path.join(env.cache_dir, DISTILLERIES_CACHE_NAME)
+			parser = matcher.load_cache(cache_path, self.path)
+			if parser is None:
+				with open(self.path, 'r') as f:
+					parser = parsers.make_distillery_parser(f.readlines())
+				matcher.save_cache(parser, cache_path, self.path)
+			return parser
 		except IOError:
-			pass
+			logger.warning(f"no distilleries in {self.path}, distilleries won't be matched")
+			return None
+
+	@property
+	def parser(self):
+		if not self._loaded:
+			self._parser = self._load()
+			self._loaded = True
+		return self._parser
 
 	def __call__(self, v):
 		if not self.parser:
@@ -38,11 +66,9 @@ def fill_item_from_name(_item):
 	if not string:
 		return _item
 
-	for attr_name in ['currency', 'abv',
-			'cask_no', 'size', 'vintage', 'age']:
-		fn = getattr(parsers, attr_name)
+	for attr_name, value in extractor.extract(string).items():
 		if _item.get(attr_name) is None:
-			_item[attr_name] = fn(string)
+			_item[attr_name] = value
 
 	if _item.get('distillery') is None:
 		_item['distillery'] = distillery_matcher(string)
@@ -0,0 +1,133 @@
+"""multi-pattern matching of names in text, with an Aho-Corasick automaton.
+
+The automaton is built once from the names, and finds every name in a
+single pass over the text, so matching doesn't slow down as names are
+added. Of the names found, the longest wins, and the leftmost of the
+longest, so results don't depend on the order of the names.
+
+Automatons can be cached in a file, see load_cache, which is rebuilt
+when the file of names it was built from changes."""
+import os
+import pickle
+
+import lib
+
+logger = lib.init_logger("whisky.matcher")
+
+
+class Automaton(object):
+	"""Aho-Corasick automaton of names. Nodes are numbered from 0, the root,
+	with transitions by character in goto, the node of the longest proper suffix
+	in fail, and the longest name ending at each node in out, -1 if none.
+	With fold_case, names and text are compared casefolded."""
+
+	def __init__(self, names, fold_case=False):
+		self.fold_case = fold_case
+		self.names = []
+		self.goto = [{}]
+		self.fail = [0]
+		self.out = [-1]
+		for name in names:
+			self._add(name)
+		self._link()
+
+	def _key(self, txt):
+		return txt.casefold() if self.fold_case else txt
+
+	def _add(self, name):
+		key = self._key(name)
+		if not key:
+			return
+		node = 0
+		for char in key:
+			nxt = self.goto[node].get(char)
+			if nxt is None:
+				nxt = len(self.goto)
+				self.goto[node][char] = nxt
+				self.goto.append({})
+				self.fail.append(0)
+				self.out.append(-1)
+			node = nxt
+		if self.out[node] == -1:
+			# the first of duplicate names is kept
+			self.out[node] = len(self.names)
+			self.names.append(name)
+
+	def _length(self, index):
+		return len(self._key(self.names[index]))
+
+	def _link(self):
+		"""sets fail links breadth first, and the outputs they lead to"""
+		queue = list(self.goto[0].values())
+		for node in queue:
+			for char, nxt in self.goto[node].items():
+				queue.append(nxt)
+				fallback = self.fail[node]
+				while fallback and char not in self.goto[fallback]:
+					fallback = self.fail[fallback]
+				target = self.goto[fallback].get(char, 0)
+				self.fail[nxt] = target if target != nxt else 0
+				if self.out[nxt] == -1:
+					# names ending here are suffixes, shorter than the node's own
+					self.out[nxt] = self.out[self.fail[nxt]]
+		self.lengths = [self._length(i) for i in range(len(self.names))]
+
+	def search(self, txt):
+		"""the longest name in txt, the leftmost of those as long, None if there's none"""
+		goto, fail, out, lengths = self.goto, self.fail, self.out, self.lengths
+		node = 0
+		best = -1
+		best_length = 0
+		for char in self._key(txt):
+			while node and char not in goto[node]:
+				node = fail[node]
+			node = goto[node].get(char, 0)
+			found = out[node]
+			if found != -1 and lengths[found] > best_length:
+				best, best_length = found, lengths[found]
+		return self.names[best] if best != -1 else None
+
+	def __call__(self, txt):
+		return self.search(txt)
+
+	def __len__(self):
+		return len(self.names)
+
+
+# bumped when the automaton changes, so older caches are rebuilt
+CACHE_VERSION = 1
+
+
+def _source_key(path):
+	stat = os.stat(path)
+	return (CACHE_VERSION, stat.st_mtime_ns, stat.st_size)
+
+
+def load_cache(cache_path, source_path):
+	"""the automaton cached in cache_path if it was built from source_path
+	as it is now, None otherwise. Caches that can't be read, e.g. pickled by
+	an older version of this module, are treated as missing, so they're rebuilt"""
+	try:
+		with open(cache_path, 'rb') as f:
+			key, automaton = pickle.load(f)
+	except FileNotFoundError:
+		return None
+	except Exception:
+		logger.warning(f"couldn't read automaton cache {cache_path}, rebuilding it", exc_info=True)
+		return None
+	return automaton if key == _source_key(source_path) else None
+
+
+def save_cache(automaton, cache_path, source_path):
+	"""caches automaton in cache_path, creating its directory and replacing
+	it atomically, so processes starting together don't see a partial cache"""
+	tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+	try:
+		os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+		with open(tmp_path, 'wb') as f:
+			pickle.dump((_source_key(source_path), automaton), f, protocol=4)
+		os.replace(tmp_path, cache_path)
+	except OSError:
+		# unwritable cache dirs build it every time
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
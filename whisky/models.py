@@ -8,6 +8,7 @@ class WhiskySearchResult(model.BaseModel):
 	__tablename__ = "whisky_search_result"
 	_filter_columns = ['id']
 	_lookup_attributes = ('name',)
+	_native_upsert = True
 
 	id = Column(Integer, primary_key=True)
 	name = Column(Unicode(512, collation=model.DEFAULT_COLLATION), unique=True)
@@ -21,6 +22,7 @@ class Whisky(model.BaseModel):
 	__tablename__ = "whisky"
 	_filter_columns = ['id']
 	_lookup_attributes = ('name',)
+	_native_upsert = True
 
 	id = Column(Integer, primary_key=True)
 
@@ -1,9 +1,13 @@
 import datetime
 import re
 
+from whisky import matcher
+
 
 def regex_proc(reg, txt, postproc=None):
-	found = re.search(reg, txt, flags=re.IGNORECASE)
+	"""group 1 of the first match of reg in txt, through postproc.
+	reg is a compiled pattern or a string, searched ignoring case"""
+	found = reg.search(txt) if isinstance(reg, re.Pattern) else re.search(reg, txt, flags=re.IGNORECASE)
 	if found:
 		target = found.group(1)
 		return postproc(target) if postproc else target
@@ -22,13 +26,13 @@ def _tofloat(v):
 	return float(v)
 
 
-def size(txt):
-	regexs = [
-		(r'(\d+)(:?\s+)?ml', _tofloat),
-		(r'(\d+)(:?\s+)?cl', _cl_pp),
-		(r'(\d+\.\d)+(:?\s+)?litre', _liter_pp),
-		(r'([\.\d])+(:?\s+)?litre', _liter_pp),
-	]
+def _compile(regexs):
+	"""compiles (pattern, postproc) pairs once, patterns have a single group"""
+	return [(re.compile(r, flags=re.IGNORECASE), pp) for r, pp in regexs]
+
+
+def first_match(regexs, txt):
+	"""result of the first of regexs that matches txt"""
 	for r, pp in regexs:
 		res = regex_proc(r, txt, postproc=pp)
 		if res is not None:
@@ -36,84 +40,78 @@ def size(txt):
 	return None
 
 
+SIZE_REGEXS = _compile([
+	(r'(\d+)(?::?\s+)?ml', _tofloat),
+	(r'(\d+)(?::?\s+)?cl', _cl_pp),
+	(r'(\d+\.\d)+(?::?\s+)?litre', _liter_pp),
+	(r'([\.\d])+(?::?\s+)?litre', _liter_pp),
+])
+
+ABV_REGEXS = _compile([
+	(r'(\d+\.\d)+%', _tofloat),
+	(r'(\d+)%', _tofloat),
+	(r'(\d+\.\d)+', _tofloat),
+])
+
+CASK_NO_REGEXS = _compile([
+	(r'Cask\s+?#([-\d]+)', None),
+	(r'Cask\s+No\.?#?([-\d]+)', None),
+	(r'#([-\d]+)', None),
+])
+
+
+def size(txt):
+	return first_match(SIZE_REGEXS, txt)
+
+
 def abv(txt):
-	regexs = [
-		(r'(\d+\.\d)+%', _tofloat),
-		(r'(\d+)%', _tofloat),
-		(r'(\d+\.\d)+', _tofloat),
-	]
-	for r, pp in regexs:
-		res = regex_proc(r, txt, postproc=pp)
-		if res is not None:
-			return res
-	return None
+	return first_match(ABV_REGEXS, txt)
 
 
 def cask_no(txt):
-	regexs = [
-		(r'Cask\s+?#([-\d]+)', None),
-		(r'Cask\s+No\.?#?([-\d]+)', None),
-		(r'#([-\d]+)', None),
-	]
-	for r, pp in regexs:
-		res = regex_proc(r, txt, postproc=pp)
-		if res is not None:
-			return res
-	return None
+	return first_match(CASK_NO_REGEXS, txt)
 
 
-def make_distillery_parser(distilleries):
+def make_distillery_parser(distilleries, fold_case=False):
+	"""parser of the longest of distilleries in a text. Parentheses
+	are removed from names, as in "Ardtalnaig (Lochtayside)"."""
 	processed = [
 			re.sub(r'\(\w+\)', '', dist).strip() for dist in distilleries]
-
-	def distillery_parser(txt):
-		for dist in processed:
-			if txt.find(dist) != -1:
-				return dist
-		return None
-
-	return distillery_parser
+	return matcher.Automaton(processed, fold_case=fold_case)
 
 
-def _make_check_year(nowtime):
-	def check_year(val):
-		year = int(val)
-		if 1800 <= year <= nowtime.year:
-			return year
-		return None
-	return check_year
+AGE_REGEXS = _compile([
+	(r'(\d{1,3})\s+Years?\s+Old', int),
+	(r'(\d{1,3})\s+Years', int),
+])
 
 
 def age(txt, nowtime=None):
-	nowtime = nowtime or datetime.datetime.utcnow()
-	regexs = [
-		(r'(\d{1,3})\s+Years?\s+Old', lambda v: int(v)),
-		(r'(\d{1,3})\s+Years', lambda v: int(v)),
-	]
-	for r, pp in regexs:
-		res = regex_proc(r, txt, postproc=pp)
-		if res is not None:
-			return res
-	return None
+	return first_match(AGE_REGEXS, txt)
 
 
 def _to_1900(v):
 	return 1900 + int(v)
 
 
-def vintage(txt, nowtime=None):
+VINTAGE_REGEXS = _compile([
+	(r"(?:'|’)(\d{2})", _to_1900),
+	(r'(\d{4})', int),
+])
+
+
+def check_year(year, nowtime=None):
+	"""year if it can be a vintage, None otherwise"""
 	nowtime = nowtime or datetime.datetime.utcnow()
-	regexs = [
-		(r"(?:'|’)(\d{2})", _to_1900),
-		(r'(\d{4})', _make_check_year(nowtime)),
-	]
-	for r, pp in regexs:
-		res = regex_proc(r, txt, postproc=pp)
-		if res is not None:
-			return res
+	if year is not None and 1800 <= year <= nowtime.year:
+		return year
 	return None
 
 
+def vintage(txt, nowtime=None):
+	return check_year(first_match(VINTAGE_REGEXS, txt), nowtime)
+
+
 def currency(txt):
 	if 'usd' in txt.lower() or '$' in txt:
 		return 'USD'
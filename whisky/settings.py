@@ -11,13 +11,43 @@ ROBOTSTXT_OBEY = True
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 SPIDER_MIDDLEWARES = {
 		'slick.middlewares.TransactionRecoverMiddleware': 300,
+		'slick.recrawl.RecrawlSpiderMiddleware': 550,
 }
 
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 DOWNLOADER_MIDDLEWARES = {
 		'slick.middlewares.MetricsDownloaderMiddleware': 543,
+		# after RetryMiddleware, so it sees blocks before they're retried
+		'slick.ratecontrol.AdaptiveRateMiddleware': 560,
+		# before HttpCompressionMiddleware, so it sees decompressed bodies
+		'slick.archive.ArchiveMiddleware': 570,
+		'slick.recrawl.RecrawlMiddleware': 580,
 }
 
+# skips pages that haven't changed since the last run, for requests with
+# meta={'recrawl': True}, see slick/recrawl.py.
+# Validators are kept in a sqlite file per spider, for RECRAWL_TTL seconds.
+RECRAWL_ENABLED = True
+RECRAWL_TTL = 7 * 24 * 60 * 60
+#RECRAWL_DIR = '.recrawl'
+
+# sets delay and concurrency per domain from blocks, errors and latency,
+# and pauses domains that keep blocking us, see slick/ratecontrol.py
+RATECONTROL_ENABLED = True
+#RATECONTROL_START_DELAY = 0
+#RATECONTROL_START_DELAYS = {'steamcommunity.com': 3}
+#RATECONTROL_START_CONCURRENCY = 8
+#RATECONTROL_MIN_DELAY = 0
+#RATECONTROL_MAX_DELAY = 60
+#RATECONTROL_MAX_CONCURRENCY = 8
+#RATECONTROL_COOLDOWN = 60
+#RATECONTROL_MAX_COOLDOWN = 1800
+#RATECONTROL_PROBE_TIMEOUT = 180
+
+# archives downloaded pages, so they can be re-parsed with `python <project>.py reparse <spider>`
+#ARCHIVE_ENABLED = True
+#ARCHIVE_DIR = '.archive'
+
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
 		'whisky.pipeline.WhiskyItemPipeline': 200,
@@ -31,3 +61,8 @@ EXTENSIONS = {
 
 LOG_LEVEL = "INFO"
 PUBLISHMETRICS_INTERVAL = 60
+
+# DBPipeline buffers items and commits once per batch,
+# flushing when either limit is hit. 0 disables a limit.
+DBPIPELINE_BATCH_SIZE = 100
+DBPIPELINE_BATCH_SECONDS = 10
@@ -25,7 +25,7 @@ class GrandSpider(spider.DBMixin, scrapy.Spider):
 	def parse(self, response):
 		for item in items.grand_whisky_search_result(response):
 			yield item
-			yield scrapy.Request(url=item['url'], callback=self.parse_whisky)
+			yield scrapy.Request(url=item['url'], callback=self.parse_whisky, meta={'recrawl': True})
 
 	def parse_whisky(self, response):
 		yield items.grand_whisky_item(response)
@@ -48,7 +48,7 @@ class DekantaSpider(spider.DBMixin, scrapy.Spider):
 	def parse(self, response):
 		for item in items.DekantaSearchResultItem.loads(response):
 			yield item
-			yield scrapy.Request(url=item['url'], callback=self.parse_whisky)
+			yield scrapy.Request(url=item['url'], callback=self.parse_whisky, meta={'recrawl': True})
 
 	def parse_whisky(self, response):
 		yield items.DekantaWhiskyItem.load(response)